@@ -11,3 +11,5 @@ PLATE_RANGE_PATTERN = re.compile(r'^(\d+)\s*-\s*(\d+)$$')
 # - must start with an ascii alphabetic character
 # - may contain spaces,dashes, and colons
 COPY_NAME_PATTERN = re.compile(r'^[A-Za-z]+[\w\- :]*$')
+
+default_app_config = 'db.apps.DbConfig'
@@ -2,7 +2,7 @@
 from __future__ import unicode_literals
 
 import cStringIO
-from collections import defaultdict, OrderedDict
+from collections import defaultdict, OrderedDict, namedtuple, deque
 from copy import deepcopy
 from decimal import Decimal
 from functools import wraps
@@ -14,9 +14,11 @@ from operator import itemgetter
 import os
 import random
 import re
+import resource
 from tempfile import SpooledTemporaryFile, NamedTemporaryFile
 import time
 import urllib
+import zlib
 from urlparse import urlparse
 from zipfile import ZipFile, ZipInfo
 
@@ -24,12 +26,11 @@ from aldjemy.core import get_engine, get_tables
 import aldjemy.core
 from django.conf import settings
 from django.conf.urls import url
-from django.core.cache import caches
 from django.core.exceptions import ObjectDoesNotExist, PermissionDenied
 from django.core.serializers.json import DjangoJSONEncoder
 from django.db import connection
 from django.db import transaction
-from django.db.models import F, Q
+from django.db.models import F, Q, Count, Sum
 from django.db.utils import ProgrammingError
 from django.forms.models import model_to_dict
 from django.http import Http404
@@ -68,7 +69,7 @@ from db.models import ScreensaverUser, Screen, \
     LabAffiliation, UserAgreement, RawDataTransform, RawDataInputFile
 from db.schema import VOCAB
 from db.support import lims_utils, screen_result_importer, bin_packer, \
-    raw_data_reader, plate_matrix_transformer
+    raw_data_reader, plate_matrix_transformer, bulk_load
 from db.support.plate_matrix_transformer import Collation
 from db.support.screen_result_importer import PARTITION_POSITIVE_MAPPING, \
     CONFIRMED_POSITIVE_MAPPING
@@ -78,7 +79,7 @@ from reports import BadRequestError, ValidationError, InformationError, \
 from reports import LIST_DELIMITER_SQL_ARRAY, LIST_DELIMITER_URL_PARAM, \
     HTTP_PARAM_USE_TITLES, HTTP_PARAM_USE_VOCAB, HTTP_PARAM_DATA_INTERCHANGE, \
     LIST_BRACKETS, HTTP_PARAM_RAW_LISTS, HEADER_APILOG_COMMENT, ValidationError, \
-    CumulativeError, LIST_DELIMITER_SUB_ARRAY
+    CumulativeError, LIST_DELIMITER_SUB_ARRAY, HTTP_PARAM_PRETTY_JSON
 from reports.api import API_PARAM_OVERRIDE, \
     API_PARAM_PATCH_PREVIEW_MODE, API_PARAM_NO_BACKGROUND, API_PARAM_PREVIEW_LOGS, \
     API_PARAM_SHOW_PREVIEW, DEBUG_AUTHORIZATION, write_authorization, read_authorization, \
@@ -94,12 +95,13 @@ from reports.schema import DATE_FORMAT, API_RESULT_DATA, API_RESULT_META, \
     API_RESULT_OBJ
 from reports.serialize import parse_val, XLSX_MIMETYPE, SDF_MIMETYPE, \
     XLS_MIMETYPE, JSON_MIMETYPE, CSV_MIMETYPE, ZIP_MIMETYPE, \
-    INPUT_FILE_DESERIALIZE_LINE_NUMBER_KEY, csvutils, LimsJSONEncoder
+    INPUT_FILE_DESERIALIZE_LINE_NUMBER_KEY, csvutils, LimsJSONEncoder, \
+    JSON_COLUMNAR_MIMETYPE
 from reports.serialize.csvutils import convert_list_vals
 from reports.serialize.streaming_serializers import ChunkIterWrapper, \
     json_generator, cursor_generator, sdf_generator, generic_xlsx_response, \
     csv_generator, get_xls_response, image_generator, closing_iterator_wrapper, \
-    FileWrapper1
+    FileWrapper1, json_columnar_generator, image_tuple_generator
 from reports.serialize.xlsutils import LIST_DELIMITER_XLS, write_xls_image
 from reports.serializers import LimsSerializer, \
     XLSSerializer, ScreenResultSerializer
@@ -107,7 +109,11 @@ from reports.sqlalchemy_resource import SqlAlchemyResource
 from reports.sqlalchemy_resource import _concat, _concat_with_sep
 from reports.utils import default_converter
 from reports.utils import sort_nicely, alphanum_key
+from reports.utils.copy_stream import copy_from_generator
 from reports.utils.django_requests import convert_request_method_to_put
+from reports.utils.result_cache import get_result_cache, get_tagged, \
+    set_tagged, count_cache_stat, get_cache_stats, get_statement_tables, \
+    get_table_tags
 import reports.utils.si_unit as si_unit
 import schema as SCHEMA
 
@@ -136,6 +142,8 @@ PLATE_NUMBER_SQL_FORMAT = 'FM9900000'
 PSYCOPG_NULL = '\\N'
 MAX_SPOOLFILE_SIZE = 1024*1024
 MAX_WELL_FINDER_COUNT = 384*10000
+# Wells listed in the screen result load error for wells not found
+MAX_MISSING_WELLS_TO_REPORT = 100
 
 API_MSG_COPYWELLS_DEALLOCATED = 'Copy wells deallocated'
 API_MSG_COPYWELLS_ALLOCATED = 'Copy wells allocated'
@@ -183,7 +191,19 @@ API_PARAM_SET_DESELECTED_TO_ZERO = 'set_deselected_to_zero'
 API_PARAM_DC_IDS = 'dc_ids'
 API_PARAM_SHOW_RESTRICTED = 'show_restricted'
 API_PARAM_SHOW_ARCHIVED = 'show_archived'
+API_PARAM_SEARCH_MODE = 'search_mode'
+API_PARAM_SEARCH_LIMIT = 'search_limit'
 
+# Vendor identifier and compound name search modes
+COMPOUND_SEARCH_STARTS_WITH = 'starts_with'
+COMPOUND_SEARCH_CONTAINS = 'contains'
+COMPOUND_SEARCH_FUZZY = 'fuzzy'
+COMPOUND_SEARCH_MODES = (
+    COMPOUND_SEARCH_STARTS_WITH, COMPOUND_SEARCH_CONTAINS, 
+    COMPOUND_SEARCH_FUZZY)
+
+# Internal key for the content digest of the input well data
+REAGENT_CONTENT_DIGEST_KEY = '_content_digest'
 
 logger = logging.getLogger(__name__)
 
@@ -196,6 +216,111 @@ DEBUG_LIB_LOAD = False or logger.isEnabledFor(logging.DEBUG)
 DEBUG_PLATE_EDIT = False or logger.isEnabledFor(logging.DEBUG)
 DEBUG_WELL_PARSE = False or logger.isEnabledFor(logging.DEBUG)
     
+# Well fields used to load screen result values (see create_result_values)
+ResultWell = namedtuple(
+    'ResultWell', ['well_id', 'plate_number', 'library_well_type'])
+
+class ResultWellMap(object):
+    '''
+    The library wells, for the screen result load (see create_result_values):
+    - the wells of the plates of the load are fetched, in batches of 
+    FETCH_PLATE_BATCH_SIZE plates,
+    - the library_well_type of the wells of each plate are stored by well 
+    (row, column) position, as one byte codes,
+    - the map is fetched on the caller's connection, before the result values
+    are generated in the producer thread of copy_from_generator, so that the
+    wells are not queried on the producer thread's connection (and 
+    transaction).
+    '''
+    MAX_COLS = 48
+    FETCH_PLATE_BATCH_SIZE = 1000
+    
+    def __init__(self):
+        self.plates = {}
+        self.well_types = []
+    
+    def fetch(self, cursor, screen_type, plate_numbers):
+        ''' Fetch the wells of the plates, for the screen_type libraries '''
+        plate_numbers = sorted(plate_numbers)
+        well_count = 0
+        for i in range(0, len(plate_numbers), self.FETCH_PLATE_BATCH_SIZE):
+            cursor.execute(
+                'select w.plate_number, array_agg(w.well_name), '
+                'array_agg(w.library_well_type) '
+                'from well w join library l on w.library_id = l.library_id '
+                'where l.screen_type = %s and w.plate_number = any(%s) '
+                'group by w.plate_number', 
+                [screen_type, 
+                    plate_numbers[i:i+self.FETCH_PLATE_BATCH_SIZE]])
+            for plate_number, well_names, library_well_types in cursor:
+                positions = [
+                    self.get_position(*lims_utils.well_row_col(well_name))
+                        for well_name in well_names]
+                codes = bytearray(max(positions)+1)
+                for position, library_well_type in zip(
+                        positions, library_well_types):
+                    codes[position] = self.get_type_code(library_well_type)
+                self.plates[plate_number] = codes
+                well_count += len(well_names)
+        logger.info('fetched result wells: plates: %d/%d, wells: %d', 
+            len(self.plates), len(plate_numbers), well_count)
+    
+    def get_position(self, row, col):
+        return row * self.MAX_COLS + col
+    
+    def get_type_code(self, library_well_type):
+        ''' Return the code for the type, 0 is used for no well '''
+        if library_well_type not in self.well_types:
+            self.well_types.append(library_well_type)
+        return self.well_types.index(library_well_type) + 1
+    
+    def get(self, well_id):
+        ''' 
+        Return the ResultWell for the well_id, or None if not found
+        - the well_id must match exactly: the well at the position of a 
+        well_id that is not in the canonical form (e.g. "00001:a1") is not 
+        returned
+        '''
+        match = WELL_ID_PATTERN.match(well_id)
+        if not match:
+            return None
+        plate_number = int(match.group(1))
+        codes = self.plates.get(plate_number)
+        if codes is None:
+            return None
+        col = int(match.group(4))-1
+        if col < 0 or col >= self.MAX_COLS:
+            return None
+        row = lims_utils.letter_to_row_index(match.group(3))
+        if well_id != '%05d:%s' % (
+                plate_number, lims_utils.get_well_name(row, col)):
+            return None
+        position = self.get_position(row, col)
+        if position >= len(codes) or codes[position] == 0:
+            return None
+        return ResultWell(
+            well_id, plate_number, self.well_types[codes[position]-1])
+
+# Eviction order for the well_query_index cached queries, most valuable first
+# (see ScreenResultResource.get_cached_queries_to_evict)
+WELL_QUERY_EVICTION_ORDER = {
+    'lru': 'coalesce(last_accessed, datetime) desc, id desc',
+    'lfu': 'hit_count desc, coalesce(last_accessed, datetime) desc, id desc',
+}
+# Recent well_query_index evictions (for this server process)
+_well_query_evictions = deque(maxlen=100)
+
+# Backends for the filtered well sets of the screen result queries:
+# - "table": rows in the well_query_index table (see create_cached_well_query)
+# - "cache": compressed blocks of the well_id list in the screen_cache (see 
+# create_cached_well_set)
+WELL_QUERY_BACKEND_TABLE = 'table'
+WELL_QUERY_BACKEND_CACHE = 'cache'
+# Wells per compressed block of a cached well set; a page reads only the 
+# blocks that it spans
+WELL_SET_BLOCK_SIZE = 10000
+CachedWellSet = namedtuple('CachedWellSet', ['key', 'count', 'base_stmt'])
+    
 def _get_raw_time_string():
   return timezone.now().strftime("%Y%m%d%H%M%S")
 
@@ -216,6 +341,7 @@ class DbApiResource(reports.api.ApiResource):
             self._create_well_query_index_table(conn)
             self._create_well_data_column_positive_index_table(conn)
             self._create_screen_overlap_table(conn)
+            self._create_result_matrix_table(conn)
 
     def clear_cache(self, request, **kwargs):
         logger.debug('clearing the cache from resource: %s' 
@@ -224,7 +350,7 @@ class DbApiResource(reports.api.ApiResource):
         self.get_cache().clear()
     
     def get_cache(self):
-        return caches['db_cache']
+        return get_result_cache('db_cache')
     
     def get_reagent_resource(self, library_classification):
 
@@ -267,6 +393,23 @@ class DbApiResource(reports.api.ApiResource):
                     sqlalchemy.Column('screen_id', sqlalchemy.Integer),
                     sqlalchemy.Column('overlap_screen_id', sqlalchemy.Integer))
                 
+            elif table_name == 'result_matrix':
+                return sqlalchemy.sql.schema.Table(
+                    'result_matrix', 
+                    aldjemy.core.get_meta(),
+                    sqlalchemy.Column('screen_result_id', sqlalchemy.Integer),
+                    sqlalchemy.Column('well_id', sqlalchemy.String),
+                    sqlalchemy.Column('numeric_values', 
+                        postgresql.ARRAY(sqlalchemy.Float)),
+                    sqlalchemy.Column('text_values', 
+                        postgresql.ARRAY(sqlalchemy.String)))
+            elif table_name == 'result_matrix_layout':
+                return sqlalchemy.sql.schema.Table(
+                    'result_matrix_layout', 
+                    aldjemy.core.get_meta(),
+                    sqlalchemy.Column('screen_result_id', sqlalchemy.Integer),
+                    sqlalchemy.Column('data_column_ids', 
+                        postgresql.ARRAY(sqlalchemy.Integer)))
             elif table_name == 'well_query_index':
                 return sqlalchemy.sql.schema.Table(
                     'well_query_index', 
@@ -387,23 +530,94 @@ class DbApiResource(reports.api.ApiResource):
                 'note that this is normal if the table already exists '
                 '(PostgreSQL <9.1 has no "CREATE TABLE IF NOT EXISTS"'), e)
 
+    def _create_result_matrix_table(self, conn):
+        '''
+        Create the result_matrix tables, if not created by the 
+        0102_result_matrix migration: for databases created without 
+        migrations (e.g. the test database); the migration also creates the
+        rows for existing screen results.
+        '''
+        try:
+            conn.execute(text(
+                'select * from "result_matrix_layout" limit 1; '))
+            logger.debug('The result_matrix table exists')
+            return
+        except Exception as e:
+            logger.info('creating the result_matrix table')
+        
+        try:
+            # One row per assay well; the result values are stored in arrays,
+            # by data column position (see result_matrix_layout)
+            conn.execute(text(
+                'CREATE TABLE result_matrix ('
+                ' "screen_result_id" integer NOT NULL, '
+                ' "well_id" text NOT NULL, '
+                ' "numeric_values" double precision[], '
+                ' "text_values" text[], '
+                ' PRIMARY KEY (screen_result_id, well_id) '
+                ');'
+            ))
+            conn.execute(text(
+                'CREATE TABLE result_matrix_layout ('
+                ' "screen_result_id" integer PRIMARY KEY, '
+                ' "data_column_ids" integer[] NOT NULL '
+                ');'
+            ))
+            logger.info('the result_matrix table created')
+        except Exception, e:
+            logger.info((
+                'Exception: %r on trying to create the '
+                'result_matrix table,'
+                'note that this is normal if the table already exists '
+                '(PostgreSQL <9.1 has no "CREATE TABLE IF NOT EXISTS"'), e)
+
     @classmethod
-    @transaction.atomic
-    def get_create_well_data_column_positive_index(cls):
+    def _build_well_data_column_positive_select(cls, screen_id=None):
         '''
-        If the well_data_column_positive_index has been cleared, recreate.
-        - recreate the entire index each time
+        Select the (well_id, data_column_id, screen_id) of the positive assay
+        wells, for the positive indicator data columns
+        @param screen_id (optional) select for the screen only
         '''
         bridge = get_tables()
         _aw = bridge['assay_well']
         _sr = bridge['screen_result']
         _s = bridge['screen']
         _dc = bridge['data_column']
+        base_stmt = join(
+            _aw, _dc, _aw.c.screen_result_id == _dc.c.screen_result_id)
+        base_stmt = base_stmt.join(
+            _sr, _sr.c.screen_result_id==_aw.c.screen_result_id)
+        base_stmt = base_stmt.join(_s, _sr.c.screen_id==_s.c.screen_id)
+        base_stmt = select([
+            _aw.c.well_id,
+            _dc.c.data_column_id,
+            _sr.c.screen_id
+            ]).select_from(base_stmt)            
+        base_stmt = base_stmt.where(_aw.c.is_positive)
+        base_stmt = base_stmt.where(_s.c.study_type==None)
+        base_stmt = base_stmt.where(
+            _dc.c.data_type.in_([
+                DC_DATA_TYPE.BOOLEAN_POSITIVE,
+                DC_DATA_TYPE.PARTITIONED_POSITIVE, 
+                DC_DATA_TYPE.CONFIRMED_POSITIVE]))
+        if screen_id is not None:
+            base_stmt = base_stmt.where(_sr.c.screen_id==screen_id)
+        base_stmt = base_stmt.order_by(
+            _dc.c.data_column_id, _aw.c.well_id)
+        return base_stmt
+    
+    @classmethod
+    @transaction.atomic
+    def get_create_well_data_column_positive_index(cls):
+        '''
+        If the well_data_column_positive_index is empty, create it for all 
+        screens.
+        - the index is maintained for each screen when screen results are
+        loaded or deleted (see update_well_data_column_positive_index); the
+        full build is needed only for a new (or manually cleared) index.
+        '''
         _wdc = cls.get_table_def('well_data_column_positive_index')
 
-        # Recreate the well_data_column_positive_index:
-        # Note: because this is lazy recreated, we are creating the whole 
-        # index each time; could just recreate for the specific screen
         count_stmt = select([func.count()]).select_from(_wdc)
         count = 0
         with get_engine().begin() as conn:
@@ -414,29 +628,10 @@ class DbApiResource(reports.api.ApiResource):
                 logger.info(
                     'well_data_column_positive_index count: %r, recreating', count)
             
-                base_stmt = join(
-                    _aw, _dc, _aw.c.screen_result_id == _dc.c.screen_result_id)
-                base_stmt = base_stmt.join(
-                    _sr, _sr.c.screen_result_id==_aw.c.screen_result_id)
-                base_stmt = base_stmt.join(_s, _sr.c.screen_id==_s.c.screen_id)
-                base_stmt = select([
-                    _aw.c.well_id,
-                    _dc.c.data_column_id,
-                    _sr.c.screen_id
-                    ]).select_from(base_stmt)            
-                base_stmt = base_stmt.where(_aw.c.is_positive)
-                base_stmt = base_stmt.where(_s.c.study_type==None)
-                base_stmt = base_stmt.where(
-                    _dc.c.data_type.in_([
-                        DC_DATA_TYPE.BOOLEAN_POSITIVE,
-                        DC_DATA_TYPE.PARTITIONED_POSITIVE, 
-                        DC_DATA_TYPE.CONFIRMED_POSITIVE]))
-                base_stmt = base_stmt.order_by(
-                    _dc.c.data_column_id, _aw.c.well_id)
                 insert_statement = (
                     insert(_wdc)
                         .from_select(['well_id', 'data_column_id','screen_id'], 
-                            base_stmt))
+                            cls._build_well_data_column_positive_select()))
                 logger.info('execute mutual pos insert statement...')
                 logger.debug(
                     'mutual pos insert statement: %r',
@@ -449,11 +644,66 @@ class DbApiResource(reports.api.ApiResource):
     
     @classmethod
     @transaction.atomic
-    def get_create_screen_overlap_indexes(cls):
+    def update_well_data_column_positive_index(cls, screen_id):
+        '''
+        Replace the well_data_column_positive_index rows for the screen: call
+        when the screen result is loaded or deleted.
+        '''
         _wdc = cls.get_create_well_data_column_positive_index()
-        _screen_overlap = cls.get_table_def('screen_overlap')
+        with get_engine().begin() as conn:
+            result = conn.execute(
+                delete(_wdc).where(_wdc.c.screen_id==screen_id))
+            logger.info(
+                'well_data_column_positive_index, removed: %d, screen_id: %r', 
+                result.rowcount, screen_id)
+            result = conn.execute(
+                insert(_wdc).from_select(
+                    ['well_id', 'data_column_id','screen_id'], 
+                    cls._build_well_data_column_positive_select(screen_id)))
+            logger.info(
+                'well_data_column_positive_index, inserted: %d, screen_id: %r', 
+                result.rowcount, screen_id)
+        return _wdc
+    
+    @classmethod
+    def _build_screen_overlap_select(cls, _wdc, screen_id=None):
+        '''
+        Select the (screen_id, overlap_screen_id) of the screens having
+        positives in the same wells
+        @param screen_id (optional) select the overlaps of the screen only, 
+            in both directions
+        '''
         wdc1 = _wdc.alias('wdc1')
         wdc2 = _wdc.alias('wdc2')
+        base_stmt = (
+            select([wdc1.c.screen_id, wdc2.c.screen_id.label('overlap_screen_id')])
+            .select_from(
+                wdc1.join(wdc2, wdc1.c.well_id==wdc2.c.well_id))
+            .where(wdc1.c.screen_id!=wdc2.c.screen_id)
+            .group_by(wdc1.c.screen_id,wdc2.c.screen_id))
+        if screen_id is not None:
+            # Note: filter on wdc1 only, so that only the positives of the 
+            # screen are scanned (and joined to wdc2 by well_id); then select
+            # the overlaps in both directions
+            overlaps = base_stmt.where(wdc1.c.screen_id==screen_id)\
+                .cte('screen_overlaps')
+            base_stmt = union_all(
+                select([overlaps.c.screen_id, overlaps.c.overlap_screen_id]),
+                select([
+                    overlaps.c.overlap_screen_id.label('screen_id'), 
+                    overlaps.c.screen_id.label('overlap_screen_id')]))
+        return base_stmt
+    
+    @classmethod
+    @transaction.atomic
+    def get_create_screen_overlap_indexes(cls):
+        '''
+        If the screen_overlap table is empty, create it for all screens.
+        - the table is maintained for each screen when screen results are
+        loaded or deleted (see update_screen_overlap)
+        '''
+        _wdc = cls.get_create_well_data_column_positive_index()
+        _screen_overlap = cls.get_table_def('screen_overlap')
         
         count_stmt = select([func.count()]).select_from(_screen_overlap)
         count = 0
@@ -463,16 +713,10 @@ class DbApiResource(reports.api.ApiResource):
         if count == 0:
             logger.info('screen_overlap count: %r, recreating', count)
         
-            base_stmt = (
-                select([wdc1.c.screen_id, wdc2.c.screen_id.label('overlap_screen_id')])
-                .select_from(wdc1)
-                .select_from(wdc2)
-                .where(wdc1.c.screen_id!=wdc2.c.screen_id)
-                .where(wdc1.c.well_id==wdc2.c.well_id)
-                .group_by(wdc1.c.screen_id,wdc2.c.screen_id))
             insert_statement = (
                 insert(_screen_overlap)
-                    .from_select(['screen_id','overlap_screen_id'], base_stmt))
+                    .from_select(['screen_id','overlap_screen_id'], 
+                        cls._build_screen_overlap_select(_wdc)))
             
             if logger.isEnabledFor(logging.DEBUG) or DEBUG_SCREENRESULT is True:
                 logger.info(
@@ -485,6 +729,33 @@ class DbApiResource(reports.api.ApiResource):
             logger.info('screen_overlap insert statement, executed: %d.' % result.rowcount)
         return _screen_overlap
     
+    @classmethod
+    @transaction.atomic
+    def update_screen_overlap(cls, screen_id):
+        '''
+        Replace the screen_overlap rows for the screen (both directions), from
+        the well_data_column_positive_index rows of the screen: call after 
+        update_well_data_column_positive_index.
+        '''
+        _screen_overlap = cls.get_create_screen_overlap_indexes()
+        _wdc = cls.get_table_def('well_data_column_positive_index')
+        with get_engine().begin() as conn:
+            result = conn.execute(
+                delete(_screen_overlap).where(or_(
+                    _screen_overlap.c.screen_id==screen_id,
+                    _screen_overlap.c.overlap_screen_id==screen_id)))
+            logger.info(
+                'screen_overlap, removed: %d, screen_id: %r', 
+                result.rowcount, screen_id)
+            result = conn.execute(
+                insert(_screen_overlap).from_select(
+                    ['screen_id','overlap_screen_id'], 
+                    cls._build_screen_overlap_select(_wdc, screen_id)))
+            logger.info(
+                'screen_overlap, inserted: %d, screen_id: %r', 
+                result.rowcount, screen_id)
+        return _screen_overlap
+    
     def get_apilog_resource(self):
         if self.apilog_resource is None:
             self.apilog_resource = ApiLogResource()
@@ -3738,6 +4009,13 @@ class ScreenResultResource(DbApiResource):
             self.screen_resource = ScreenResource()
         return self.screen_resource
     
+    def get_modified_tables(self):
+        '''
+        Screen result loads write the result value, index, and overlap tables,
+        which are not declared by the schema: clear the caches (see un_cache)
+        '''
+        return None
+    
     @transaction.atomic()        
     def clear_cache(self, request, **kwargs):
         
@@ -3756,7 +4034,7 @@ class ScreenResultResource(DbApiResource):
         if all is True or any([by_date,by_size,by_uri]) is False:
             # Manually clear the screen caches
             DbApiResource.clear_cache(self, request, **kwargs)
-            caches['screen_cache'].clear()
+            get_result_cache('screen_cache').clear()
 
         max_indexes_to_cache = getattr(
             settings, 'MAX_WELL_INDEXES_TO_CACHE', 3e+08)
@@ -3772,20 +4050,12 @@ class ScreenResultResource(DbApiResource):
                     [(x.id, x.uri) for x in query])
             ids = set()
             if by_size:
-                query = query.order_by('-datetime')
-                cumulative_count = 0
-
-                for q in query:
-                    if q.count:
-                        cumulative_count += q.count
-                    if cumulative_count >= max_indexes_to_cache:
-                        last_id_to_save = q.id
-                        logger.info(
-                            'cumulative_count: %d, last_id_to_save: %d',
-                            cumulative_count, last_id_to_save)
-                        query = query.filter(id__lte=last_id_to_save)
-                        ids.update([q.id for q in query])
-                        break
+                evicted = self.get_cached_queries_to_evict(
+                    max_indexes_to_cache, 
+                    keep_id=param_hash.get('keep_query_id'))
+                if evicted:
+                    ids.update([query_id for query_id,count in evicted])
+                    self.record_eviction(evicted, max_indexes_to_cache)
                 
             if by_date:  # TODO: test
                 query = query.filter(datetime__lte=by_date)
@@ -3826,11 +4096,11 @@ class ScreenResultResource(DbApiResource):
             logger.exception('on screenresult clear cache')
             raise e  
 
-        # NOTE: for now, clear the wdcpi when a new screen_result is loaded:
-        # (when "all" or "by_uri" is set)
-        # TODO: incrementally clear the wdcpi for each set of ids, or all
-        if all is True or by_uri is not None:
-            logger.info('all: %r, by_uri: %r', all, by_uri)
+        # NOTE: the well_data_column_positive_index and the screen_overlap are
+        # maintained for each screen (see update_well_data_column_positive_index,
+        # update_screen_overlap); clear to recreate for all screens
+        if param_hash.get('clear_positive_indexes', False):
+            logger.info('clear the well_data_column_positive_index')
             get_engine().execute(delete(self.get_table_def('well_data_column_positive_index')))
             logger.info(
                 'cleared all cached well_data_column_positive_indexes')
@@ -3895,6 +4165,97 @@ class ScreenResultResource(DbApiResource):
         rv_select = rv_select.label(key)
         return rv_select
 
+    def _build_result_matrix_column(
+            self, field_information, position, cast_boolean=False):
+        '''
+        Select the result value from the result_matrix row for the assay well:
+        result_matrix.<numeric_values|text_values>[position]
+        '''
+        data_column_type = field_information.get('data_type') 
+        if data_column_type in ['numeric', 'decimal', 'integer']:
+            return literal_column(
+                'result_matrix.numeric_values[%d]' % position)
+        elif data_column_type == 'boolean' and cast_boolean is True:
+            return literal_column(
+                'CAST( result_matrix.text_values[%d] as BOOLEAN)' % position)
+        else:
+            return literal_column('result_matrix.text_values[%d]' % position)
+    
+    def get_result_matrix_positions(self, screen_result):
+        '''
+        Return a dict of {data_column_id: position} for the result_matrix
+        arrays of the screen_result, or None if the result_matrix is not 
+        current with the data columns of the screen_result.
+        '''
+        _dc = self.bridge['data_column']
+        _layout = self.get_table_def('result_matrix_layout')
+        screen_result_id = screen_result.screen_result_id
+        with get_engine().connect() as conn:
+            layout = conn.execute(
+                select([_layout.c.data_column_ids])
+                .where(_layout.c.screen_result_id == screen_result_id)
+                ).scalar()
+            if layout is None:
+                logger.info('no result_matrix for: %r', screen_result)
+                return None
+            data_column_ids = [ row[0] for row in conn.execute(
+                select([_dc.c.data_column_id])
+                .where(_dc.c.screen_result_id == screen_result_id)
+                .order_by(_dc.c.ordinal, _dc.c.data_column_id)) ]
+        if list(layout) != data_column_ids:
+            logger.warn(
+                'result_matrix for %r does not match the data columns: %r, %r', 
+                screen_result, layout, data_column_ids)
+            return None
+        return { 
+            data_column_id: i+1 for i, data_column_id in enumerate(layout) }
+    
+    def create_result_matrix(self, screen_result):
+        '''
+        Create the result_matrix rows for the screen_result: one row per assay
+        well, with the result values in arrays ordered by data column ordinal.
+        - if the result values are duplicated for a well and data column, the 
+        first one loaded is used (see _build_result_value_column)
+        '''
+        screen_result_id = screen_result.screen_result_id
+        with connection.cursor() as cursor:
+            cursor.execute(
+                'DELETE FROM result_matrix WHERE screen_result_id = %s; '
+                'DELETE FROM result_matrix_layout '
+                'WHERE screen_result_id = %s; ', 
+                [screen_result_id, screen_result_id])
+            cursor.execute(
+                'WITH dc AS ( '
+                '  SELECT data_column_id, '
+                '    row_number() over (order by ordinal, data_column_id) '
+                '      as position '
+                '  FROM data_column WHERE screen_result_id = %(id)s ), '
+                'rv AS ( '
+                '  SELECT DISTINCT ON (data_column_id, well_id) '
+                '    data_column_id, well_id, numeric_value, value '
+                '  FROM result_value JOIN dc using(data_column_id) '
+                '  ORDER BY data_column_id, well_id, result_value_id ), '
+                'layout AS ( '
+                '  INSERT INTO result_matrix_layout '
+                '  SELECT %(id)s, '
+                '    coalesce(array_agg(data_column_id order by position), '
+                '      \'{}\') '
+                '  FROM dc ) '
+                'INSERT INTO result_matrix '
+                '(screen_result_id, well_id, numeric_values, text_values) '
+                'SELECT %(id)s, aw.well_id, '
+                '  array_agg(rv.numeric_value order by dc.position), '
+                '  array_agg(rv.value order by dc.position) '
+                'FROM assay_well aw CROSS JOIN dc '
+                'LEFT JOIN rv ON rv.data_column_id = dc.data_column_id '
+                '  AND rv.well_id = aw.well_id '
+                'WHERE aw.screen_result_id = %(id)s '
+                'GROUP BY aw.well_id; ', 
+                { 'id': screen_result_id })
+            logger.info('created result_matrix rows for %r: %d', 
+                screen_result, cursor.rowcount)
+            return cursor.rowcount
+    
     # 20180220 - not used after rv query optimizations
     # def _build_result_value_column_for_base_select(self, field_information):
     #     '''
@@ -3973,6 +4334,243 @@ class ScreenResultResource(DbApiResource):
             )
         return excluded_cols_select.cte('exclusions')
     
+    def get_eviction_policy(self):
+        policy = getattr(settings, 'WELL_QUERY_INDEX_EVICTION_POLICY', 'lru')
+        if policy not in WELL_QUERY_EVICTION_ORDER:
+            logger.warn('unknown WELL_QUERY_INDEX_EVICTION_POLICY: %r, '
+                'using "lru"', policy)
+            policy = 'lru'
+        return policy
+    
+    def get_cached_queries_to_evict(self, max_indexes_to_cache, keep_id=None):
+        '''
+        Select the screen result CachedQuery entries to evict so that the 
+        well_query_index rows are below max_indexes_to_cache:
+        - entries are ranked by the eviction policy (see 
+        WELL_QUERY_INDEX_EVICTION_POLICY); the entries that do not fit after
+        the higher ranked entries are evicted.
+        @param keep_id the id of a query that should not be evicted (ranked 
+        first)
+        @return list of (id, count) of the entries to evict
+        '''
+        sql = (
+            'select id, count from ( '
+            '  select id, count, sum(coalesce(count,0)) over ( '
+            '    order by (id = %(keep_id)s) desc, {order} '
+            '    rows unbounded preceding) as cumulative_count '
+            '  from cached_query where uri like %(uri)s ) ranked '
+            'where cumulative_count > %(max_count)s '
+            'and id != %(keep_id)s '
+            ).format(order=WELL_QUERY_EVICTION_ORDER[self.get_eviction_policy()])
+        with connection.cursor() as cursor:
+            cursor.execute(sql, { 
+                'keep_id': keep_id or -1, 
+                'uri': '%/screenresult/%',
+                'max_count': max_indexes_to_cache })
+            return cursor.fetchall()
+    
+    def record_eviction(self, evicted, max_indexes_to_cache):
+        evicted_wells = sum(count or 0 for query_id,count in evicted)
+        logger.info('evict cached queries: %d, wells: %d, policy: %r',
+            len(evicted), evicted_wells, self.get_eviction_policy())
+        count_cache_stat('well_query_evictions', len(evicted))
+        _well_query_evictions.append({
+            'datetime': _now(),
+            'policy': self.get_eviction_policy(),
+            'max_indexes_to_cache': max_indexes_to_cache,
+            'evicted_queries': len(evicted),
+            'evicted_wells': evicted_wells,
+            })
+    
+    def get_well_query_index_stats(self):
+        '''
+        Report the well_query_index size, the cached query hit rate, and the
+        recent evictions:
+        - hits, misses, hit_rate: cached query lookups for this server process
+        - stored_hits, stored_hit_rate: for the cached queries stored
+        '''
+        stored = (
+            CachedQuery.objects.filter(uri__contains='/screenresult/')
+                .aggregate(
+                    entries=Count('id'), wells=Sum('count'), 
+                    hits=Sum('hit_count')))
+        entries = stored['entries'] or 0
+        stored_hits = stored['hits'] or 0
+        with connection.cursor() as cursor:
+            cursor.execute(
+                "select pg_total_relation_size('well_query_index')")
+            table_bytes = cursor.fetchone()[0]
+        process_stats = get_cache_stats()
+        hits = process_stats.get('well_query_hits', 0)
+        misses = process_stats.get('well_query_misses', 0)
+        return {
+            'backend': self.get_well_query_backend(),
+            'policy': self.get_eviction_policy(),
+            'max_indexes_to_cache': getattr(
+                settings, 'MAX_WELL_INDEXES_TO_CACHE', 3e+08),
+            'entries': entries,
+            'wells': stored['wells'] or 0,
+            'table_bytes': table_bytes,
+            'hits': hits,
+            'misses': misses,
+            'hit_rate': float(hits)/(hits+misses) if hits+misses else None,
+            'stored_hits': stored_hits,
+            'stored_hit_rate': (
+                float(stored_hits)/(stored_hits+entries) if entries else None),
+            'evictions': process_stats.get('well_query_evictions', 0),
+            'eviction_history': list(reversed(_well_query_evictions)),
+            }
+    
+    @write_authorization
+    def dispatch_cache_stats(self, request, **kwargs):
+        
+        stats = get_cache_stats()
+        stats['well_query_index'] = self.get_well_query_index_stats()
+        return self.build_response(request, stats, **kwargs)
+    
+    def get_well_query_backend(self):
+        backend = getattr(
+            settings, 'WELL_QUERY_INDEX_BACKEND', WELL_QUERY_BACKEND_TABLE)
+        if backend not in [WELL_QUERY_BACKEND_TABLE, WELL_QUERY_BACKEND_CACHE]:
+            logger.warn('unknown WELL_QUERY_INDEX_BACKEND: %r, using %r', 
+                backend, WELL_QUERY_BACKEND_TABLE)
+            backend = WELL_QUERY_BACKEND_TABLE
+        # The cached well sets must be cleared for all server processes when 
+        # a screen result is loaded: a process local screen_cache is not
+        if (backend == WELL_QUERY_BACKEND_CACHE
+                and getattr(settings, 'USE_SHARED_RESULT_CACHE', False) 
+                    is not True):
+            logger.warn(
+                'WELL_QUERY_INDEX_BACKEND %r requires USE_SHARED_RESULT_CACHE,'
+                ' using %r', backend, WELL_QUERY_BACKEND_TABLE)
+            backend = WELL_QUERY_BACKEND_TABLE
+        return backend
+    
+    def create_cached_well_set(self, base_stmt, screen_facility_id):
+        '''
+        Get or create the well_ids selected by the base statement, stored in
+        the screen_cache: alternative to the well_query_index table (see
+        WELL_QUERY_INDEX_BACKEND), the well_ids are stored (in order) as zlib 
+        compressed blocks of WELL_SET_BLOCK_SIZE wells, and no rows are 
+        written to the database.
+        - the "key" entry holds the well count, the "key_<n>" entries hold the
+        blocks (see get_cached_well_set_page)
+        - the "key" entry is tagged with the tables read by the statement, so
+        that writes to these tables evict the well set (see set_tagged)
+        NOTE: requires the shared result cache (see get_well_query_backend), 
+        so that the well sets are evicted for all server processes
+        '''
+        compiled_stmt = str(base_stmt.compile(
+            dialect=postgresql.dialect(),
+            compile_kwargs={"literal_binds": True}))
+        key = 'well_set_%s' % hashlib.md5(compiled_stmt).hexdigest()
+        cache = get_result_cache('screen_cache')
+        count = get_tagged(cache, key)
+        if count is not None:
+            logger.info('using cached well set: %r, %r', 
+                screen_facility_id, key)
+            count_cache_stat('well_query_hits')
+        else:
+            logger.info('create cached well set: %r, %r', 
+                screen_facility_id, key)
+            count_cache_stat('well_query_misses')
+            count = self._cache_well_set(cache, key, base_stmt)
+        return CachedWellSet(key, count, base_stmt)
+    
+    def _cache_well_set(self, cache, key, base_stmt):
+        '''
+        Select the well_ids and store the compressed blocks, then the count
+        @return the well count
+        '''
+        timeout = getattr(settings, 'WELL_SET_CACHE_TIMEOUT', 60*60*4)
+        # Get the tags before reading, so that concurrent writes evict the set
+        tags = get_table_tags(cache, get_statement_tables(base_stmt))
+        stmt = select([literal_column('well_id')]).select_from(
+            base_stmt.alias('base_stmt'))
+        count = 0
+        with get_engine().connect() as conn:
+            result = conn.execute(stmt)
+            while True:
+                rows = result.fetchmany(WELL_SET_BLOCK_SIZE)
+                if not rows:
+                    break
+                cache.set(
+                    '%s_%d' % (key, count//WELL_SET_BLOCK_SIZE),
+                    zlib.compress(
+                        b'\n'.join(row[0].encode('utf-8') for row in rows)),
+                    timeout)
+                count += len(rows)
+        set_tagged(cache, key, count, timeout=timeout, tags=tags)
+        logger.info('cached well set: %r, wells: %d', key, count)
+        return count
+    
+    def get_cached_well_set_page(self, cachedWellSet, limit, offset):
+        '''
+        Return the well_ids of the page of the CachedWellSet: only the blocks
+        spanned by the page are read; if a block has been evicted, the well
+        set is stored again.
+        '''
+        count = cachedWellSet.count
+        end = count
+        if limit > 0:
+            end = min(offset+limit, count)
+        if offset >= end:
+            return []
+        first_block = offset//WELL_SET_BLOCK_SIZE
+        block_keys = [
+            '%s_%d' % (cachedWellSet.key, i) 
+                for i in range(first_block, (end-1)//WELL_SET_BLOCK_SIZE+1)]
+        cache = get_result_cache('screen_cache')
+        blocks = cache.get_many(block_keys)
+        if len(blocks) < len(block_keys):
+            logger.info('cached well set blocks evicted: %r, recreate', 
+                cachedWellSet.key)
+            count_cache_stat('well_query_misses')
+            self._cache_well_set(
+                cache, cachedWellSet.key, cachedWellSet.base_stmt)
+            blocks = cache.get_many(block_keys)
+            if len(blocks) < len(block_keys):
+                raise ProgrammingError(
+                    'cached well set blocks not stored: %r' 
+                    % cachedWellSet.key)
+        well_ids = []
+        for block_key in block_keys:
+            well_ids.extend(zlib.decompress(blocks[block_key]).split(b'\n'))
+        block_offset = first_block*WELL_SET_BLOCK_SIZE
+        return well_ids[offset-block_offset:end-block_offset]
+    
+    def build_well_query_page(self, cachedQuery, limit, offset):
+        '''
+        Build the "wqx" (id, well_id) CTE for a page of the cached query
+        @param cachedQuery a CachedQuery (well_query_index) or a CachedWellSet
+        '''
+        if not isinstance(cachedQuery, CachedWellSet):
+            _wellQueryIndex = self.get_table_def('well_query_index')
+            _wqx = select([column('id'), column('well_id')]).select_from(_wellQueryIndex)
+            _wqx = _wqx.where(_wellQueryIndex.c.query_id == cachedQuery.id)
+            _wqx = _wqx.order_by(_wellQueryIndex.c.id)
+            if limit > 0:    
+                _wqx = _wqx.limit(limit)
+            _wqx = _wqx.offset(offset)
+            return _wqx.cte('wqx')
+        
+        well_ids = self.get_cached_well_set_page(cachedQuery, limit, offset)
+        # Note: pass the page as a PostgreSQL array literal, so that the 
+        # statement may also be compiled with literal binds
+        array_literal = '{%s}' % ','.join(
+            '"%s"' % well_id.replace(b'\\', b'\\\\').replace(b'"', b'\\"') 
+                for well_id in well_ids)
+        _wqx = (
+            select([
+                literal_column('wqx_page.id').label('id'), 
+                literal_column('wqx_page.well_id').label('well_id')])
+            .select_from(
+                text(
+                    'unnest(cast(:well_ids as text[])) '
+                    'with ordinality as wqx_page(well_id, id)')
+                .bindparams(well_ids=array_literal)))
+        return _wqx.cte('wqx')
+    
     @transaction.atomic
     def create_cached_well_query(self, 
         base_stmt, param_hash, screen_facility_id, username):
@@ -4025,7 +4623,9 @@ class ScreenResultResource(DbApiResource):
                     '/screenresult/%s' % screen_facility_id
                 cachedQuery.params = json.dumps(
                     { k:v for k,v in param_hash.items() if k!='schema'})
+                cachedQuery.last_accessed = timezone.now()
                 cachedQuery.save()
+                count_cache_stat('well_query_misses')
 
                 base_stmt = base_stmt.alias('base_stmt')
                 
@@ -4057,9 +4657,14 @@ class ScreenResultResource(DbApiResource):
                     cachedQuery.save()
 
                 # clear out older cached query wells
-                self.clear_cache(None, by_size=True)
+                self.clear_cache(
+                    None, by_size=True, keep_query_id=cachedQuery.id)
             else:
                 logger.info('using cached well_query: %r', cachedQuery)
+                CachedQuery.objects.filter(id=cachedQuery.id).update(
+                    last_accessed=timezone.now(), 
+                    hit_count=F('hit_count')+1)
+                count_cache_stat('well_query_hits')
         logger.info('create_cached_well_query returns: %r', cachedQuery)
         return cachedQuery
         
@@ -4150,7 +4755,6 @@ class ScreenResultResource(DbApiResource):
         _reagent = self.bridge['reagent']
         _library = self.bridge['library']
         excluded_cols_select = self.create_exclusions_cte(screenresult)
-        _wellQueryIndex = self.get_table_def('well_query_index')
                     
         # Strategy: 
         # 1. create the base clause, which will build a stored index in 
@@ -4172,11 +4776,26 @@ class ScreenResultResource(DbApiResource):
         logger.debug('base fields: %r', [
             (fi['key'], fi['scope']) for fi in base_fields])
 
+        # Data columns of this screen result are read from the result_matrix 
+        # row for the assay well; other data columns (e.g. mutual positives 
+        # columns) are read from the result_value table
+        matrix_positions = self.get_result_matrix_positions(screenresult) or {}
+        def is_rv_field(fi):
+            return (fi.get('is_datacolumn', None)
+                and fi.get('data_column_id') not in matrix_positions)
+        def is_matrix_field(fi):
+            return (fi.get('is_datacolumn', None)
+                and fi.get('data_column_id') in matrix_positions)
+        _rm = self.get_table_def('result_matrix')
+        
         # If filtering on result_value columns, the left joins perform better
         if [fi for fi in base_fields 
-                if fi.get('is_datacolumn', None)
-                    and fi['key'] in filter_hash]:
+                if is_rv_field(fi) and fi['key'] in filter_hash]:
             RV_JOIN_TYPE = RV_JOIN_TYPE_LEFT_OUTER
+        # Note: boolean data columns are output as booleans (not as strings) 
+        # when filtering on data columns (as for the left outer join)
+        cast_output_booleans = bool([fi for fi in base_fields 
+            if fi.get('is_datacolumn', None) and fi['key'] in filter_hash])
         
         base_clause = _aw
         base_query_tables = ['assay_well',]
@@ -4245,17 +4864,26 @@ class ScreenResultResource(DbApiResource):
                         literal_column('library_cte.%s' % fi['key'])
         
         # # Include Result Value tables
+        base_matrix_fields = [fi for fi in base_fields if is_matrix_field(fi)]
+        if base_matrix_fields:
+            base_clause = base_clause.join(_rm, 
+                and_(_rm.c.screen_result_id==screenresult.screen_result_id,
+                     _rm.c.well_id==_aw.c.well_id), 
+                isouter=True)
+            for fi in base_matrix_fields:
+                base_custom_columns[fi['key']] = \
+                    self._build_result_matrix_column(
+                        fi, matrix_positions[fi['data_column_id']],
+                        cast_boolean=True)
         if RV_JOIN_TYPE == RV_JOIN_TYPE_NESTED_SELECT:        
             # Using nested selects 
-            for fi in [fi for fi in base_fields 
-                    if fi.get('is_datacolumn', None)]:
+            for fi in [fi for fi in base_fields if is_rv_field(fi)]:
                 rv_select = self._build_result_value_column(fi)
                 base_custom_columns[fi['key']] = rv_select
         elif RV_JOIN_TYPE == RV_JOIN_TYPE_LEFT_OUTER:
             # 20180215
             # For using rv_joins - all rows must be represented      
-            for fi in [fi for fi in base_fields 
-                    if fi.get('is_datacolumn', None)]:
+            for fi in [fi for fi in base_fields if is_rv_field(fi)]:
                 key = fi['key']
                 result_value_alias = _rv.alias('rv_%s' % key)
                 data_column_id = fi['data_column_id']
@@ -4325,8 +4953,12 @@ class ScreenResultResource(DbApiResource):
             self.wrap_statement(base_stmt, order_clauses, filter_expression)
         base_stmt = base_stmt.order_by(asc(column('well_id')))  
         
-        cachedQuery = self.create_cached_well_query(
-            base_stmt, param_hash, screenresult.screen.facility_id, username)            
+        if self.get_well_query_backend() == WELL_QUERY_BACKEND_CACHE:
+            cachedQuery = self.create_cached_well_set(
+                base_stmt, screenresult.screen.facility_id)
+        else:
+            cachedQuery = self.create_cached_well_query(
+                base_stmt, param_hash, screenresult.screen.facility_id, username)            
 
         # Use the cached well_query_index table to build efficient output query
         if DEBUG_SCREENRESULT: 
@@ -4340,13 +4972,7 @@ class ScreenResultResource(DbApiResource):
             'exclude': literal_column('exclusions.exclude')
         }
         # Use the well_query_index well_ids as the central subquery loop
-        _wqx = select([column('id'), column('well_id')]).select_from(_wellQueryIndex)
-        _wqx = _wqx.where(_wellQueryIndex.c.query_id == cachedQuery.id)
-        _wqx = _wqx.order_by(_wellQueryIndex.c.id)
-        if limit > 0:    
-            _wqx = _wqx.limit(limit)
-        _wqx = _wqx.offset(offset)
-        _wqx = _wqx.cte('wqx')
+        _wqx = self.build_well_query_page(cachedQuery, limit, offset)
         # Join to well table first to take advantage of well_id foreign key
         # between well and assay_well
         j = join(_wqx, _w, _wqx.c.well_id == _w.c.well_id)
@@ -4366,18 +4992,28 @@ class ScreenResultResource(DbApiResource):
             # (or create an assay_row table)
             j = j.join(excluded_cols_select, 
                 excluded_cols_select.c.well_id == _aw.c.well_id, isouter=True)
+        matrix_fields = [
+            fi for fi in field_hash.values() if is_matrix_field(fi)]
+        if matrix_fields:
+            # A single (screen_result_id, well_id) index scan for the row
+            j = j.join(_rm, 
+                and_(_rm.c.screen_result_id==screenresult.screen_result_id,
+                     _rm.c.well_id==_aw.c.well_id), 
+                isouter=True)
+            for fi in matrix_fields:
+                custom_columns[fi['key']] = self._build_result_matrix_column(
+                    fi, matrix_positions[fi['data_column_id']],
+                    cast_boolean=cast_output_booleans)
         if RV_JOIN_TYPE == RV_JOIN_TYPE_NESTED_SELECT:        
             # Using nested selects
             for fi in [
-                fi for fi in field_hash.values() 
-                    if fi.get('is_datacolumn', None)]:
+                fi for fi in field_hash.values() if is_rv_field(fi)]:
                 logger.debug('building rv column: %r', fi['key'])
                 custom_columns[fi['key']] = self._build_result_value_column(fi)
         elif RV_JOIN_TYPE == RV_JOIN_TYPE_LEFT_OUTER:
             # 20180215
             # Using joins - left join rqd      
-            for fi in [fi for fi in field_hash.values() 
-                    if fi.get('is_datacolumn', None)]:
+            for fi in [fi for fi in field_hash.values() if is_rv_field(fi)]:
                 key = fi['key']
                 result_value_alias = _rv.alias('rv_%s' % key)
                 data_column_id = fi['data_column_id']
@@ -4595,23 +5231,37 @@ class ScreenResultResource(DbApiResource):
             if rowproxy_generator:
                 result = rowproxy_generator(result)
 
+            meta = {
+                'limit': limit,
+                'offset': offset,
+                'screen_facility_id': screen_facility_id,
+                'total_count': cachedQuery.count,
+            }    
+            if content_type == JSON_COLUMNAR_MIMETYPE:
+                data = cursor_generator(
+                    result,ordered_keys,list_fields=list_fields,
+                    value_templates=value_templates, as_tuples=True)
+                data = closing_iterator_wrapper(data, conn.close)
+                data = image_tuple_generator(
+                    data, ordered_keys, image_keys, request)
+                response = StreamingHttpResponse(
+                    ChunkIterWrapper(
+                        json_columnar_generator(data, meta, ordered_keys)))
+                response['Content-Type'] = content_type
+                return response
+            
             data = cursor_generator(
                 result,ordered_keys,list_fields=list_fields,
                 value_templates=value_templates)
             data = closing_iterator_wrapper(data, conn.close)
             if content_type == JSON_MIMETYPE:
-                meta = {
-                    'limit': limit,
-                    'offset': offset,
-                    'screen_facility_id': screen_facility_id,
-                    'total_count': cachedQuery.count,
-                }    
                 # Note: is_excluded generator not needed for JSON - already
                 # part of the query, and no need to convert to col letters
                 data = image_generator(data, image_keys, request) 
                 response = StreamingHttpResponse(
                     ChunkIterWrapper(
-                        json_generator(data, meta, is_for_detail=is_for_detail)))
+                        json_generator(data, meta, is_for_detail=is_for_detail,
+                            pretty=param_hash.get(HTTP_PARAM_PRETTY_JSON, False))))
                 response['Content-Type'] = content_type
                 return response
             elif(content_type == XLS_MIMETYPE or
@@ -4653,7 +5303,7 @@ class ScreenResultResource(DbApiResource):
     def get_mutual_positives_columns(self, screen_result_id):
         logger.info('get_mutual_positives_columns...')
         cache_key = '%s_mutual_positive_columns' % screen_result_id
-        cached_ids = self.get_cache().get(cache_key)
+        cached_ids = get_tagged(self.get_cache(), cache_key)
         
         if not cached_ids:
         
@@ -4736,7 +5386,7 @@ class ScreenResultResource(DbApiResource):
                 result = conn.execute(stmt)
                 cached_ids =  [x[0] for x in result ]
                 logger.info('done, cols %r', cached_ids)
-                self.get_cache().set(cache_key, cached_ids)
+                set_tagged(self.get_cache(), cache_key, cached_ids)
         else:
             logger.info('using cached mutual positive columns')
         return cached_ids
@@ -4797,7 +5447,7 @@ class ScreenResultResource(DbApiResource):
         m.update(cache_key)
         digested_cache_key = m.hexdigest()
         
-        data = self.get_cache().get(digested_cache_key)
+        data = get_tagged(self.get_cache(), digested_cache_key)
         
         def add_well_fields(current_fields):
             well_schema = \
@@ -4957,7 +5607,7 @@ class ScreenResultResource(DbApiResource):
                 
             if DEBUG_SCREENRESULT: 
                 logger.info('build screenresult schema done')
-            self.get_cache().set(digested_cache_key, data)
+            set_tagged(self.get_cache(), digested_cache_key, data)
             
         return data
 
@@ -5010,11 +5660,21 @@ class ScreenResultResource(DbApiResource):
             screen_result = screen.screenresult
             logger.info('screen result: %r exists, deleting extant data',
                 screen_result)
+            if self.is_result_value_partitioned():
+                self.drop_result_partitions(screen_result.screen_result_id)
             screen_result.datacolumn_set.all().delete()
             screen_result.assaywell_set.all().delete()
             screen_result.screen.assayplate_set\
                 .filter(library_screening__isnull=True).delete()
+            with connection.cursor() as cursor:
+                cursor.execute(
+                    'DELETE FROM result_matrix WHERE screen_result_id = %s; '
+                    'DELETE FROM result_matrix_layout '
+                    'WHERE screen_result_id = %s; ', 
+                    [screen_result.screen_result_id]*2)
             screen.screenresult.delete()
+            self.update_well_data_column_positive_index(screen.screen_id)
+            self.update_screen_overlap(screen.screen_id)
             logger.info('screen_result deleted')
             screen_log = self.make_log(request, **kwargs)
             screen_log.ref_resource_name = 'screen'
@@ -5102,8 +5762,12 @@ class ScreenResultResource(DbApiResource):
                 screen_result = screen.screenresult
                 logger.info('screen result: %r exists, deleting extant data',
                     screen_result)
-                screen_result.datacolumn_set.all().delete()
-                screen_result.assaywell_set.all().delete()
+                if self.is_result_value_partitioned():
+                    # Note: extant data are replaced in swap_result_partitions
+                    logger.info('replace the partitions after the load')
+                else:
+                    screen_result.datacolumn_set.all().delete()
+                    screen_result.assaywell_set.all().delete()
                 screen_result.screen.assayplate_set\
                     .filter(library_screening__isnull=True).delete()
                 screen_log.diffs = { 
@@ -5197,12 +5861,14 @@ class ScreenResultResource(DbApiResource):
             except ValidationError, e:
                 logger.exception('Validation error: %r', e)
                 raise e
+            
+            self.update_well_data_column_positive_index(screen.screen_id)
+            self.update_screen_overlap(screen.screen_id)
             # END of Transaction
             
-        self.create_data_loading_statistics(screen_result)
-    
-        # Create indexes
-        self.get_create_screen_overlap_indexes()
+        self.create_data_loading_statistics(
+            screen_result, result_meta['experimental_well_count'],
+            sheet_col_to_datacolumn.values())
         
         screenresult_log.diffs.update({ 
             'created_by': [None,adminuser.username],  
@@ -5344,7 +6010,90 @@ class ScreenResultResource(DbApiResource):
             logger.info('rv_initializer: %r', rv_initializer)
         return rv_initializer
     
-    @transaction.atomic
+    def is_result_value_partitioned(self):
+        '''
+        True if the result_value and assay_well tables are partitioned by 
+        screen result (see db/migrations/manual/result_value_partition.sql)
+        '''
+        with connection.cursor() as cursor:
+            cursor.execute(
+                "select count(*) from pg_class "
+                "where relname in ('result_value', 'assay_well') "
+                "and relkind = 'p' ")
+            return cursor.fetchone()[0] == 2
+    
+    @staticmethod
+    def get_result_partition_names(screen_result_id):
+        return (
+            'result_value_sr_%d' % screen_result_id, 
+            'assay_well_sr_%d' % screen_result_id)
+    
+    def create_result_load_tables(self, cursor, screen_result_id, data_column_ids):
+        '''
+        Create the tables to load the screen result into, for 
+        swap_result_partitions:
+        - the CHECK constraints match the partition bounds, so that the tables
+        are not scanned again when attached.
+        @return (result_value table name, assay_well table name)
+        '''
+        (rv_partition, aw_partition) = \
+            self.get_result_partition_names(screen_result_id)
+        rv_table = '%s_load' % rv_partition
+        aw_table = '%s_load' % aw_partition
+        cursor.execute(
+            'DROP TABLE IF EXISTS {rv_table}, {aw_table}; '
+            'CREATE TABLE {rv_table} (LIKE result_value INCLUDING DEFAULTS); '
+            'ALTER TABLE {rv_table} ADD CONSTRAINT {rv_table}_bounds '
+            '  CHECK (data_column_id IS NOT NULL '
+            '    AND data_column_id IN ({data_column_ids})); '
+            'CREATE TABLE {aw_table} (LIKE assay_well INCLUDING DEFAULTS); '
+            'ALTER TABLE {aw_table} ADD CONSTRAINT {aw_table}_bounds '
+            '  CHECK (screen_result_id IS NOT NULL '
+            '    AND screen_result_id = {screen_result_id}); '
+            .format(
+                rv_table=rv_table, aw_table=aw_table, 
+                screen_result_id=int(screen_result_id),
+                data_column_ids=','.join(
+                    str(int(x)) for x in data_column_ids)))
+        return (rv_table, aw_table)
+    
+    def swap_result_partitions(self, cursor, screen_result_id, data_column_ids):
+        '''
+        Replace the result_value and assay_well partitions of the screen 
+        result with the tables loaded (see create_result_load_tables).
+        Note: dropping a partition locks the partitioned table until the end of
+        the transaction; the swap is done after the load.
+        '''
+        (rv_partition, aw_partition) = \
+            self.get_result_partition_names(screen_result_id)
+        logger.info('swap in the result partitions: %r, %r', 
+            rv_partition, aw_partition)
+        cursor.execute(
+            'DROP TABLE IF EXISTS {rv}, {aw}; '
+            'ALTER TABLE {rv}_load RENAME TO {rv}; '
+            'ALTER TABLE {aw}_load RENAME TO {aw}; '
+            'ALTER TABLE result_value ATTACH PARTITION {rv} '
+            '  FOR VALUES IN ({data_column_ids}); '
+            'ALTER TABLE assay_well ATTACH PARTITION {aw} '
+            '  FOR VALUES IN ({screen_result_id}); '
+            'ALTER TABLE {rv} DROP CONSTRAINT {rv}_load_bounds; '
+            'ALTER TABLE {aw} DROP CONSTRAINT {aw}_load_bounds; '
+            .format(
+                rv=rv_partition, aw=aw_partition,
+                screen_result_id=int(screen_result_id),
+                data_column_ids=','.join(
+                    str(int(x)) for x in data_column_ids)))
+    
+    def drop_result_partitions(self, screen_result_id):
+        '''
+        Delete the result_values and assay_wells of the screen result by 
+        dropping the partitions
+        '''
+        with connection.cursor() as cursor:
+            cursor.execute(
+                'DROP TABLE IF EXISTS {}, {}'.format(
+                    *self.get_result_partition_names(screen_result_id)))
+    
     def create_result_values(
             self, screen_result, result_values, sheet_col_to_datacolumn,
             screenresult_log):
@@ -5363,31 +6112,40 @@ class ScreenResultResource(DbApiResource):
         meta_columns = ['well_id', 'assay_well_control_type', 'exclude']
         meta = {}
         
-        with SpooledTemporaryFile(max_size=MAX_SPOOLFILE_SIZE) as result_value_file,\
-            SpooledTemporaryFile(max_size=MAX_SPOOLFILE_SIZE) as assay_well_file:
+        # Pipelined load: the result values are parsed and validated in a 
+        # producer thread (see copy_from_generator), and streamed to the 
+        # "COPY result_value" while the database loads the previous rows; 
+        # the assay_wells are written to a temp file, and copied after.
+        # Note: the wells and the screen are fetched before, on this thread's
+        # connection (the producer thread has a separate connection).
+        # Note: the data loading statistics are also accumulated here, (see
+        # create_data_loading_statistics) so that the loaded data are not 
+        # scanned again.
+        counts = { 
+            'rows_created': 0, 'rvs_to_create': 0, 'experimental_wells': 0,
+            'missing_wells': 0 }
+        errors = {}
+        # Only the first MAX_MISSING_WELLS_TO_REPORT wells not found are kept
+        missing_wells = []
         
+        def generate_result_value_rows(assay_well_file):
+            row_buffer = io.BytesIO()
             writer = unicodecsv.DictWriter(
-                result_value_file, fieldnames=fieldnames, delimiter=str(','),
+                row_buffer, fieldnames=fieldnames, delimiter=str(','),
                 lineterminator="\n")
             assay_well_writer = unicodecsv.DictWriter(
                 assay_well_file, fieldnames=assay_well_fieldnames, 
                 delimiter=str(','), lineterminator="\n")
             
-            rows_created = 0
-            rvs_to_create = 0
-            logger.info('write temp file result values for screen: %r ...',
-                screen_result.screen.facility_id)
-            errors = {}
+            logger.info('parse result values for screen: %r ...', facility_id)
+            # Note: iterating triggers parsing (see ResultValueParser)
+            # Note: for testing, or if data are posted using JSON, and
+            # not as the Screen Result Load file format, result values
+            # may be a list
+            _result_values = iter(result_values)
             while True:
                 try: 
-                    # Note: iterating triggers parsing using the generator
-                    # Note: for testing, or if data are posted using JSON, and
-                    # not as the Screen Result Load file format, result values
-                    # may be a list
-                    if isinstance(result_values, (list, tuple)):
-                        result_values = iter(result_values)
-                    
-                    result_row = result_values.next()
+                    result_row = _result_values.next()
                     initializer_dict = { 
                         fieldname:PSYCOPG_NULL for fieldname in fieldnames}
                     assay_well_initializer = { 
@@ -5396,12 +6154,13 @@ class ScreenResultResource(DbApiResource):
                     for meta_field in meta_columns:
                         if meta_field in result_row:
                             initializer_dict[meta_field] = result_row[meta_field]
-                    try:
-                        well = Well.objects.get(well_id=result_row['well_id']) 
-                    except ObjectDoesNotExist, e:
+                    well = well_map.get(result_row['well_id'])
+                    if well is None:
                         logger.info('well not found: %r', result_row['well_id'])
-                        raise ValidationError(
-                            key='well_id', msg='well not found: %r' % result_row['well_id'])
+                        counts['missing_wells'] += 1
+                        if len(missing_wells) < MAX_MISSING_WELLS_TO_REPORT:
+                            missing_wells.append(result_row['well_id'])
+                        continue
                     assay_well_initializer.update({
                         'screen_result_id': screen_result.screen_result_id,
                         'well_id': well.well_id,
@@ -5412,7 +6171,7 @@ class ScreenResultResource(DbApiResource):
                     if assay_well_control_type:
                         allowed_control_well_types = [
                             WELL_TYPE.EMPTY, WELL_TYPE.DMSO, WELL_TYPE.LIBRARY_CONTROL]
-                        if screen_result.screen.screen_type == SCREEN_TYPE.RNAI:
+                        if screen_type == SCREEN_TYPE.RNAI:
                             allowed_control_well_types.append(WELL_TYPE.RNAI_BUFFER)
                         if well.library_well_type in allowed_control_well_types:
                             assay_well_initializer['assay_well_control_type'] = \
@@ -5455,61 +6214,143 @@ class ScreenResultResource(DbApiResource):
                             #         well.well_id, well.library_well_type, rv_initializer) 
                             
                             writer.writerow(rv_initializer)
-                            rvs_to_create += 1
+                            counts['rvs_to_create'] += 1
                         except ValidationError,e1:
                             errors.update(e1.errors)
                         
                     assay_well_writer.writerow(assay_well_initializer)
-                    rows_created += 1
-                    if rows_created % 10000 == 0:
+                    counts['rows_created'] += 1
+                    if well.library_well_type == WELL_TYPE.EXPERIMENTAL:
+                        counts['experimental_wells'] += 1
+                    if counts['rows_created'] % 10000 == 0:
                         logger.info(
-                            'wrote %d result rows to temp file', rows_created)
+                            'parsed %d result rows', counts['rows_created'])
 
                 except ValidationError, e:
                     logger.exception('validation error: %r; errors: %r', e, errors)
                     errors.update(e.errors) 
                 except StopIteration, e:
                     break
-            
-            if errors:
-                logger.warn('errors: %r', errors)
-                raise ValidationError(errors=errors)
-            
-            if not rvs_to_create:
-                raise ValidationError( errors={ 
-                    'result_values': 'no result values were parsed' })
-
-            logger.info('result_values: rows: %d, result_values to create: %d',
-                rows_created, rvs_to_create)
-            meta['assay_wells'] = rows_created
-            meta['result_values'] = rvs_to_create
-            
-            logger.info(
-                'use copy_from to create %d assay_wells...', rows_created)
-            assay_well_file.seek(0)
-            
+                
+                if row_buffer.tell():
+                    # Once errors are found the load will be rolled back:
+                    # continue parsing to report all errors, but stop copying
+                    if not errors and not missing_wells:
+                        yield row_buffer.getvalue()
+                    row_buffer.seek(0)
+                    row_buffer.truncate()
+        
+        facility_id = screen_result.screen.facility_id
+        screen_type = screen_result.screen.screen_type
+        if isinstance(
+                result_values, screen_result_importer.ResultValueParser):
+            plate_numbers = result_values.get_plate_numbers()
+        else:
+            result_values = list(result_values)
+            plate_numbers = set()
+            for result_value in result_values:
+                match = WELL_ID_PATTERN.match(result_value.get('well_id') or '')
+                if match:
+                    plate_numbers.add(int(match.group(1)))
+        well_map = ResultWellMap()
+        with connection.cursor() as cursor:
+            well_map.fetch(cursor, screen_type, plate_numbers)
+        
+        # If the tables are partitioned, load into new tables, and swap these
+        # in for the extant partitions of the screen result
+        partitioned = self.is_result_value_partitioned()
+        data_column_ids = [
+            dc.data_column_id for dc in sheet_col_to_datacolumn.values()]
+        
+        with SpooledTemporaryFile(max_size=MAX_SPOOLFILE_SIZE) as assay_well_file:
+            
+            start_time = time.time()
+            start_peak_memory = \
+                resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
             with connection.cursor() as conn:
+                rv_table, aw_table = 'result_value', 'assay_well'
+                if partitioned:
+                    rv_table, aw_table = self.create_result_load_tables(
+                        conn, screen_result.screen_result_id, data_column_ids)
+                copy_command = \
+                    '''COPY {} ({}) FROM STDIN 
+                       WITH (FORMAT CSV, NULL "{}", DELIMITER '{}', QUOTE '{}' )'''.format(
+                         rv_table, ','.join(fieldnames), PSYCOPG_NULL, ',', '"')
+                # USE copy_expert so that delimiter, quoting can be defined
+                logger.info('use copy_from to create result_values...')
+                # Note: the parse process pool is created on this thread, and
+                # is closed when the rows have been parsed, or on error
+                is_parser = isinstance(
+                    result_values, screen_result_importer.ResultValueParser)
+                try:
+                    if is_parser:
+                        result_values.open()
+                    copy_from_generator(
+                        conn, copy_command, 
+                        generate_result_value_rows(assay_well_file))
+                finally:
+                    if is_parser:
+                        result_values.close()
+                
+                rows_created = counts['rows_created']
+                rvs_to_create = counts['rvs_to_create']
+                if missing_wells:
+                    msg = 'wells not found (%d): %s' % (
+                        counts['missing_wells'], ', '.join(missing_wells))
+                    if counts['missing_wells'] > len(missing_wells):
+                        msg += ', ... (first %d shown)' % len(missing_wells)
+                    errors['well_id'] = msg
+                if errors:
+                    logger.warn('errors: %r', errors)
+                    raise ValidationError(errors=errors)
+                
+                if not rvs_to_create:
+                    raise ValidationError( errors={ 
+                        'result_values': 'no result values were parsed' })
+    
+                logger.info('result_values created: %d', rvs_to_create)
+                meta['assay_wells'] = rows_created
+                meta['result_values'] = rvs_to_create
+                meta['experimental_well_count'] = counts['experimental_wells']
+            
+                logger.info(
+                    'use copy_from to create %d assay_wells...', rows_created)
+                assay_well_file.seek(0)
                 conn.copy_from(
-                    assay_well_file, 'assay_well', sep=str(','), 
+                    assay_well_file, aw_table, sep=str(','), 
                     columns=assay_well_fieldnames, null=PSYCOPG_NULL)
                 logger.info('assay_wells created.')
                 
-                # USE copy_expert so that delimiter, quoting can be defined
-                logger.info(
-                    'use copy_from to create %d result_values...', rvs_to_create)
-                result_value_file.seek(0)
-                copy_command = \
-                    '''COPY result_value ({}) FROM STDIN 
-                       WITH (FORMAT CSV, NULL "{}", DELIMITER '{}', QUOTE '{}' )'''.format(
-                         ','.join(fieldnames), PSYCOPG_NULL, ',', '"')
-                conn.copy_expert(copy_command, result_value_file)
-                logger.info('result_values created.')
+                if partitioned:
+                    self.swap_result_partitions(
+                        conn, screen_result.screen_result_id, data_column_ids)
+                    # the data columns replaced: result values have been 
+                    # dropped with the partition
+                    screen_result.datacolumn_set\
+                        .exclude(data_column_id__in=data_column_ids).delete()
+            
+            load_time = max(time.time() - start_time, 0.001)
+            # Note: ru_maxrss is the peak resident set size (KB) over the 
+            # process lifetime: report the increase of the peak during the 
+            # load (0 if the load stayed below an earlier peak)
+            peak_memory_increase = (
+                resource.getrusage(resource.RUSAGE_SELF).ru_maxrss 
+                - start_peak_memory)
+            logger.info(
+                'result values loaded: %d, time: %0.2f s, rows/s: %d, '
+                'process peak memory increase: %d KB', rvs_to_create, 
+                load_time, rvs_to_create/load_time, peak_memory_increase)
             screenresult_log.diffs.update({
                 'result_values_created': [None,rvs_to_create],
-                'assay_wells_loaded': [None, rows_created]
+                'assay_wells_loaded': [None, rows_created],
+                'load_result_values_per_second': [
+                    None, int(rvs_to_create/load_time)],
+                'load_peak_memory_increase_kb': [None, peak_memory_increase],
                 })
         for dc in sheet_col_to_datacolumn.values():
             dc.save()
+        
+        self.create_result_matrix(screen_result)
             
         # 20170424 - remove replicate tracking for data load - per JAS
         # if plates_max_replicate_loaded:
@@ -5605,51 +6446,23 @@ class ScreenResultResource(DbApiResource):
         
 
     @transaction.atomic
-    def create_data_loading_statistics(self, screen_result):
-        with get_engine().connect() as conn:
-            # NOTE: mixing Django connection with SQA connection
-            # - thrown exceptions will rollback the nested SQA transaction
-            # see: http://docs.sqlalchemy.org/en/latest/core/connections.html
-            screen_facility_id = screen_result.screen.facility_id
-            sql_experimental_wells_loaded = (
-                'select count(*) '
-                'from screen s '
-                'join screen_result sr using(screen_id) '
-                'join assay_well aw using(screen_result_id) '
-                'join well w using(well_id) '
-                'where w.library_well_type = %s '
-                'and s.facility_id = %s; ')
-            screen_result.experimental_well_count = int(
-                conn.execute(
-                    sql_experimental_wells_loaded,
-                    (WELL_TYPE.EXPERIMENTAL, screen_facility_id))
-                .scalar() or 0)
-            
-            sql_replicate_count = (
-                 'select max(replicate_ordinal) '
-                 'from data_column ' 
-                 'join screen_result using(screen_result_id) ' 
-                 'join screen using (screen_id) '
-                 'where facility_id = %s;')
-            screen_result.replicate_count = int(
-                conn.execute(
-                    sql_replicate_count, screen_facility_id)
-                .scalar() or 0)
-            if screen_result.replicate_count == 0:
-                screen_result.replicate_count = 1
-                
-            sql_channel_count = (
-                 'select max(channel) '
-                 'from data_column ' 
-                 'join screen_result using(screen_result_id) ' 
-                 'join screen using (screen_id) '
-                 'where facility_id = %s;')
-            screen_result.channel_count = int(
-                conn.execute(
-                    sql_channel_count, screen_facility_id)
-                .scalar() or 0)
-            if screen_result.channel_count == 0:
-                screen_result.channels_count = 1
+    def create_data_loading_statistics(
+            self, screen_result, experimental_well_count, data_columns):
+        '''
+        Store the data loading statistics, as accumulated by 
+        create_result_values, in one update of the screen_result:
+        - experimental_well_count: assay_wells loaded for experimental wells
+        - replicate_count, channel_count: from the loaded data_columns
+        (the data_column positives counts are accumulated in 
+        create_result_value).
+        '''
+        screen_result.experimental_well_count = experimental_well_count
+        screen_result.replicate_count = max(
+            [dc.replicate_ordinal or 0 for dc in data_columns] or [0])
+        if screen_result.replicate_count == 0:
+            screen_result.replicate_count = 1
+        screen_result.channel_count = max(
+            [dc.channel or 0 for dc in data_columns] or [0])
         screen_result.date_loaded = _now().date()
         screen_result.save()
             
@@ -16674,7 +17487,7 @@ class ScreenResource(DbApiResource):
     def clear_cache(self, request, **kwargs):
         logger.info('clear screen caches')
         DbApiResource.clear_cache(self, request, **kwargs)
-        caches['screen_cache'].clear()
+        get_result_cache('screen_cache').clear()
         self.get_screenresult_resource().clear_cache(request, **kwargs)
         
     def get_su_resource(self):
@@ -16877,8 +17690,8 @@ class ScreenResource(DbApiResource):
             return self.dispatch('detail', request, **kwargs)
         
         cache_key = 'detail_ui_%s_%s' % (facility_id, request.user.username) 
-        screen_cache = caches['screen_cache']
-        _data = screen_cache.get(cache_key)
+        screen_cache = get_result_cache('screen_cache')
+        _data = get_tagged(screen_cache, cache_key)
         
         if not _data:
             logger.debug('cache key not set: %s', cache_key)
@@ -16922,7 +17735,7 @@ class ScreenResource(DbApiResource):
                     
                     # TODO: attached files
                     # TODO: publications
-                    screen_cache.set(cache_key, _data)
+                    set_tagged(screen_cache, cache_key, _data)
                 else:
                     # do not cache if restricted
                     _data['is_restricted_view'] = True
@@ -20766,6 +21579,9 @@ class ReagentResource(DbApiResource):
         authorization = ReagentResourceAuthorization(resource_name)
         serializer = LimsSerializer()
         
+    # The Reagent subclass model created by _patch_wells
+    reagent_model = None
+    
     def __init__(self, **kwargs):
 
         self.library_resource = None
@@ -20775,6 +21591,10 @@ class ReagentResource(DbApiResource):
         self.data_column_resource = None
         self.study_resource = None
         super(ReagentResource, self).__init__(**kwargs)
+        # for debugging
+        self.patch_elapsedtime1 = 0
+        self.patch_elapsedtime2 = 0
+        self.patch_elapsedtime3 = 0
     
     def prepend_urls(self):
         
@@ -20837,28 +21657,162 @@ class ReagentResource(DbApiResource):
             self.npr_resource = NaturalProductReagentResource()
         return self.npr_resource
     
-    def get_datacolumn_resource(self):
-        if self.data_column_resource is None:
-            self.data_column_resource = DataColumnResource()
-        return self.data_column_resource
-    
-    def get_library_resource(self):
-        if not self.library_resource:
-            self.library_resource = LibraryResource()
-        return self.library_resource
-    
-    def get_study_resource(self):
-        if not self.study_resource:
-            self.study_resource = StudyResource()
-        return self.study_resource 
+    @staticmethod
+    def _get_value_fields(model):
+        ''' The (non-key, non-relation) columns of the model table '''
+        return [field for field in model._meta.local_concrete_fields 
+            if not field.primary_key and not field.is_relation]
     
-    def get_schema(self, request, **kwargs):
-        param_hash = self._convert_request_to_dict(request)
-        param_hash.update(kwargs)
+    def _patch_wells(self, request, deserialized):
+        ''' 
+        Internal bulk update: 
+        - the deserialized array has been loaded with the wells
+        - the reagents are parsed and validated, then the valid reagents are 
+        created and updated using COPY and set based statements 
+        (see db.support.bulk_load); reagent values that are not changed are 
+        not written
+        - the related values are set in _bulk_set_related_values
+        NOTE: patching will only be done in batch, from library/well
+        '''
+        logger.info('patch (%d) reagents for %s ...', 
+            len(deserialized), self._meta.resource_name)
+        start_time = time.time()
         
-        extra_dc_ids = param_hash.get(API_PARAM_DC_IDS, None)
-
-        if not 'library_short_name' in kwargs:
+        schema = self.build_schema(request.user)
+        fields = schema['fields']
+        cumulative_error = CumulativeError()
+        
+        # Find the extant reagents: 
+        # TODO: only works for a single reagent per well
+        library_ids = set(
+            well_data['well'].library_id for well_data in deserialized)
+        reagent_ids = {}
+        for well_id, reagent_id in (Reagent.objects
+                .filter(well__library_id__in=library_ids)
+                .order_by('-reagent_id')
+                .values_list('well_id', 'reagent_id')):
+            reagent_ids[well_id] = reagent_id
+        
+        new_reagents = []
+        patched_reagents = []
+        for i, well_data in enumerate(deserialized):
+            well = well_data['well']
+            reagent_id = reagent_ids.get(well.well_id, None)
+            is_patch = reagent_id is not None
+            try:
+                initializer_dict = self.parse(
+                    well_data, create=not is_patch, fields=fields)
+                errors = self.validate(
+                    initializer_dict, patch=is_patch, fields=fields)
+                if errors:
+                    raise ValidationError(errors)
+            except ValidationError, e:
+                cumulative_error.add_error(well.well_id, e.errors, 
+                    line=well_data.get(INPUT_FILE_DESERIALIZE_LINE_NUMBER_KEY, i))
+                continue
+            initializer_dict['content_digest'] = \
+                well_data.get(REAGENT_CONTENT_DIGEST_KEY, None)
+            if is_patch:
+                patched_reagents.append(
+                    (reagent_id, initializer_dict, well_data))
+            else:
+                new_reagents.append((initializer_dict, well_data))
+        
+        self.patch_elapsedtime1 += (time.time() - start_time)
+        start_time = time.time()
+        
+        def get_value(field, initializer_dict):
+            if field.name in initializer_dict:
+                return initializer_dict[field.name]
+            return field.get_default()
+        
+        reagent_fields = self._get_value_fields(Reagent)
+        subclass_fields = self._get_value_fields(self.reagent_model)
+        with connection.cursor() as cursor:
+            
+            new_reagents = [
+                (reagent_id, initializer_dict, well_data) 
+                for reagent_id, (initializer_dict, well_data) in zip(
+                    bulk_load.reserve_ids(
+                        cursor, Reagent._meta.db_table, 'reagent_id', 
+                        len(new_reagents)),
+                    new_reagents)]
+            bulk_load.copy_rows(
+                cursor, Reagent._meta.db_table, 
+                ['reagent_id', 'well_id'] + [f.column for f in reagent_fields],
+                ([reagent_id, well_data['well'].well_id] 
+                    + [get_value(f, initializer_dict) for f in reagent_fields]
+                    for reagent_id, initializer_dict, well_data 
+                        in new_reagents))
+            bulk_load.copy_rows(
+                cursor, self.reagent_model._meta.db_table, 
+                ['reagent_id'] + [f.column for f in subclass_fields],
+                ([reagent_id] 
+                    + [get_value(f, initializer_dict) for f in subclass_fields]
+                    for reagent_id, initializer_dict, well_data 
+                        in new_reagents))
+            
+            # Update the patched reagents for the fields given:
+            # group by the fields given, usually the same for all rows
+            for model, model_fields in [
+                    (Reagent, reagent_fields), 
+                    (self.reagent_model, subclass_fields)]:
+                updates = defaultdict(list)
+                for reagent_id, initializer_dict, well_data in patched_reagents:
+                    patch_fields = tuple(f for f in model_fields 
+                        if f.name in initializer_dict)
+                    updates[patch_fields].append([reagent_id] + [
+                        initializer_dict[f.name] for f in patch_fields])
+                for patch_fields, rows in updates.items():
+                    bulk_load.update_rows(
+                        cursor, model._meta.db_table, 'reagent_id', 
+                        [f.column for f in patch_fields], rows)
+            
+            self.patch_elapsedtime2 += (time.time() - start_time)
+            start_time = time.time()
+            
+            self._bulk_set_related_values(
+                cursor, new_reagents, patched_reagents)
+            
+            self.patch_elapsedtime3 += (time.time() - start_time)
+
+        logger.info('patched %d reagents, created: %d', 
+            len(deserialized), len(new_reagents))
+        # Note: valid reagents are written; errors are reported for the rest
+        if cumulative_error.errors:
+            raise cumulative_error
+        return {}
+    
+    def _bulk_set_related_values(self, cursor, new_reagents, patched_reagents):
+        '''
+        Set the values stored in related tables, for _patch_wells
+        @param new_reagents, patched_reagents 
+            [(reagent_id, initializer_dict, well_data)]
+        '''
+        pass
+    
+    def get_datacolumn_resource(self):
+        if self.data_column_resource is None:
+            self.data_column_resource = DataColumnResource()
+        return self.data_column_resource
+    
+    def get_library_resource(self):
+        if not self.library_resource:
+            self.library_resource = LibraryResource()
+        return self.library_resource
+    
+    def get_study_resource(self):
+        if not self.study_resource:
+            self.study_resource = StudyResource()
+        return self.study_resource 
+    
+    def get_schema(self, request, **kwargs):
+        param_hash = self._convert_request_to_dict(request)
+        param_hash.update(kwargs)
+        
+        extra_dc_ids = param_hash.get(API_PARAM_DC_IDS, None)
+
+        if not 'library_short_name' in kwargs:
             return self.build_response(
                 request, 
                 self.build_schema(
@@ -21855,6 +22809,12 @@ class ReagentResource(DbApiResource):
 
         # is_released is required for the authorization filter
         columns['is_released'] = _library.c.is_released
+        # order the vendor and compound name search matches by rank
+        is_ranked_search = (
+            well_base_query is not None 
+                and 'search_rank' in well_base_query.c)
+        if is_ranked_search:
+            columns['search_rank'] = well_base_query.c.search_rank
         
         stmt = select(columns.values()).select_from(j)
         if well_ids is not None:
@@ -21877,7 +22837,10 @@ class ReagentResource(DbApiResource):
         (stmt, count_stmt) = self.wrap_statement(
             stmt, order_clauses, filter_expression)
         if not order_clauses:
-            stmt = stmt.order_by("plate_number", "well_name")
+            if is_ranked_search:
+                stmt = stmt.order_by("search_rank", "plate_number", "well_name")
+            else:
+                stmt = stmt.order_by("plate_number", "well_name")
 
         # compiled_stmt = str(stmt.compile(
         #     dialect=postgresql.dialect(),
@@ -21919,8 +22882,25 @@ class ReagentResource(DbApiResource):
         if well_search_data is not None:
             logger.debug('well_search_data: %r', well_search_data)
             if param_hash.pop('vendor_and_compound_search', False) is True:
+                search_limit = int(
+                    getattr(settings, 'COMPOUND_SEARCH_LIMIT', 1000))
+                requested_limit = parse_val(
+                    param_hash.pop(API_PARAM_SEARCH_LIMIT, None),
+                    API_PARAM_SEARCH_LIMIT, 'integer')
+                if requested_limit:
+                    search_limit = min(requested_limit, search_limit) \
+                        if search_limit else requested_limit
+                search_mode = param_hash.pop(API_PARAM_SEARCH_MODE, None)
+                if (search_mode == COMPOUND_SEARCH_FUZZY 
+                        and not WellResource.is_pg_trgm_installed()):
+                    raise ValidationError(
+                        key=API_PARAM_SEARCH_MODE,
+                        msg='%s: requires the pg_trgm database extension' 
+                            % search_mode)
                 well_base_query = \
-                    WellResource.create_vendor_compound_name_base_query(well_search_data)
+                    WellResource.create_vendor_compound_name_base_query(
+                        well_search_data, search_mode=search_mode,
+                        limit=search_limit)
             else:
                 parsed_searches = WellResource.parse_well_search(well_search_data)
                 well_base_query = WellResource.create_well_base_query(parsed_searches)
@@ -22078,6 +23058,8 @@ class ReagentResource(DbApiResource):
 
 class SilencingReagentResource(ReagentResource):
     
+    reagent_model = SilencingReagent
+    
     class Meta:
     
         queryset = Reagent.objects.all()
@@ -22356,93 +23338,74 @@ class SilencingReagentResource(ReagentResource):
         raise ApiNotImplemented(self._meta.resource_name, 'patch_obj')
         # NOTE: patching will only be done in batch, from library/well
  
-    def _patch_wells(self, request, deserialized):
-        ''' Internal for bulk updates: 
-        - the deserialized array has been loaded with the well & duplex wells
-        NOTE: patching will only be done in batch, from library/well
+    def _bulk_set_related_values(self, cursor, new_reagents, patched_reagents):
         '''
-        logger.info('patch (%d) reagents for silencing_reagent ...', len(deserialized))
-        
-        metadata = {}
-        schema = self.build_schema(request.user)
-        fields = schema['fields']
-
-        cumulative_error = CumulativeError()
-            
-        for i,well_data in enumerate(deserialized):
-            well = well_data['well']
-            logger.debug('patch sirna well: %r', well.well_id)
-            is_patch = False
-            if not well.reagents.exists():
-                reagent = SilencingReagent(well=well)
-                if well_data.get('duplex_wells', None):
-                    reagent.save()
-                    reagent.duplex_wells = well_data['duplex_wells']
-                # FIXME: 20181211: how to unset duplex_wells? (Not this...)
-                # else:
-                #    reagent.duplex_wells = None
-            else:
-                is_patch = True
-                # TODO: only works for a single reagent
-                # can search for the reagent using id_kwargs
-                # reagent = well.reagents.all().filter(**id_kwargs)
-                # TODO: update reagent
-                reagent = well.reagents.all()[0]
-                reagent = reagent.silencingreagent
-                logger.debug('found reagent: %r, %r', reagent.well_id, reagent)
-            try:
-                self._set_reagent_values(reagent, well_data, is_patch, schema, fields)
-                if (i+1) % 1000 == 0:
-                    logger.info('patched %d reagents', i+1)
-            except ValidationError, e:
-                cumulative_error.add_error(well.well_id, e.errors, 
-                    line=well_data.get(INPUT_FILE_DESERIALIZE_LINE_NUMBER_KEY, i))
-            
-        if cumulative_error.errors:
-            raise cumulative_error
-        
-        logger.info('patched %d reagents', i+1)
-        return metadata
-
-    def _set_reagent_values(self, reagent, deserialized, is_patch, schema, fields):
-        
-        start_time = time.time()
-
-        initializer_dict = self.parse(deserialized, fields=fields)
-        errors = self.validate(initializer_dict, patch=is_patch, fields=fields)
-        if errors:
-            raise ValidationError(errors)
-
-        self.patch_elapsedtime1 += (time.time() - start_time)
-        start_time = time.time()
-        
-        related_fields = ['entrezgene_id', 'gene_name', 'species_name']
-        related_fields = ['facility_%s'%field for field in related_fields] + \
-            ['vendor_%s'%field for field in related_fields]
-        for key, val in initializer_dict.items():
-            if key not in related_fields and key != 'duplex_wells': 
-                if hasattr(reagent, key):
-                    setattr(reagent, key, val)
-        reagent.save()
-        logger.debug('patch silencing reagent: %r', reagent)
-        logger.debug('patch silencing reagent: %r: %r', reagent, initializer_dict)
-
-        self.patch_elapsedtime2 += (time.time() - start_time)
-        start_time = time.time()
-
-        # Now do the gene tables
-        
-        gene_key = 'entrezgene_id'
-        if deserialized.get('vendor_%s' % gene_key, None):
-            logger.debug('create gene for %r', reagent.well.well_id)
-            reagent.vendor_gene = \
-                self._create_gene(deserialized, 'vendor')
-        if deserialized.get('facility_%s' % gene_key, None):
-            reagent.facility_gene = \
-                self._create_gene(deserialized, 'facility')
-        reagent.save()
-        
-        self.patch_elapsedtime3 += (time.time() - start_time)
+        Create the vendor and facility genes, and the duplex wells of the new 
+        reagents (the deserialized array has been loaded with the duplex wells)
+        '''
+        reagents = new_reagents + patched_reagents
+        gene_keys = ['entrezgene_id', 'gene_name', 'species_name']
+        gene_fields = [Gene._meta.get_field(key) for key in gene_keys]
+        
+        def get_value(key, initializer_dict, well_data):
+            if key in initializer_dict:
+                return initializer_dict[key]
+            return well_data.get(key, None)
+        
+        for source_type in ['vendor', 'facility']:
+            # Note: a new gene is created for each reagent gene given
+            gene_reagents = [
+                (reagent_id, initializer_dict, well_data) 
+                for reagent_id, initializer_dict, well_data in reagents
+                    if well_data.get('%s_entrezgene_id' % source_type, None)]
+            if not gene_reagents:
+                continue
+            logger.debug('create %s genes: %d', source_type, len(gene_reagents))
+            gene_ids = bulk_load.reserve_ids(
+                cursor, Gene._meta.db_table, 'gene_id', len(gene_reagents))
+            genes = zip(gene_ids, gene_reagents)
+            bulk_load.copy_rows(
+                cursor, Gene._meta.db_table, ['gene_id'] + gene_keys,
+                ([gene_id] + [
+                    get_value('%s_%s' % (source_type, field.name), 
+                        initializer_dict, well_data) or field.get_default()
+                    for field in gene_fields]
+                    for gene_id, (reagent_id, initializer_dict, well_data) 
+                        in genes))
+            bulk_load.copy_rows(
+                cursor, GeneSymbol._meta.db_table, 
+                ['gene_id', 'entrezgene_symbol', 'ordinal'],
+                ([gene_id, symbol, ordinal]
+                    for gene_id, (reagent_id, initializer_dict, well_data) 
+                        in genes
+                    for ordinal, symbol in enumerate(get_value(
+                        '%s_entrezgene_symbols' % source_type, 
+                        initializer_dict, well_data) or [])))
+            bulk_load.copy_rows(
+                cursor, GeneGenbankAccessionNumber._meta.db_table, 
+                ['gene_id', 'genbank_accession_number'],
+                ([gene_id, accession_number]
+                    for gene_id, (reagent_id, initializer_dict, well_data) 
+                        in genes
+                    for accession_number in get_value(
+                        '%s_genbank_accession_numbers' % source_type, 
+                        initializer_dict, well_data) or []))
+            bulk_load.update_rows(
+                cursor, SilencingReagent._meta.db_table, 'reagent_id',
+                ['%s_gene_id' % source_type],
+                ([reagent_id, gene_id] 
+                    for gene_id, (reagent_id, initializer_dict, well_data) 
+                        in genes))
+        
+        # FIXME: 20181211: how to unset duplex_wells? 
+        # (duplex wells are set only for new reagents)
+        duplex_wells_through = SilencingReagent.duplex_wells.through
+        bulk_load.copy_rows(
+            cursor, duplex_wells_through._meta.db_table, 
+            ['silencingreagent_id', 'well_id'],
+            ([reagent_id, duplex_well.well_id]
+                for reagent_id, initializer_dict, well_data in new_reagents
+                for duplex_well in well_data.get('duplex_wells', None) or []))
         
     def final_validation(self, final_data):
         ''' Perform final validations on the data generated after loading'''
@@ -22462,42 +23425,10 @@ class SilencingReagentResource(ReagentResource):
             super(SilencingReagentResource, self).final_validation(final_data))
         return errors
     
-    def _create_gene(self, data, source_type):
-        
-        gene_keys = ['entrezgene_id', 'gene_name', 'species_name']
-        gene = Gene()
-        for key in gene_keys:
-            api_key = '%s_%s' % (source_type, key)
-            val = data.get(api_key, None)
-            if val:
-                setattr(gene, key, val)
-        gene.save()
-        
-        _key = 'entrezgene_symbols'
-        if data.get('%s_%s' % (source_type, _key), None):
-            symbol_list = data['%s_%s' % (source_type, _key)]
-            for i, symbol in enumerate(symbol_list):
-                gene_symbol = GeneSymbol()
-                setattr(gene_symbol, 'entrezgene_symbol', symbol)
-                setattr(gene_symbol, 'ordinal', i)
-                setattr(gene_symbol, 'gene', gene)
-                gene_symbol.save()
-    
-        _key = 'genbank_accession_numbers'
-        
-        if data.get('%s_%s' % (source_type, _key), None):
-            _list = data['%s_%s' % (source_type, _key)]
-            logger.debug('create genbank_accession_number: %r, %r', _list, gene)
-            for i, num in enumerate(_list):
-                accession_number = GeneGenbankAccessionNumber()
-                setattr(accession_number, 'genbank_accession_number', num)
-                setattr(accession_number, 'gene', gene)
-                accession_number.save()
-        
-        return gene
-
 class SmallMoleculeReagentResource(ReagentResource):
 
+    reagent_model = SmallMoleculeReagent
+    
     class Meta:
         authentication = MultiAuthentication(
             IccblBasicAuthentication(), IccblSessionAuthentication())
@@ -22645,52 +23576,6 @@ class SmallMoleculeReagentResource(ReagentResource):
         raise ApiNotImplemented(self._meta.resource_name, 'patch_obj')
         # NOTE: patching will only be done in batch, from library/well
     
-    def _patch_wells(self, request, deserialized):
-        ''' Internal bulk update: 
-        - the deserialized array has been loaded with the wells
-        '''
-        logger.info('patch (%d) reagents for small_molecule ...', len(deserialized))
-        
-        schema = self.build_schema(request.user)
-        fields = schema['fields']
-        metadata = {}
-        
-        cumulative_error = CumulativeError()
-        
-        for i,well_data in enumerate(deserialized):
-            well = well_data['well']
-            is_patch = False
-            if not well.reagents.exists():
-                reagent = SmallMoleculeReagent(well=well)
-                reagent.save()
-            else:
-                is_patch = True
-                # TODO: only works for a single reagent
-                # can search for the reagent using id_kwargs
-                # reagent = well.reagents.all().filter(**id_kwargs)
-                # TODO: update reagent
-                reagent = well.reagents.all()[0]
-                reagent = reagent.smallmoleculereagent
-                logger.debug('found reagent: %r, %r', reagent.well_id, reagent)
-            try:
-                well_metadata = \
-                    self._set_reagent_values(
-                        reagent, well_data, is_patch, schema, fields)
-                if well_metadata:
-                    metadata[well_data[WELL.WELL_ID]] = well_metadata
-                if (i+1) % 1000 == 0:
-                    logger.info('patched %d reagents', i+1)
-            except ValidationError, e:
-                cumulative_error.add_error(well.well_id, e.errors, 
-                          line=well_data.get(INPUT_FILE_DESERIALIZE_LINE_NUMBER_KEY, i))
-            
-        if cumulative_error.errors:
-            raise cumulative_error
-
-        logger.info('patched %d reagents', i+1)
-        
-        return metadata
-
     def parse(self, deserialized, create=False, fields=None, schema=None):
         
         _data = ReagentResource.parse(self, deserialized, create=create, 
@@ -22705,92 +23590,54 @@ class SmallMoleculeReagentResource(ReagentResource):
         return _data
 
 
-    def _set_reagent_values(self, reagent, deserialized, is_patch, schema, fields):
-
-        start_time = time.time()
-        initializer_dict = self.parse(deserialized, create=not is_patch, fields=fields)
-        metadata = {}
-        errors = self.validate(initializer_dict, patch=is_patch, fields=fields)
-        if errors:
-            raise ValidationError(errors)
-
-        self.patch_elapsedtime1 += (time.time() - start_time)
-        start_time = time.time()
-
-        related_fields = [
-            'compound_name', 'chembank_id', 'pubchem_cid', 'chembl_id',
-            'molfile']
-        for key, val in initializer_dict.items():
-            if key not in related_fields and hasattr(reagent, key):
-                setattr(reagent, key, val)
-        logger.debug('patch small molecule reagent: %r', reagent)
-        reagent.save()
-
-        self.patch_elapsedtime2 += (time.time() - start_time)
-        start_time = time.time()
-        
-        if 'compound_name' in initializer_dict:
-            reagent.smallmoleculecompoundname_set.all().delete()
-            # TODO: does this delete the old name entries?
-            values = initializer_dict['compound_name'] or []
-            for ordinal, val in enumerate(values):
-                cn = SmallMoleculeCompoundName.objects.create(
-                    reagent=reagent, compound_name=val, ordinal=ordinal)
-                cn.save()
-        if 'chembank_id' in initializer_dict:
-            reagent.smallmoleculechembankid_set.all().delete()
-            values = initializer_dict['chembank_id'] or []
-            for id in values:
-                cid = SmallMoleculeChembankId.objects.create(
-                    reagent=reagent, chembank_id=id)
-                cid.save()
-        if 'pubchem_cid' in initializer_dict:
-            reagent.smallmoleculepubchemcid_set.all().delete()
-            values = initializer_dict['pubchem_cid'] or []
-            for id in values:
-                cid = SmallMoleculePubchemCid.objects.create(
-                    reagent=reagent, pubchem_cid=id)
-                cid.save()
-        if 'chembl_id' in initializer_dict:
-            reagent.smallmoleculechemblid_set.all().delete()
-            values = initializer_dict['chembl_id'] or []
-            for id in values:
-                cid = SmallMoleculeChemblId.objects.create(
-                    reagent=reagent, chembl_id=id)
-                cid.save()
-        new_molfile = deserialized.get('molfile', None)
-        if new_molfile:
-            # Compare md5sum for molfiles
-            molquery = Molfile.objects.all().filter(reagent=reagent)
-            if molquery.exists():
-                old_molfile = molquery[0]
-#                 m = hashlib.md5()
-#                 m.update(old_molfile)
-#                 oldkey = m.hexdigest()
-#                 m = hashlib.md5()
-#                 m.update(new_molfile)
-#                 newkey = m.hexdigest()
-#                 if oldkey != newkey:
-#                 metadata[SMALL_MOLECULE_REAGENT.MOLFILE] = [
-#                     oldkey, newkey]
-                molquery.delete()
-                
-                molfile = Molfile.objects.create(
-                    reagent=reagent, molfile=new_molfile)
-                molfile.save()
-            else:
-                molfile = Molfile.objects.create(
-                    reagent=reagent, molfile=new_molfile)
-                molfile.save()
-                
-        self.patch_elapsedtime3 += (time.time() - start_time)
-                
-        logger.debug('sm patch_obj done')
-        return metadata
+    def _bulk_set_related_values(self, cursor, new_reagents, patched_reagents):
+        '''
+        Replace the compound names, chembank, pubchem, chembl ids, and the 
+        molfiles given
+        '''
+        reagents = new_reagents + patched_reagents
+        
+        compound_name_reagents = [
+            (reagent_id, initializer_dict['compound_name'] or []) 
+            for reagent_id, initializer_dict, well_data in reagents
+                if 'compound_name' in initializer_dict ]
+        bulk_load.replace_rows(
+            cursor, SmallMoleculeCompoundName._meta.db_table, 'reagent_id',
+            [reagent_id for reagent_id, values in compound_name_reagents],
+            ['reagent_id', 'compound_name', 'ordinal'],
+            ([reagent_id, val, ordinal] 
+                for reagent_id, values in compound_name_reagents
+                for ordinal, val in enumerate(values)))
+        
+        for key, model in [
+                ('chembank_id', SmallMoleculeChembankId),
+                ('pubchem_cid', SmallMoleculePubchemCid),
+                ('chembl_id', SmallMoleculeChemblId)]:
+            id_reagents = [
+                (reagent_id, initializer_dict[key] or []) 
+                for reagent_id, initializer_dict, well_data in reagents
+                    if key in initializer_dict ]
+            bulk_load.replace_rows(
+                cursor, model._meta.db_table, 'reagent_id',
+                [reagent_id for reagent_id, values in id_reagents],
+                ['reagent_id', key],
+                ([reagent_id, val] 
+                    for reagent_id, values in id_reagents for val in values))
+        
+        molfile_reagents = [
+            (reagent_id, well_data['molfile']) 
+            for reagent_id, initializer_dict, well_data in reagents
+                if well_data.get('molfile', None) ]
+        bulk_load.replace_rows(
+            cursor, Molfile._meta.db_table, 'reagent_id',
+            [reagent_id for reagent_id, molfile in molfile_reagents],
+            ['reagent_id', 'molfile'], molfile_reagents)
 
 class NaturalProductReagentResource(ReagentResource):
     # Consider folding the NaturalProductReagentResource into ReagentResource
     
+    reagent_model = NaturalProductReagent
+    
     class Meta:
         
         authentication = MultiAuthentication(IccblBasicAuthentication(),
@@ -22811,52 +23658,6 @@ class NaturalProductReagentResource(ReagentResource):
     def patch_obj(self, request, deserialized, **kwargs):
         raise ApiNotImplemented(self._meta.resource_name, 'patch_obj')
         # NOTE: patching will only be done in batch, from library/well
-
-    def _patch_wells(self, request, deserialized):
-        ''' For bulk update: 
-        - deserialized has been loaded with the well
-        '''
-        logger.info('patch (%d) reagents for natural_product ...', len(deserialized))
-        metadata = {}
-        schema = self.build_schema(request.user)
-        fields = schema['fields']
-        logger.info('natural product reagent fields: %r', fields.keys())
-        cumulative_error = CumulativeError()
-        for i,well_data in enumerate(deserialized):
-            
-            well = well_data['well']
-            is_patch = False
-            if not well.reagents.exists():
-                reagent = NaturalProductReagent(well=well)
-            else:
-                is_patch = True
-                # TODO: only works for a single reagent
-                # can search for the reagent using id_kwargs
-                # reagent = well.reagents.all().filter(**id_kwargs)
-                # TODO: update reagent
-                reagent = well.reagents.all()[0]
-                reagent = reagent.naturalproductreagent
-                logger.debug('found reagent: %r, %r', reagent.well_id, reagent)
-            
-            initializer_dict = self.parse(well_data, fields=fields)
-            errors = self.validate(initializer_dict, patch=is_patch, fields=fields)
-            if errors:
-                cumulative_error.add_error(well.well_id, errors, line=line)
-            
-            for key, val in initializer_dict.items():
-                if hasattr(reagent, key):
-                    setattr(reagent, key, val)
-    
-            reagent.save()
-            if (i+1) % 1000 == 0:
-                logger.info('patched %d reagents', i+1)
-
-        if cumulative_error.errors:
-            raise cumulative_error
-        
-        logger.info('patched %d reagents', i+1)
-
-        return metadata
     
 class WellSerializer(LimsSerializer):
     
@@ -23245,10 +24046,6 @@ class WellResource(DbApiResource):
 
         reagent_resource = self.get_reagent_resource(library.classification)  
         schema = reagent_resource.build_schema(request.user)
-        reagent_specific_fields = { 
-            k:v for k,v in schema['fields'].items()
-                if v['scope'] != 'fields.well' }
-        logger.debug('reagent_specific_fields: %r', reagent_specific_fields.keys())
 
         # allow for internal data to be passed
         deserialized = kwargs.pop('data', None)
@@ -23261,15 +24058,225 @@ class WellResource(DbApiResource):
         # Track cumulative parsing and validation errors        
         cumulative_error = CumulativeError()
         
+        library_log = self.make_log(request, **kwargs)
+        library_log.ref_resource_name = 'library'
+        library_log.key = library.short_name
+        library_log.uri = '/'.join([
+            library_log.ref_resource_name, library_log.key])
+        # Note: saved before the well logs are created with the parent_log
+        library_log.save()
+ 
+        logger.info('Cache library wells for patch...') 
+        well_map = dict((well.well_id, well) 
+            for well in library.well_set.all())
+        if len(well_map) == 0:
+            # Note: wells can only be created on library creation
+            raise BadRequestError(
+                key='library_short_name', msg='Library wells have not been created')
+        
+        digest_keys = set(schema['fields'].keys())
+        digest_keys.add('molfile')
+        digest_keys.discard('library_short_name')
+        content_digests = dict(Reagent.objects
+            .filter(well__library=library)
+            .exclude(content_digest__isnull=True)
+            .values_list('well_id', 'content_digest'))
+
+        full_create_log = False
+        if library.is_released is True:
+            full_create_log = is_preview_mode
+        logger.info('full_create_log: %r', full_create_log)
+        
+        # Patch the wells in batches, so that the input may be read 
+        # incrementally (e.g. SDF records are generated as the file is read)
+        batch_size = int(getattr(settings, 'WELL_PATCH_BATCH_SIZE', 2000))
+        well_ids_found = set()
+        patch_count = 0
+        unchanged_count = 0
+        create_count = 0
+        logs = []
+        for batch in self._get_batches(deserialized, batch_size):
+            batch_result = self._patch_well_batch(
+                request, library, library_log, reagent_resource, schema, 
+                batch, well_map, well_ids_found, content_digests, digest_keys,
+                cumulative_error, full_create_log, **kwargs)
+            patch_count += batch_result['patch_count']
+            unchanged_count += batch_result['unchanged_count']
+            create_count += batch_result['create_count']
+            logs.extend(batch_result['logs'])
+            logger.info('patched wells: %d, unchanged: %d', 
+                patch_count, unchanged_count)
+        
+        if not patch_count:
+            if cumulative_error.errors:
+                raise cumulative_error
+            else:
+                raise ValidationError(key='objects', msg='no valid well IDs')
+        logger.info('wells submitted: %d, changed: %d, unchanged: %d',
+            patch_count, patch_count-unchanged_count, unchanged_count)
+        
+        if cumulative_error.errors:
+            sorted_wells = sorted(cumulative_error.errors.keys())
+            sorted_errors = list()
+            for well_id in sorted_wells:
+                sorted_errors.append((well_id, cumulative_error.errors[well_id]))
+            cumulative_error.errors = sorted_errors
+            
+            if deserialize_meta:
+                for k,v in deserialize_meta.items():
+                    cumulative_error.errors.append((k,v))
+            if DEBUG_LIB_LOAD is True:
+                logger.info('cumulative_errors...: %r', cumulative_error)
+            raise cumulative_error
+
+        if not logs:
+            if deserialize_meta:
+                errors = deserialize_meta
+            else:
+                errors = {}
+            errors.update({ 'state': 'patch file contains no updates'})
+            if unchanged_count:
+                errors.update({
+                    SCHEMA.API_MSG_SUBMIT_COUNT: patch_count, 
+                    SCHEMA.API_MSG_UNCHANGED: unchanged_count })
+            raise ValidationError(errors)
+
+        library.save()
+        logger.info(
+            'put_list: WellResource: library: %r; patch completed: %d', 
+            library.short_name, patch_count)
+        reagent_resource.get_debug_times()
+        
+        # Update statistics 
+        
+        experimental_well_count = library.well_set.filter(
+            library_well_type__iexact=WELL_TYPE.EXPERIMENTAL).count()
+        if library.experimental_well_count != experimental_well_count:
+            library_log.diffs['experimental_well_count'] = \
+                [library.experimental_well_count, experimental_well_count]
+            library.experimental_well_count = experimental_well_count
+            library.save()
+ 
+        library_log.save()
+        
+        # Update: for wells, only measure what has diffed
+        update_count = len([x for x in logs if x.diffs ])
+
+        # Update screening stats if wells have changed
+                
+        if update_count:
+            self.update_screening_stats(library)
+        
+        if update_count > 0 or create_count > 0:
+            prev_version = library.version_number
+            if library.version_number:
+                library.version_number += 1
+            else:
+                library.version_number = 1
+            library.save()
+            library_log.diffs['version_number'] = [prev_version, library.version_number]
+            library_log.save()
+        
+        # Final result reporting
+        meta = kwargs.get('meta', {})
+
+        if deserialize_meta:
+            meta.update(deserialize_meta)
+        
+        meta.update({ 
+            SCHEMA.API_MSG_RESULT: { 
+                SCHEMA.API_MSG_SUBMIT_COUNT: patch_count, 
+                SCHEMA.API_MSG_UPDATED: update_count, 
+                SCHEMA.API_MSG_CREATED: create_count, 
+                SCHEMA.API_MSG_UNCHANGED: patch_count-update_count-create_count,
+                SCHEMA.API_MSG_ACTION: library_log.api_action, 
+                SCHEMA.API_MSG_COMMENTS: library_log.comment
+            }
+        })
+        logger.info('wells patch complete: %r', meta)
+        
+        library_log.json_field = meta
+        library_log.save()
+        
+        if is_preview_mode is True and library.is_released is True:
+            # After release, each load will be a "preview":
+            # -- only the logs will be committed until the preview is released.
+            if API_PARAM_PREVIEW_LOGS in kwargs:
+                kwargs[API_PARAM_PREVIEW_LOGS].append(library_log)
+                kwargs[API_PARAM_PREVIEW_LOGS].extend(logs)
+            
+                logger.info('transaction rollback for preview mode...')
+                transaction.set_rollback(True)
+            else:
+                raise ProgrammingError(
+                    'patching in preview mode requires %r param' 
+                        % API_PARAM_PREVIEW_LOGS )
+        if not self._meta.always_return_data:
+            return self.build_response(
+                request, { API_RESULT_META: meta }, 
+                response_class=HttpResponse, **kwargs)
+        else:
+            return self.build_response(
+                request,  { API_RESULT_META: meta }, 
+                response_class=HttpResponse, **kwargs)
+
+    @staticmethod
+    def _get_batches(deserialized, batch_size):
+        ''' 
+        Generate lists of batch_size rows from the (iterable) input; rows are
+        assigned the input row number if no line number was deserialized
+        '''
+        batch = []
+        for row, data in enumerate(deserialized):
+            data.setdefault(INPUT_FILE_DESERIALIZE_LINE_NUMBER_KEY, row)
+            batch.append(data)
+            if len(batch) >= batch_size:
+                yield batch
+                batch = []
+        if batch:
+            yield batch
+    
+    def _patch_well_batch(
+            self, request, library, library_log, reagent_resource, 
+            reagent_schema, deserialized, well_map, well_ids_found, 
+            content_digests, digest_keys, cumulative_error, full_create_log, 
+            **kwargs):
+        '''
+        Patch a batch of the well/reagent definitions for patch_list:
+        - validation errors are added to the cumulative_error
+        @return dict of the patch_count, unchanged_count, create_count, and 
+        the well logs for the batch
+        '''
+        result = {
+            'patch_count': 0, 'unchanged_count': 0, 'create_count': 0, 
+            'logs': [] }
+        reagent_specific_fields = { 
+            k:v for k,v in reagent_schema['fields'].items()
+                if v['scope'] != 'fields.well' }
+        
         # 1. Validate all patch entries and collect well_ids
-        valid_data, errors = self._find_valid_entries(deserialized)
+        valid_data, errors = self._find_valid_entries(
+            deserialized, well_ids_found=well_ids_found)
         if errors:
             cumulative_error._update_from(errors)
         if not valid_data:
-            if cumulative_error.errors:
-                raise cumulative_error
+            return result
+        well_ids_found.update(valid_data.keys())
+        result['patch_count'] = len(valid_data)
+        
+        # 1a. Skip wells that are unchanged since the last load
+        
+        for well_id, well_data in valid_data.items():
+            content_digest = self.get_content_digest(well_data, digest_keys)
+            if content_digests.get(well_id, None) == content_digest:
+                del valid_data[well_id]
+                result['unchanged_count'] += 1
             else:
-                raise ValidationError(key='objects', msg='no valid well IDs')
+                well_data[REAGENT_CONTENT_DIGEST_KEY] = content_digest
+        logger.info('batch wells: %d, unchanged: %d',
+            result['patch_count'], result['unchanged_count'])
+        if not valid_data:
+            return result
         
         # 2. Fetch original data for logging state
 
@@ -23310,28 +24317,20 @@ class WellResource(DbApiResource):
         original_data = { data['well_id']:data for data in original_data }
         
         logger.info('fetched wells: %d for search data', len(original_data))
-    
-        library_log = self.make_log(request, **kwargs)
-        library_log.ref_resource_name = 'library'
-        library_log.key = library.short_name
-        library_log.uri = '/'.join([
-            library_log.ref_resource_name, library_log.key])
- 
-        logger.info('Cache library wells for patch...') 
-        well_map = dict((well.well_id, well) 
-            for well in library.well_set.all())
-        if len(well_map) == 0:
-            # Note: wells can only be created on library creation
-            raise BadRequestError(
-                key='library_short_name', msg='Library wells have not been created')
         
         # 3. Patch well specific data
          
         logger.info('patch wells, count: %d', len(valid_data))
-        fields = { key:field for key,field in schema['fields'].items()
+        fields = { key:field for key,field in reagent_schema['fields'].items()
             if field['scope'] == 'fields.%s'% 'well'
                 and 'u' in field['editability'] }
         reagent_data = []
+        # Wells are updated in bulk, after validation
+        well_attnames = set(
+            field.attname for field in Well._meta.local_concrete_fields
+                if not field.primary_key)
+        patched_wells = []
+        patched_well_columns = set([WELL.LIBRARY_WELL_TYPE])
         for i,(well_id,well_data) in enumerate(valid_data.items()):
             line = well_data.get(INPUT_FILE_DESERIALIZE_LINE_NUMBER_KEY, i)
             
@@ -23387,10 +24386,10 @@ class WellResource(DbApiResource):
                     
             well_data['well'] = well
             for key, val in initializer_dict.items():
-                if hasattr(well, key):
+                if key in well_attnames:
                     setattr(well, key, val)
-            
-            well.save()
+                    patched_well_columns.add(key)
+            patched_wells.append(well)
             
             duplex_wells = []
             if well_data.get('duplex_wells', None):
@@ -23442,44 +24441,30 @@ class WellResource(DbApiResource):
             if (i+1) % 1000 == 0:
                 logger.info('patched %d wells', i+1)
                 
+        patched_well_columns = sorted(patched_well_columns)
+        with connection.cursor() as cursor:
+            bulk_load.update_rows(
+                cursor, Well._meta.db_table, 'well_id', 
+                [Well._meta.get_field(attname).column 
+                    for attname in patched_well_columns],
+                ([well.well_id] + [
+                    getattr(well, attname) for attname in patched_well_columns]
+                    for well in patched_wells))
         logger.info('patched %d wells', i+1)
 
         # 4. Patch reagent specific data
         
-        reagent_patch_metadata = None
         if reagent_data:
             try:
                 logger.info('patch (%d) reagents for: %r',
                             len(reagent_data), library.classification)
-                reagent_patch_metadata = \
-                    reagent_resource._patch_wells(request, reagent_data)
-                    
-                # FIXME: 20180710 - reagent_patch_metadata created but not 
-                # needed to track molfile changes
+                reagent_resource._patch_wells(request, reagent_data)
             except CumulativeError, e:
                 cumulative_error.update_from(e)
         else:
             logger.info('no reagent data to patch')
-            
-        library.save()
-        logger.info(
-            'put_list: WellResource: library: %r; patch completed: %d', 
-            library.short_name, i+1)
-        reagent_resource.get_debug_times()
-        
-        # 5. Update statistics 
-        
-        experimental_well_count = library.well_set.filter(
-            library_well_type__iexact=WELL_TYPE.EXPERIMENTAL).count()
-        if library.experimental_well_count != experimental_well_count:
-            library_log.diffs['experimental_well_count'] = \
-                [library.experimental_well_count, experimental_well_count]
-            library.experimental_well_count = experimental_well_count
-            library.save()
- 
-        library_log.save()
         
-        # 6. Fetch new data, for logging
+        # 5. Fetch new data, for logging
         
         logger.info('fetch new data, for logging...')
         logger.debug('get new reagent state, for logging: %r',kwargs_for_log)
@@ -23496,112 +24481,56 @@ class WellResource(DbApiResource):
                 if errors:
                     cumulative_error.add_error(well_id, errors)
         if cumulative_error.errors:
-            sorted_wells = sorted(cumulative_error.errors.keys())
-            sorted_errors = list()
-            for well_id in sorted_wells:
-                sorted_errors.append((well_id, cumulative_error.errors[well_id]))
-            cumulative_error.errors = sorted_errors
-            
-            if deserialize_meta:
-                for k,v in deserialize_meta.items():
-                    cumulative_error.errors.append((k,v))
-            if DEBUG_LIB_LOAD is True:
-                logger.info('cumulative_errors...: %r', cumulative_error)
-            raise cumulative_error
+            # Note: the load will fail, so the logs are not needed
+            return result
 
         # TODO: 20180710 efficient Test for molfile changes
         
-        full_create_log = False
-        if library.is_released is True:
-            full_create_log = is_preview_mode
-        
-        logger.info('full_create_log: %r', full_create_log)
         logs = self.log_patches(
             request, original_data.values(), new_data.values(),
             excludes=['substance_id'], parent_log=library_log, 
             full_create_log=full_create_log)
-
-        if not logs:
-            if deserialize_meta:
-                errors = deserialize_meta
-            else:
-                errors = {}
-            errors.update({ 'state': 'patch file contains no updates'})
-            raise ValidationError(errors)
-
-        patch_count = len(valid_data)
-        # Update: for wells, only measure what has diffed
-        update_count = len([x for x in logs if x.diffs ])
+        result['logs'] = logs or []
+        
         # Create: measure what is reported created (new_data), subtract updates,
         # because create actions are not included in updates for well patching.
-        create_count = 0
         if not original_data:
-            create_count = len(new_data) - update_count
-
-        # 7. Update screening stats if wells have changed
-                
-        if update_count:
-            self.update_screening_stats(library)
-        
-        if update_count > 0 or create_count > 0:
-            prev_version = library.version_number
-            if library.version_number:
-                library.version_number += 1
-            else:
-                library.version_number = 1
-            library.save()
-            library_log.diffs['version_number'] = [prev_version, library.version_number]
-            library_log.save()
-        
-        # Final result reporting
-        meta = kwargs.get('meta', {})
+            result['create_count'] = \
+                len(new_data) - len([x for x in result['logs'] if x.diffs ])
+        return result
 
-        if deserialize_meta:
-            meta.update(deserialize_meta)
-        
-        meta.update({ 
-            SCHEMA.API_MSG_RESULT: { 
-                SCHEMA.API_MSG_SUBMIT_COUNT: patch_count, 
-                SCHEMA.API_MSG_UPDATED: update_count, 
-                SCHEMA.API_MSG_CREATED: create_count, 
-                SCHEMA.API_MSG_UNCHANGED: patch_count-update_count-create_count,
-                SCHEMA.API_MSG_ACTION: library_log.api_action, 
-                SCHEMA.API_MSG_COMMENTS: library_log.comment
-            }
-        })
-        logger.info('wells patch complete: %r', meta)
-        
-        library_log.json_field = meta
-        library_log.save()
-        
-        if is_preview_mode is True and library.is_released is True:
-            # After release, each load will be a "preview":
-            # -- only the logs will be committed until the preview is released.
-            if API_PARAM_PREVIEW_LOGS in kwargs:
-                kwargs[API_PARAM_PREVIEW_LOGS].append(library_log)
-                kwargs[API_PARAM_PREVIEW_LOGS].extend(logs)
-            
-                logger.info('transaction rollback for preview mode...')
-                transaction.set_rollback(True)
+    @staticmethod
+    def get_content_digest(well_data, keys):
+        '''
+        Digest of the (non-empty) input values of the well for the keys, used to
+        detect wells that are unchanged since the last load
+        '''
+        digest = hashlib.md5()
+        for key in sorted(keys):
+            val = well_data.get(key, None)
+            if val is None or val == '' or val == []:
+                continue
+            if isinstance(val, (list, tuple)):
+                val = LIST_DELIMITER_SQL_ARRAY.join(
+                    v.decode('utf-8') if isinstance(v, str) else unicode(v)
+                        for v in val)
+            elif isinstance(val, str):
+                val = val.decode('utf-8')
             else:
-                raise ProgrammingError(
-                    'patching in preview mode requires %r param' 
-                        % API_PARAM_PREVIEW_LOGS )
-        if not self._meta.always_return_data:
-            return self.build_response(
-                request, { API_RESULT_META: meta }, 
-                response_class=HttpResponse, **kwargs)
-        else:
-            return self.build_response(
-                request,  { API_RESULT_META: meta }, 
-                response_class=HttpResponse, **kwargs)
-
-    def _find_valid_entries(self, deserialized):  
-
+                val = unicode(val)
+            digest.update(('%s=%s\n' % (key, val)).encode('utf-8'))
+        return digest.hexdigest()
+    
+    def _find_valid_entries(self, deserialized, well_ids_found=None):  
+        '''
+        @param well_ids_found well_ids of previous batches, to find duplicates
+        '''
         errors = defaultdict(dict)
         
         id_attribute = WELL.WELL_ID
         valid_data = {}
+        if well_ids_found is None:
+            well_ids_found = set()
         
         DEBUG_LINE_KEY = 'line: {}'
         
@@ -23620,7 +24549,7 @@ class WellResource(DbApiResource):
                                 plate_number, well_name)})
                         continue
                     else:
-                        if well_id in valid_data:
+                        if well_id in valid_data or well_id in well_ids_found:
                             errors[well_id].update({ debug_key: 'duplicate' })
                         else:
                             data[WELL.WELL_ID] = well_id
@@ -23636,7 +24565,7 @@ class WellResource(DbApiResource):
                             .format(id, WELL.WELL_ID_PATTERN_MSG) })
                     continue
                 else:
-                    if well_id in valid_data:
+                    if well_id in valid_data or well_id in well_ids_found:
                         errors[well_id].update({ debug_key: 'duplicate' })
                     else:
                         data[WELL.WELL_ID] = well_id
@@ -23739,11 +24668,50 @@ class WellResource(DbApiResource):
         
         raise ApiNotImplemented(self._meta.resource_name, 'patch_obj')
         
+    @staticmethod
+    def is_pg_trgm_installed():
+        ''' 
+        True if the pg_trgm extension, required for the "fuzzy" search, is 
+        installed (see migration 0101_compound_search_indexes)
+        '''
+        with connection.cursor() as cursor:
+            cursor.execute(
+                "select count(*) from pg_extension where extname = 'pg_trgm'")
+            return cursor.fetchone()[0] > 0
+    
     @classmethod
-    def create_vendor_compound_name_base_query(cls, well_search_data):
-        
+    def create_vendor_compound_name_base_query(
+            cls, well_search_data, search_mode=None, limit=None):
+        '''
+        Create a ranked query for the wells having a vendor identifier or a
+        compound name matching one of the search lines (case insensitive):
+        - "starts_with": vendor identifiers and compound names starting with
+        the search line,
+        - "contains" (default): vendor identifiers equal to the search line,
+        compound names containing the search line,
+        - "fuzzy": as for "contains", and vendor identifiers and compound names
+        similar to the search line (pg_trgm similarity; requires the pg_trgm
+        extension, see is_pg_trgm_installed).
+
+        Matches are ranked in "search_rank": exact (0), starts with (1),
+        contains (2), similar (3-4, by similarity).
+
+        @param limit the maximum number of wells to return, best ranked first
+        @return a select of (well_id, search_rank)
+
+        NOTE: the lower case pattern and trigram indexes for the searches are
+        created in migration 0101_compound_search_indexes.
+        '''
         IS_SMALL_MOLECULE_ONLY = False
-        
+
+        if search_mode is None:
+            search_mode = COMPOUND_SEARCH_CONTAINS
+        if search_mode not in COMPOUND_SEARCH_MODES:
+            raise ValidationError(
+                key=API_PARAM_SEARCH_MODE,
+                msg='%s: must be one of %s' 
+                    % (search_mode, ', '.join(COMPOUND_SEARCH_MODES)))
+
         # Process the patterns by line
         parsed_lines = well_search_data
         if isinstance(parsed_lines, basestring):
@@ -23752,8 +24720,8 @@ class WellResource(DbApiResource):
             logger.info('found %d lines in search', len(parsed_lines))
             logger.debug('parsed_lines: %r', parsed_lines)
         if not isinstance(parsed_lines, (list,tuple)):
-            well_search_data = (parsed_lines,)
-        
+            parsed_lines = (parsed_lines,)
+
         search_items = set()
         for _line in parsed_lines:
             if not _line:
@@ -23763,48 +24731,88 @@ class WellResource(DbApiResource):
                 continue
             # 20180227 - require each entry on a separate line:
             # Otherwise, names containing commmas and whitespace must be quoted
-            search_items.add(_line)
-        
+            search_items.add(_line.lower())
+
         if not search_items:
             raise ValidationError(
                 key=SCHEMA.API_PARAM_SEARCH, msg='no search lines found')
 
-        logger.info('found: %d compound or vendor names in %r', 
-            len(search_items), parsed_lines)
+        logger.info('found: %d compound or vendor names in %r, mode: %r',
+            len(search_items), parsed_lines, search_mode)
 
         bridge = get_tables()
         _cn = bridge['small_molecule_compound_name']
         _smr = bridge['small_molecule_reagent']
         _r = bridge['reagent']
         _well = bridge['well']
-        
-        clause_cn = []
-        clause_vn = []
-        for term in search_items:
-            clause_cn.append(_cn.c.compound_name.ilike('%{}%'.format(term)))
-            clause_vn.append(_r.c.vendor_identifier==term)
-        if len(clause_cn) > 1:
-            clause_cn = or_(*clause_cn)
-            clause_vn = or_(*clause_vn)
-        else:
-            clause_cn = clause_cn[0]
-            clause_vn = clause_vn[0]
-        querycn = (
-            select([_well.c.well_id])
-            .select_from(
-                _well.join(_r,_well.c.well_id==_r.c.well_id)
-                    .join(_cn,_r.c.reagent_id==_cn.c.reagent_id))
-            .where(clause_cn))
-        vjoin = _well.join(_r,_well.c.well_id==_r.c.well_id)
+
+        _name = func.lower(_cn.c.compound_name)
+        _vendor_id = func.lower(_r.c.vendor_identifier)
+        name_join = (
+            _well.join(_r,_well.c.well_id==_r.c.well_id)
+                .join(_cn,_r.c.reagent_id==_cn.c.reagent_id))
+        vendor_join = _well.join(_r,_well.c.well_id==_r.c.well_id)
         if IS_SMALL_MOLECULE_ONLY is True:
-            vjoin = vjoin.join(_smr, _r.c.reagent_id==_smr.c.reagent_id)
-        query_vendor = (
-            select([_well.c.well_id])
-            .select_from(vjoin)
-            .where(clause_vn))
-        query = querycn.union(query_vendor)
+            vendor_join = vendor_join.join(
+                _smr, _r.c.reagent_id==_smr.c.reagent_id)
+
+        like_escape_char = '!'
+        def like_escape(term):
+            return re.sub(r'([!%_])', r'!\1', term)
+
+        def similar_to(column, term):
+            # NOTE: "%%" renders the pg_trgm "%" (similarity) operator, escaped
+            # for the psycopg2 parameter format
+            return column.op('%%')(term)
+
+        def ranked_select(join, rank, where):
+            return (
+                select([_well.c.well_id, rank.label('search_rank')])
+                .select_from(join)
+                .where(where))
+
+        matches = []
+        if search_mode != COMPOUND_SEARCH_STARTS_WITH:
+            matches.append(ranked_select(
+                vendor_join, literal_column('0'),
+                _vendor_id.in_(search_items)))
+        for term in search_items:
+            prefix = like_escape(term) + '%'
+            if search_mode == COMPOUND_SEARCH_STARTS_WITH:
+                matches.append(ranked_select(
+                    vendor_join,
+                    case([(_vendor_id==term, 0)], else_=1),
+                    _vendor_id.like(prefix, escape=like_escape_char)))
+                name_clause = _name.like(prefix, escape=like_escape_char)
+            else:
+                name_clause = _name.like('%' + prefix, escape=like_escape_char)
+            name_ranks = [
+                (_name==term, 0),
+                (_name.like(prefix, escape=like_escape_char), 1)]
+            name_rank_else = 2
+            if search_mode == COMPOUND_SEARCH_FUZZY:
+                matches.append(ranked_select(
+                    vendor_join,
+                    4 - func.similarity(_vendor_id, term),
+                    similar_to(_vendor_id, term)))
+                name_ranks.append((name_clause, 2))
+                name_clause = or_(name_clause, similar_to(_name, term))
+                name_rank_else = 4 - func.similarity(_name, term)
+            matches.append(ranked_select(
+                name_join, case(name_ranks, else_=name_rank_else),
+                name_clause))
+
+        _matches = union_all(*matches).alias('matches')
+        search_rank = func.min(_matches.c.search_rank)
+        query = (
+            select([_matches.c.well_id, search_rank.label('search_rank')])
+            .select_from(_matches)
+            .group_by(_matches.c.well_id)
+            .order_by(search_rank, _matches.c.well_id))
+        if limit:
+            query = query.limit(limit)
         return query
-        
+
     @classmethod
     def parse_well_search(cls, well_search_data):
         '''
@@ -24693,7 +25701,7 @@ class ResourceResource(reports.api.ResourceResource):
         
         resources = None
         if self.use_cache:
-            resources = self.get_cache().get('dbresources')
+            resources = get_tagged(self.get_cache(), 'dbresources')
         if not resources:
 
             resources = \
@@ -24703,7 +25711,7 @@ class ResourceResource(reports.api.ResourceResource):
             for key,resource in resources.items():
                 self.extend_resource_specific_data(resource)
                 
-            self.get_cache().set('dbresources', resources)
+            set_tagged(self.get_cache(), 'dbresources', resources)
     
         return resources
     
@@ -0,0 +1,31 @@
+from __future__ import unicode_literals
+
+import logging
+import threading
+
+from django.apps import AppConfig
+from django.conf import settings
+
+
+logger = logging.getLogger(__name__)
+
+
+class DbConfig(AppConfig):
+    name = 'db'
+
+    def ready(self):
+        from reports.serialize import register_image_file_resolver
+        from db.support.structure_image_index import \
+            get_structure_image_index, structure_image_file_resolver
+
+        register_image_file_resolver(structure_image_file_resolver)
+        
+        # Build the structure image index on startup, in the background
+        index = get_structure_image_index()
+        if (index is not None 
+                and getattr(settings, 'BUILD_STRUCTURE_IMAGE_INDEX_ON_STARTUP', 
+                    True) is True):
+            thread = threading.Thread(
+                target=index.refresh, name='structure_image_index')
+            thread.daemon = True
+            thread.start()
@@ -0,0 +1,24 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('db', '0098_db_post_migrate'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='cachedquery',
+            name='last_accessed',
+            field=models.DateTimeField(null=True),
+        ),
+        migrations.AddField(
+            model_name='cachedquery',
+            name='hit_count',
+            field=models.IntegerField(default=0),
+        ),
+    ]
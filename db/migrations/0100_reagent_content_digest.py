@@ -0,0 +1,19 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('db', '0099_cached_query_access'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='reagent',
+            name='content_digest',
+            field=models.TextField(null=True),
+        ),
+    ]
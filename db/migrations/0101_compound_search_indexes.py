@@ -0,0 +1,79 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import logging
+
+from django.db import migrations, transaction
+from django.db.utils import DatabaseError
+
+
+logger = logging.getLogger(__name__)
+
+# Indexes for the vendor identifier and compound name search:
+# - text_pattern_ops: exact and "starts with" searches
+# - gin_trgm_ops: "contains" and "fuzzy" (similarity) searches
+# @see db.api.WellResource.create_vendor_compound_name_base_query
+# NOTE: the trigram indexes require the pg_trgm extension (postgresql-contrib);
+# creating the extension requires database owner (PostgreSQL >= 13) or
+# superuser privileges. If the extension is not available, only the pattern
+# indexes are created, and the "fuzzy" search is not available.
+SEARCH_INDEXES = [
+    ('small_molecule_compound_name', 'compound_name'),
+    ('reagent', 'vendor_identifier'),
+]
+
+
+def create_pg_trgm_extension(schema_editor):
+    with schema_editor.connection.cursor() as cursor:
+        cursor.execute(
+            "select count(*) from pg_available_extensions "
+            "where name = 'pg_trgm'")
+        if cursor.fetchone()[0] == 0:
+            logger.warn(
+                'pg_trgm extension is not available, '
+                'trigram indexes are not created')
+            return False
+        try:
+            with transaction.atomic(using=schema_editor.connection.alias):
+                cursor.execute('CREATE EXTENSION IF NOT EXISTS pg_trgm')
+        except DatabaseError as e:
+            logger.warn(
+                'pg_trgm extension not created, '
+                'trigram indexes are not created: %r', e)
+            return False
+    return True
+
+def create_indexes(apps, schema_editor):
+    is_trgm_available = create_pg_trgm_extension(schema_editor)
+    with schema_editor.connection.cursor() as cursor:
+        for table, column in SEARCH_INDEXES:
+            cursor.execute(
+                'CREATE INDEX {table}_{column}_lower_pattern '
+                'ON {table} (lower({column}) text_pattern_ops);'.format(
+                    table=table, column=column))
+            if is_trgm_available:
+                cursor.execute(
+                    'CREATE INDEX {table}_{column}_lower_trgm '
+                    'ON {table} USING gin (lower({column}) gin_trgm_ops);'
+                    .format(table=table, column=column))
+
+def drop_indexes(apps, schema_editor):
+    with schema_editor.connection.cursor() as cursor:
+        for table, column in SEARCH_INDEXES:
+            cursor.execute(
+                'DROP INDEX IF EXISTS {table}_{column}_lower_pattern;'.format(
+                    table=table, column=column))
+            cursor.execute(
+                'DROP INDEX IF EXISTS {table}_{column}_lower_trgm;'.format(
+                    table=table, column=column))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('db', '0100_reagent_content_digest'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_indexes, drop_indexes),
+    ]
@@ -0,0 +1,102 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import logging
+
+from django.db import migrations
+
+
+logger = logging.getLogger(__name__)
+
+# The result_matrix tables: one row per assay well, with the result values in
+# arrays, ordered by the data column positions of the result_matrix_layout.
+# @see db.api.ScreenResultResource.create_result_matrix
+# NOTE: the tables are not Django models (as for the well_query_index tables);
+# databases created without migrations (e.g. the test database) create the
+# tables on startup (see DbApiResource._create_result_matrix_table).
+# NOTE: the backfill reads all of the result_value rows; for large databases,
+# allow time for the migration (one statement per screen result).
+
+CREATE_TABLES_SQL = (
+    'CREATE TABLE IF NOT EXISTS result_matrix ('
+    ' "screen_result_id" integer NOT NULL, '
+    ' "well_id" text NOT NULL, '
+    ' "numeric_values" double precision[], '
+    ' "text_values" text[], '
+    ' PRIMARY KEY (screen_result_id, well_id) '
+    ');'
+    'CREATE TABLE IF NOT EXISTS result_matrix_layout ('
+    ' "screen_result_id" integer PRIMARY KEY, '
+    ' "data_column_ids" integer[] NOT NULL '
+    ');')
+
+# Note: as for create_result_matrix: if the result values are duplicated for a
+# well and data column, the first one loaded is used
+CREATE_RESULT_MATRIX_SQL = (
+    'WITH dc AS ( '
+    '  SELECT data_column_id, '
+    '    row_number() over (order by ordinal, data_column_id) '
+    '      as position '
+    '  FROM data_column WHERE screen_result_id = %(id)s ), '
+    'rv AS ( '
+    '  SELECT DISTINCT ON (data_column_id, well_id) '
+    '    data_column_id, well_id, numeric_value, value '
+    '  FROM result_value JOIN dc using(data_column_id) '
+    '  ORDER BY data_column_id, well_id, result_value_id ), '
+    'layout AS ( '
+    '  INSERT INTO result_matrix_layout '
+    '  SELECT %(id)s, '
+    '    coalesce(array_agg(data_column_id order by position), '
+    '      \'{}\') '
+    '  FROM dc ) '
+    'INSERT INTO result_matrix '
+    '(screen_result_id, well_id, numeric_values, text_values) '
+    'SELECT %(id)s, aw.well_id, '
+    '  array_agg(rv.numeric_value order by dc.position), '
+    '  array_agg(rv.value order by dc.position) '
+    'FROM assay_well aw CROSS JOIN dc '
+    'LEFT JOIN rv ON rv.data_column_id = dc.data_column_id '
+    '  AND rv.well_id = aw.well_id '
+    'WHERE aw.screen_result_id = %(id)s '
+    'GROUP BY aw.well_id; ')
+
+
+def backfill_result_matrix(cursor):
+    '''
+    Create the result_matrix rows for the screen results that have none
+    @return the number of screen results backfilled
+    '''
+    cursor.execute(
+        'SELECT screen_result_id FROM screen_result sr '
+        'WHERE NOT EXISTS ( '
+        '  SELECT null FROM result_matrix_layout rml '
+        '  WHERE rml.screen_result_id = sr.screen_result_id ) '
+        'ORDER BY screen_result_id')
+    screen_result_ids = [row[0] for row in cursor.fetchall()]
+    for i, screen_result_id in enumerate(screen_result_ids):
+        cursor.execute(CREATE_RESULT_MATRIX_SQL, { 'id': screen_result_id })
+        logger.info('result_matrix rows for screen_result %d: %d (%d/%d)',
+            screen_result_id, cursor.rowcount, i+1, len(screen_result_ids))
+    return len(screen_result_ids)
+
+def create_result_matrix(apps, schema_editor):
+    with schema_editor.connection.cursor() as cursor:
+        cursor.execute(CREATE_TABLES_SQL)
+        backfill_result_matrix(cursor)
+
+def drop_result_matrix(apps, schema_editor):
+    with schema_editor.connection.cursor() as cursor:
+        cursor.execute(
+            'DROP TABLE IF EXISTS result_matrix; '
+            'DROP TABLE IF EXISTS result_matrix_layout; ')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('db', '0101_compound_search_indexes'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_result_matrix, drop_result_matrix),
+    ]
@@ -0,0 +1,110 @@
+/**
+  Partition the result_value and assay_well tables by screen result:
+
+  - result_value is partitioned by LIST(data_column_id): one partition for the
+  data columns of each screen result: "result_value_sr_<screen_result_id>"
+  - assay_well is partitioned by LIST(screen_result_id): one partition for each
+  screen result: "assay_well_sr_<screen_result_id>"
+
+  With the partitioned tables, a screen result load writes into new tables that
+  are swapped in for the extant partitions, and deleting a screen result drops
+  its partitions (see db.api.ScreenResultResource.swap_result_partitions).
+
+  - requires PostgreSQL >= 11 (indexes and foreign keys on partitioned tables)
+  - run after result_value_cleanup.sql (unique data_column_id, well_id)
+  - run in a single transaction:
+  psql -1 -v ON_ERROR_STOP=1 -f result_value_partition.sql
+
+  NOTE: the extant tables are kept as "result_value_legacy" and
+  "assay_well_legacy"; drop them after the migration has been verified.
+  NOTE: result values without a data_column_id are not migrated.
+**/
+
+alter table result_value rename to result_value_legacy;
+alter table assay_well rename to assay_well_legacy;
+
+create table result_value (like result_value_legacy including defaults)
+  partition by list (data_column_id);
+create table assay_well (like assay_well_legacy including defaults)
+  partition by list (screen_result_id);
+
+/** keep the id sequences when the legacy tables are dropped **/
+do $$
+declare
+  seq text;
+begin
+  seq := pg_get_serial_sequence('result_value_legacy', 'result_value_id');
+  if seq is not null then
+    execute format(
+      'alter sequence %s owned by result_value.result_value_id', seq);
+  end if;
+  seq := pg_get_serial_sequence('assay_well_legacy', 'assay_well_id');
+  if seq is not null then
+    execute format(
+      'alter sequence %s owned by assay_well.assay_well_id', seq);
+  end if;
+end $$;
+
+/** create the partitions for the extant screen results **/
+do $$
+declare
+  sr record;
+begin
+  for sr in
+    select screen_result_id, string_agg(data_column_id::text, ',') dc_ids
+    from data_column group by screen_result_id
+  loop
+    execute format(
+      'create table result_value_sr_%s partition of result_value '
+      'for values in (%s)', sr.screen_result_id, sr.dc_ids);
+  end loop;
+  for sr in select screen_result_id from screen_result
+  loop
+    execute format(
+      'create table assay_well_sr_%s partition of assay_well '
+      'for values in (%s)', sr.screen_result_id, sr.screen_result_id);
+  end loop;
+end $$;
+
+insert into result_value
+  select * from result_value_legacy where data_column_id is not null;
+insert into assay_well select * from assay_well_legacy;
+
+/** constraints and indexes are created on the loaded partitions **/
+alter table result_value
+  add constraint result_value_pkey_partitioned
+  primary key (result_value_id, data_column_id);
+alter table result_value
+  add constraint result_value_data_column_well_id
+  unique (data_column_id, well_id);
+alter table result_value
+  add constraint result_value_data_column_fk
+  foreign key (data_column_id) references data_column (data_column_id)
+  deferrable initially deferred;
+alter table result_value
+  add constraint result_value_well_fk
+  foreign key (well_id) references well (well_id)
+  deferrable initially deferred;
+create index result_value_well_id_partitioned on result_value (well_id);
+
+alter table assay_well
+  add constraint assay_well_pkey_partitioned
+  primary key (assay_well_id, screen_result_id);
+alter table assay_well
+  add constraint assay_well_screen_result_fk
+  foreign key (screen_result_id) references screen_result (screen_result_id)
+  deferrable initially deferred;
+alter table assay_well
+  add constraint assay_well_well_fk
+  foreign key (well_id) references well (well_id)
+  deferrable initially deferred;
+create index assay_well_well_id_partitioned on assay_well (well_id);
+create index assay_well_is_positive_partitioned on assay_well (is_positive);
+
+analyze result_value;
+analyze assay_well;
+
+/**
+drop table result_value_legacy;
+drop table assay_well_legacy;
+**/
@@ -0,0 +1,42 @@
+/**
+  Revert result_value_partition.sql: restore the unpartitioned result_value
+  and assay_well tables.
+
+  - requires the "result_value_legacy" and "assay_well_legacy" tables kept by
+  result_value_partition.sql
+  - the rows of the partitioned tables replace the rows of the legacy tables
+  - run in a single transaction:
+  psql -1 -v ON_ERROR_STOP=1 -f result_value_unpartition.sql
+**/
+
+delete from result_value_legacy;
+insert into result_value_legacy select * from result_value;
+delete from assay_well_legacy;
+insert into assay_well_legacy select * from assay_well;
+
+/** keep the id sequences when the partitioned tables are dropped **/
+do $$
+declare
+  seq text;
+begin
+  seq := pg_get_serial_sequence('result_value', 'result_value_id');
+  if seq is not null then
+    execute format(
+      'alter sequence %s owned by result_value_legacy.result_value_id', seq);
+  end if;
+  seq := pg_get_serial_sequence('assay_well', 'assay_well_id');
+  if seq is not null then
+    execute format(
+      'alter sequence %s owned by assay_well_legacy.assay_well_id', seq);
+  end if;
+end $$;
+
+/** the partitions are dropped with the partitioned tables **/
+drop table result_value;
+drop table assay_well;
+
+alter table result_value_legacy rename to result_value;
+alter table assay_well_legacy rename to assay_well;
+
+analyze result_value;
+analyze assay_well;
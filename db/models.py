@@ -958,13 +958,17 @@ class CachedQuery(models.Model):
     username = models.CharField(null=False, max_length=128)
     count = models.IntegerField(null=True)
     
+    # access accounting, for eviction (see ScreenResultResource.clear_cache)
+    last_accessed = models.DateTimeField(null=True)
+    hit_count = models.IntegerField(default=0)
+    
     class Meta:
         db_table = 'cached_query' 
 
     def __repr__(self):
         return (
-            '<CachedQuery(id: %r, uri: %r, username: %r, count:%r)>' 
-            % (self.id, self.uri, self.username, self.count ))
+            '<CachedQuery(id: %r, uri: %r, username: %r, count:%r, hits: %r)>' 
+            % (self.id, self.uri, self.username, self.count, self.hit_count ))
 
 class Reagent(models.Model):
 
@@ -980,6 +984,10 @@ class Reagent(models.Model):
     
     comment = models.TextField(null=True)
     
+    # Digest of the input values of the last library load, to detect 
+    # unchanged wells on reload (see WellResource.patch_list)
+    content_digest = models.TextField(null=True)
+    
     # TODO: deprecated
     # library_contents_version = \
     #     models.ForeignKey('LibraryContentsVersion', null=True)
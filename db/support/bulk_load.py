@@ -0,0 +1,119 @@
+from __future__ import unicode_literals
+'''
+Set based loading of table rows, using the PostgreSQL "COPY" command:
+- copy_rows: COPY rows into a table,
+- update_rows: COPY the rows into a temporary staging table, then update the
+table from the staging table in one statement; rows that are unchanged are
+not written,
+- replace_rows: delete the child rows of the parents given, and COPY the new
+rows,
+- reserve_ids: allocate the ids of the rows to create from the table sequence,
+so that the ids may be used for child rows before the rows are copied.
+
+Note: table and column names are interpolated into the statements, and must
+not be taken from user input.
+'''
+
+import logging
+from tempfile import SpooledTemporaryFile
+
+
+logger = logging.getLogger(__name__)
+
+MAX_SPOOLFILE_SIZE = 100*1024*1024
+
+
+def _format_copy_value(val):
+    ''' Format the value for the "COPY (FORMAT CSV)" input '''
+    if val is None:
+        # Note: in CSV format, an unquoted empty value is a NULL
+        return b''
+    if isinstance(val, bool):
+        val = 'true' if val else 'false'
+    elif isinstance(val, float):
+        val = repr(val)
+    elif isinstance(val, str):
+        val = val.decode('utf-8')
+    elif not isinstance(val, unicode):
+        val = unicode(val)
+    return b'"%s"' % val.replace('"', '""').encode('utf-8')
+
+def copy_rows(cursor, table, columns, rows):
+    '''
+    COPY the rows into the table
+    @param rows iterable of value sequences, in columns order
+    @return the number of rows copied
+    '''
+    with SpooledTemporaryFile(max_size=MAX_SPOOLFILE_SIZE) as copy_file:
+        count = 0
+        for row in rows:
+            copy_file.write(
+                b','.join(_format_copy_value(val) for val in row))
+            copy_file.write(b'\n')
+            count += 1
+        if count == 0:
+            return 0
+        copy_file.seek(0)
+        cursor.copy_expert(
+            'COPY {} ({}) FROM STDIN WITH (FORMAT CSV)'.format(
+                table, ', '.join(columns)),
+            copy_file)
+    logger.debug('copied %d rows to %r', count, table)
+    return count
+
+def update_rows(cursor, table, key_column, columns, rows):
+    '''
+    Update the table from the rows, using a temporary staging table
+    @param rows iterable of (key, values...) sequences
+    @return the number of rows changed
+    '''
+    if not columns:
+        return 0
+    staging_table = '%s_staging' % table
+    cursor.execute(
+        'DROP TABLE IF EXISTS {staging}; '
+        'CREATE TEMP TABLE {staging} AS '
+        '  SELECT {key}, {columns} FROM {table} WITH NO DATA; '.format(
+            staging=staging_table, table=table, key=key_column,
+            columns=', '.join(columns)))
+    staged = copy_rows(cursor, staging_table, [key_column] + columns, rows)
+    updated = 0
+    if staged:
+        cursor.execute(
+            'UPDATE {table} t SET {set_columns} '
+            'FROM {staging} s '
+            'WHERE t.{key} = s.{key} '
+            'AND ({t_columns}) IS DISTINCT FROM ({s_columns}); '.format(
+                table=table, staging=staging_table, key=key_column,
+                set_columns=', '.join(
+                    '{0} = s.{0}'.format(column) for column in columns),
+                t_columns=', '.join('t.%s' % column for column in columns),
+                s_columns=', '.join('s.%s' % column for column in columns)))
+        updated = cursor.rowcount
+    cursor.execute('DROP TABLE {}'.format(staging_table))
+    logger.info('%s: staged: %d, updated: %d', table, staged, updated)
+    return updated
+
+def replace_rows(cursor, table, parent_column, parent_ids, columns, rows):
+    '''
+    Replace the rows of the table for the parent_ids
+    @param rows iterable of value sequences, in columns order
+    @return the number of rows copied
+    '''
+    if not parent_ids:
+        return 0
+    cursor.execute(
+        'DELETE FROM {} WHERE {} = ANY(%s)'.format(table, parent_column),
+        [list(parent_ids)])
+    return copy_rows(cursor, table, columns, rows)
+
+def reserve_ids(cursor, table, id_column, count):
+    '''
+    @return count new ids from the sequence of the table id_column
+    '''
+    if not count:
+        return []
+    cursor.execute(
+        'SELECT nextval(pg_get_serial_sequence(%s, %s)) '
+        'FROM generate_series(1, %s)', [table, id_column, count])
+    return [row[0] for row in cursor.fetchall()]
@@ -1,11 +1,14 @@
 from __future__ import unicode_literals
 
 import argparse
-from collections import OrderedDict
+from collections import OrderedDict, deque
+import itertools
 import json
 import logging
+import multiprocessing
 import re
 
+from django.conf import settings
 import xlrd
 from xlsxwriter.utility import xl_col_to_name
 
@@ -16,7 +19,7 @@ from reports.utils import default_converter
 from reports import ParseError, ValidationError, LIST_DELIMITER_SQL_ARRAY
 from reports.serialize import parse_val
 from reports.serialize.xlsutils import sheet_cols, sheet_rows, \
-    workbook_sheets, generic_xls_write_workbook
+    workbook_sheets, generic_xls_write_workbook, read_cell_string
 from db.schema import SCREEN_RESULT
 
 
@@ -24,6 +27,11 @@ logger = logging.getLogger(__name__)
 
 DEBUG_IMPORTER = False or logger.isEnabledFor(logging.DEBUG)
 
+# Result value sheet rows per parse task
+PARSE_CHUNK_SIZE = 2000
+# Parse smaller files in process
+PARALLEL_PARSE_MIN_ROWS = 4000
+
 PARTITION_POSITIVE_MAPPING = \
     SCHEMA.VOCAB.resultvalue.partitioned_positive.get_dict()
 CONFIRMED_POSITIVE_MAPPING = \
@@ -197,47 +205,245 @@ def result_value_field_mapper(header_row, parsed_columns):
         logger.info('mapped result value header row: %r', mapped_row) 
     return mapped_row
         
-def parse_result_values(parsed_columns, sheets):
+class _Absent(object):
+    ''' 
+    Marker for the fields not set in a packed result row (see 
+    _parse_result_rows_chunk); the class is pickled by reference, so the 
+    marker identity is kept in the pool worker results.
+    '''
+    pass
+
+_worker_parsed_columns = None
+
+def _init_parse_worker(parsed_columns):
+    global _worker_parsed_columns
+    _worker_parsed_columns = parsed_columns
+
+def _parse_result_rows_chunk(args):
+    '''
+    Parse a chunk of result value sheet rows (pool worker function):
+    @param args (header_row, start_index, row_types, row_values), where 
+        row_types, row_values are the xlrd Sheet.row_types, Sheet.row_values
+    @return (keys, rows, errors): the parsed rows, packed as tuples of values 
+        for the keys (_Absent for the keys not set), and the errors 
+        (of the ValidationErrors raised)
+    '''
+    (header_row, start_index, row_types, row_values) = args
+    parsed_columns = _worker_parsed_columns
+    keys = []
+    key_index = {}
+    rows = []
+    errors = {}
+    for i, (types, values) in enumerate(
+            zip(row_types, row_values), start_index):
+        try:
+            result = parse_result_row(
+                i,parsed_columns,dict(zip(header_row,[
+                    read_cell_string(ctype, value) 
+                        for ctype, value in zip(types, values)])))
+            if DEBUG_IMPORTER:
+                logger.info('parsed row: %d: %r',i,  result)
+        except ValidationError,e:
+            logger.exception('parse error: %r', e)
+            errors.update(e.errors)
+            continue
+        packed_row = [_Absent]*len(keys)
+        for key, value in result.items():
+            position = key_index.get(key)
+            if position is None:
+                key_index[key] = len(keys)
+                keys.append(key)
+                packed_row.append(value)
+            else:
+                packed_row[position] = value
+        rows.append(tuple(packed_row))
+    return (keys, rows, errors)
+
+def get_parse_processes():
+    '''
+    Return the number of processes used to parse the result value sheets:
+    settings.SCREEN_RESULT_PARSE_PROCESSES, or the cpu count (max 4)
+    '''
+    processes = getattr(settings, 'SCREEN_RESULT_PARSE_PROCESSES', None)
+    if processes is None:
+        try:
+            processes = min(multiprocessing.cpu_count(), 4)
+        except NotImplementedError:
+            processes = 1
+    return processes
+
+def _generate_sheet_chunks(parsed_columns, sheets, add_parse_error):
+    '''
+    Read the sheet headers, and yield (sheet name, chunk) for the rows of each
+    sheet, in chunks of PARSE_CHUNK_SIZE rows (see _parse_result_rows_chunk); 
+    the rows are read as the chunks are generated.
+    '''
+    for sheet in sheets:
+        logger.info('read result values sheet: %r...', sheet.name)
+    
+        rows = sheet_rows(sheet)
+        try:
+            header_row = result_value_field_mapper(rows.next(), parsed_columns)
+        except StopIteration:
+            continue
+        except ValidationError, e:
+            logger.exception('error: %r', e)
+            add_parse_error(sheet.name, e)
+            continue
+        for start in range(1, sheet.nrows, PARSE_CHUNK_SIZE):
+            end = min(start+PARSE_CHUNK_SIZE, sheet.nrows)
+            yield (sheet.name, (
+                header_row, start-1, 
+                [sheet.row_types(r) for r in range(start,end)],
+                [sheet.row_values(r) for r in range(start,end)]))
+
+def _imap_chunks(pool, sheet_chunks, max_pending):
+    '''
+    Yield (sheet name, parsed chunk) for the sheet_chunks, in order, parsed 
+    by the pool: at most max_pending chunks are read ahead of the consumer.
+    '''
+    pending = deque()
+    for sheet_name, chunk in sheet_chunks:
+        pending.append((sheet_name, 
+            pool.apply_async(_parse_result_rows_chunk, (chunk,))))
+        if len(pending) >= max_pending:
+            sheet_name, result = pending.popleft()
+            yield (sheet_name, result.get())
+    while pending:
+        sheet_name, result = pending.popleft()
+        yield (sheet_name, result.get())
+
+def parse_result_values(parsed_columns, sheets, processes=None):
     '''
     Parse the Screen Result input file format into a valid API input format:
-        - Create a row generator from the result value sheets
+        - Create a row iterable from the result value sheets
+    
+    @see ResultValueParser
+    @param processes the number of pool processes (default from 
+        get_parse_processes); use 1 to parse in this process.
+    '''
+    return ResultValueParser(parsed_columns, sheets, processes=processes)
+
+class ResultValueParser(object):
+    '''
+    Iterable of the parsed result value rows of the sheets:
+    - the sheet rows are parsed in chunks of PARSE_CHUNK_SIZE rows, using a
+    process pool if opened, and if there are more than 
+    PARALLEL_PARSE_MIN_ROWS rows; errors and duplicate wells are collected in
+    sheet order, and raised as a ParseError at the end of the iteration.
+    - the rows are parsed in this process if the parser is not opened.
+    
+    NOTE: the process pool is created by "open", and must be closed by the 
+    caller (use "with"): the pool is not created on deserialization, so that
+    no worker processes are left if the load fails before the rows are 
+    parsed; and the pool is created on the calling thread, not when the rows
+    are first iterated: the rows may be iterated in another thread (see 
+    copy_stream.copy_from_generator), and forking from a thread while other 
+    threads hold locks (e.g. the logging locks) can deadlock the workers.
     '''
     
+    def __init__(self, parsed_columns, sheets, processes=None):
+        self.parsed_columns = parsed_columns
+        self.sheets = list(sheets)
+        if processes is None:
+            processes = get_parse_processes()
+        self.processes = processes
+        self.pool = None
+    
+    def open(self):
+        row_count = sum(max(sheet.nrows-1, 0) for sheet in self.sheets)
+        if (self.pool is None and self.processes > 1 
+                and row_count > PARALLEL_PARSE_MIN_ROWS):
+            logger.info('parse %d rows, using processes: %d', 
+                row_count, self.processes)
+            self.pool = multiprocessing.Pool(
+                self.processes, _init_parse_worker, (self.parsed_columns,))
+        return self
+    
+    def close(self):
+        if self.pool is not None:
+            self.pool.terminate()
+            self.pool.join()
+            self.pool = None
+    
+    def __enter__(self):
+        return self.open()
+    
+    def __exit__(self, *args):
+        self.close()
+    
+    def __iter__(self):
+        return _generate_result_values(
+            self.parsed_columns, self.sheets, self.pool, self.processes)
+    
+    def get_plate_numbers(self):
+        '''
+        Return the set of plate numbers of the result value sheets:
+        - only the "plate" column is read, the rows are not parsed
+        - values that are not valid plate numbers are skipped (these are 
+        reported when the rows are parsed)
+        '''
+        plate_numbers = set()
+        for sheet in self.sheets:
+            if sheet.nrows < 2:
+                continue
+            try:
+                header_row = result_value_field_mapper(
+                    sheet_rows(sheet).next(), self.parsed_columns)
+            except ValidationError:
+                continue
+            col = header_row.index('plate_number')
+            for ctype, value in zip(
+                    sheet.col_types(col, 1), sheet.col_values(col, 1)):
+                try:
+                    plate_number = parse_val(
+                        read_cell_string(ctype, value), 'plate_number', 
+                        'integer')
+                except (ValidationError, ValueError, TypeError):
+                    continue
+                if plate_number is not None:
+                    plate_numbers.add(plate_number)
+        return plate_numbers
+
+def _generate_result_values(parsed_columns, sheets, pool, processes):
+    
     logger.info('parse_result_values...')
     well_ids = set()
     parse_error = ParseError(errors={})
     def add_parse_error(sheet_name, validation_error):
+        add_parse_errors(sheet_name, validation_error.errors)
+    def add_parse_errors(sheet_name, errors):
         sheet_name = str(sheet_name)
         if not sheet_name in parse_error.errors:
             parse_error.errors[sheet_name] = {}
-        parse_error.errors[sheet_name].update(validation_error.errors)
+        parse_error.errors[sheet_name].update(errors)
     
-    for sheet in sheets:
-        logger.info('parse result values sheet: %r...', sheet.name)
+    sheet_chunks = _generate_sheet_chunks(
+        parsed_columns, sheets, add_parse_error)
+    if pool is not None:
+        parsed_chunks = _imap_chunks(pool, sheet_chunks, processes*2)
+    else:
+        _init_parse_worker(parsed_columns)
+        parsed_chunks = (
+            (sheet_name, _parse_result_rows_chunk(chunk)) 
+                for sheet_name, chunk in sheet_chunks)
     
-        rows = sheet_rows(sheet)
-        try:
-            header_row = result_value_field_mapper(rows.next(), parsed_columns)
-        except ValidationError, e:
-            logger.exception('error: %r', e)
-            add_parse_error(sheet.name, e)
-            continue
-        logger.info('output result values...')
-        for i,row in enumerate(rows):
-            try:
-                result = parse_result_row(
-                    i,parsed_columns,dict(zip(header_row,row)))
-                if DEBUG_IMPORTER:
-                    logger.info('parsed row: %d: %r',i,  result)
-                if result['well_id'] in well_ids:
-                    raise ParseError(
-                        key=result['well_id'],
-                        msg='duplicate')
-                well_ids.add(result['well_id'])
-                yield result
-            except ValidationError,e:
-                logger.exception('parse error: %r', e)
-                add_parse_error(sheet.name, e)
+    logger.info('output result values...')
+    for sheet_name, (keys, rows, errors) in parsed_chunks:
+        if errors:
+            add_parse_errors(sheet_name, errors)
+        for packed_row in rows:
+            result = { key: value 
+                for key, value in itertools.izip(keys, packed_row) 
+                    if value is not _Absent }
+            if result['well_id'] in well_ids:
+                logger.info('duplicate well: %r', result['well_id'])
+                add_parse_error(sheet_name, ParseError(
+                    key=result['well_id'],
+                    msg='duplicate'))
+                continue
+            well_ids.add(result['well_id'])
+            yield result
     if parse_error.errors:
         raise parse_error
 
@@ -0,0 +1,166 @@
+from __future__ import unicode_literals
+'''
+In-memory index of the well structure image files.
+
+Structure images are stored as PNG files in the settings.WELL_STRUCTURE_IMAGE_DIR:
+<WELL_STRUCTURE_IMAGE_DIR>/<plate>/<plate><well_name>.png
+
+The index records the files found in each plate directory, so that checking
+whether a structure image exists for a well is a set lookup, in place of
+fetching the image through the "well_image" view:
+- the index is built on first use (see db.apps.DbConfig to build it on startup),
+- it is refreshed when older than REFRESH_SECONDS; only the plate directories
+that have been modified (by directory mtime) are read again.
+'''
+
+import logging
+import os.path
+import threading
+import time
+
+from django.conf import settings
+from django.http.response import Http404
+from django.urls import resolve, Resolver404
+
+from db import WELL_ID_PATTERN
+
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_REFRESH_SECONDS = 300
+
+
+def get_structure_image_path(image_dir, plate, well_name):
+    ''' Return the path of the structure image file for the well '''
+    return os.path.join(
+        image_dir, plate, '%s%s.png' % (plate, well_name))
+
+
+class StructureImageIndex(object):
+    '''
+    Index of the structure image files in the image_dir, by plate directory.
+    '''
+    def __init__(self, image_dir, refresh_seconds=DEFAULT_REFRESH_SECONDS):
+        self.image_dir = os.path.abspath(image_dir)
+        self.refresh_seconds = refresh_seconds
+        # { plate: (directory mtime, set of file names) }
+        self._plates = {}
+        self._dir_mtime = None
+        self._refresh_time = None
+        self._lock = threading.Lock()
+
+    def refresh(self):
+        '''
+        Read the plate directories that have been added or modified since the
+        last refresh.
+        @return the number of plate directories read
+        '''
+        with self._lock:
+            start = time.time()
+            plates = dict(self._plates)
+            try:
+                dir_mtime = os.stat(self.image_dir).st_mtime
+                if dir_mtime != self._dir_mtime:
+                    plate_names = [name for name in os.listdir(self.image_dir)
+                        if os.path.isdir(os.path.join(self.image_dir, name))]
+                else:
+                    plate_names = plates.keys()
+            except OSError, e:
+                logger.warn('structure image dir can not be read: %r, %r',
+                    self.image_dir, e)
+                dir_mtime = None
+                plate_names = []
+
+            updated = {}
+            read_count = 0
+            for plate in plate_names:
+                plate_dir = os.path.join(self.image_dir, plate)
+                try:
+                    mtime = os.stat(plate_dir).st_mtime
+                    if plate in plates and plates[plate][0] == mtime:
+                        updated[plate] = plates[plate]
+                        continue
+                    updated[plate] = (mtime, frozenset(
+                        name for name in os.listdir(plate_dir)
+                            if name.endswith('.png')))
+                    read_count += 1
+                except OSError, e:
+                    logger.info('plate dir removed: %r, %r', plate_dir, e)
+
+            # Replace, so that lookups do not need the lock
+            self._plates = updated
+            self._dir_mtime = dir_mtime
+            self._refresh_time = time.time()
+            logger.info(
+                'structure image index: %r, plate dirs: %d, read: %d, '
+                'time: %0.2f s', self.image_dir, len(updated), read_count,
+                self._refresh_time-start)
+            return read_count
+
+    def _check_refresh(self):
+        if (self._refresh_time is None
+                or time.time()-self._refresh_time > self.refresh_seconds):
+            self.refresh()
+
+    def get_path(self, plate, well_name):
+        '''
+        Return the path of the structure image file for the well, or None if
+        it does not exist.
+        '''
+        self._check_refresh()
+        entry = self._plates.get(plate)
+        if entry is None:
+            return None
+        file_name = '%s%s.png' % (plate, well_name)
+        if file_name not in entry[1]:
+            return None
+        return os.path.join(self.image_dir, plate, file_name)
+
+    def get_path_for_well_id(self, well_id):
+        match = WELL_ID_PATTERN.match(well_id)
+        if not match:
+            return None
+        return self.get_path(match.group(1), match.group(2))
+
+    def __len__(self):
+        return sum(len(files) for (mtime, files) in self._plates.values())
+
+
+_index = None
+_index_lock = threading.Lock()
+
+def get_structure_image_index():
+    '''
+    Return the index for the settings.WELL_STRUCTURE_IMAGE_DIR, or None if it
+    is not set.
+    '''
+    global _index
+    image_dir = getattr(settings, 'WELL_STRUCTURE_IMAGE_DIR', None)
+    if not image_dir:
+        return None
+    with _index_lock:
+        if _index is None or _index.image_dir != os.path.abspath(image_dir):
+            _index = StructureImageIndex(
+                image_dir, refresh_seconds=getattr(
+                    settings, 'STRUCTURE_IMAGE_INDEX_REFRESH_SECONDS',
+                    DEFAULT_REFRESH_SECONDS))
+    return _index
+
+def structure_image_file_resolver(uri):
+    '''
+    Image file resolver (see reports.serialize.register_image_file_resolver)
+    for "well_image" uris.
+    '''
+    try:
+        match = resolve(uri)
+    except Resolver404:
+        return None
+    if match.url_name != 'well_image':
+        return None
+    index = get_structure_image_index()
+    if index is None:
+        return None
+    path = index.get_path_for_well_id(match.kwargs['well_id'])
+    if path is None:
+        raise Http404('no structure image for: %r' % uri)
+    return path
@@ -4,24 +4,37 @@ import cStringIO
 from collections import OrderedDict, defaultdict
 import copy
 import csv
+from datetime import timedelta
 from decimal import Decimal
 import filecmp
+import importlib
 import io
 import json
 import logging
+import multiprocessing
 import os
 import random
 import re
+import shutil
 import string
 import sys
+import tempfile
+import threading
+import time
+from zipfile import ZipFile
 
 from django.conf import settings
 from django.contrib.auth.models import User
 from django.core.exceptions import ObjectDoesNotExist
 from django.db import connection
-from django.test import TestCase
+from django.http.response import Http404
+from django.test import TestCase, RequestFactory, override_settings
 from django.test.client import MULTIPART_CONTENT
 from django.urls import resolve
+from PIL import Image
+import sqlalchemy
+from sqlalchemy.dialects import postgresql
+from sqlalchemy.sql import select, func, literal_column
 import xlrd
 import xlsxwriter
 
@@ -57,10 +70,12 @@ from db.support import lims_utils, screen_result_importer, bin_packer
 from db.support.plate_matrix_transformer import Collation, Counter
 import db.support.plate_matrix_transformer
 import db.support.raw_data_reader
+from db.support.structure_image_index import StructureImageIndex, \
+    structure_image_file_resolver
 from db.test.factories import LibraryFactory, ScreenFactory, \
     ScreensaverUserFactory, LabAffiliationFactory
 from reports import ValidationError, HEADER_APILOG_COMMENT, _now, \
-    API_RESULT_ERROR, HTTP_PARAM_AUTH, DJANGO_ACCEPT_PARAM
+    API_RESULT_ERROR, HTTP_PARAM_AUTH, DJANGO_ACCEPT_PARAM, ParseError
 from reports.api import API_RESULT_META, API_PARAM_OVERRIDE, API_RESULT_OBJ, \
     API_PARAM_PATCH_PREVIEW_MODE, API_PARAM_SHOW_PREVIEW
 from reports.models import ApiLog, UserProfile, UserGroup, Vocabulary
@@ -71,6 +86,8 @@ from reports.serializers import CSVSerializer, XLSSerializer, LimsSerializer, \
 from reports.tests import IResourceTestCase, equivocal, TestApiClient
 from reports.tests import assert_obj1_to_obj2, find_all_obj_in_list, \
     find_obj_in_list, find_in_dict
+from reports.utils.result_cache import get_result_cache, get_tagged, \
+    invalidate_tables
 
 
 # SCHEMA imports
@@ -1172,9 +1189,118 @@ class LibraryResource(DBResourceTestCase):
                         'k: %r %r != %r' % (k, v,v2))
             
     
+    def _load_compound_search_library(self):
+        ''' Load the small molecule test library for the compound search '''
+        
+        library_item = self.create_library({ 
+            START_PLATE: '1536', 
+            END_PLATE: '1536', 
+            'plate_size': '384',
+            SCREEN_TYPE: 'small_molecule' })
+        resource_uri = '/'.join([
+            BASE_URI_DB,'library', library_item['short_name'],'well'])
+        filename = (
+            '%s/db/static/test_data/libraries/clean_data_small_molecule.sdf'
+                % APP_ROOT_DIR )
+        with open(filename) as input_file:
+            input_data = self.serializer.from_sdf(input_file.read())
+            resp = self.api_client.put(
+                resource_uri, format='sdf', data=input_data[API_RESULT_DATA], 
+                authentication=self.get_credentials(), 
+                **{ 'limit': 0, DJANGO_ACCEPT_PARAM: JSON_MIMETYPE })
+            self.assertTrue(
+                resp.status_code in [200], 
+                (resp.status_code, self.get_content(resp)))
+    
+    def _compound_search(self, search_data, **params):
+        ''' @return the well_ids found by the compound search '''
+        search_uri = '/'.join([BASE_URI_DB, 'reagent', 'compound_search'])
+        params.update({ 'limit': 0, SCHEMA.API_PARAM_SEARCH: search_data })
+        resp = self.api_client.get(
+            search_uri, format='json', 
+            authentication=self.get_credentials(), data=params)
+        self.assertTrue(
+            resp.status_code in [200], 
+            (resp.status_code, self.get_content(resp)))
+        return [x['well_id'] for x in self.deserialize(resp)[API_RESULT_DATA]]
+    
     def test_c_reagent_compound_name_vendor_search(self):
-        # TODO
-        pass
+        
+        self._load_compound_search_library()
+        search = self._compound_search
+        
+        # 1. "contains" (default): compound names containing the search line, 
+        # vendor identifiers equal to the search line; exact matches first
+        self.assertEqual(
+            search('compound name 2'), ['01536:A01', '01536:A03'])
+        self.assertEqual(
+            search('FAKE COMPOUND NAME 3\nST0012'), ['01536:A04'])
+        self.assertEqual(
+            search('fake compound name 1\ncompound'),
+            ['01536:A01', '01536:A02', '01536:A03', '01536:A04', '01536:A05'])
+        
+        # 2. "starts_with"
+        self.assertEqual(
+            search('ST0012', search_mode='starts_with'), 
+            ['01536:A02', '01536:A04'])
+        self.assertEqual(
+            search('fake compound name 4\nst000077\ncompound', 
+                search_mode='starts_with'), 
+            ['01536:A03', '01536:A05'])
+        
+        # 3. result limit: best ranked first
+        self.assertEqual(
+            search('fake compound name 1\ncompound', search_limit=3),
+            ['01536:A01', '01536:A02', '01536:A03'])
+        
+        # 4. invalid mode; "fuzzy" is invalid if pg_trgm is not installed
+        search_uri = '/'.join([BASE_URI_DB, 'reagent', 'compound_search'])
+        invalid_modes = ['regex']
+        if not db.api.WellResource.is_pg_trgm_installed():
+            invalid_modes.append('fuzzy')
+        for search_mode in invalid_modes:
+            resp = self.api_client.get(
+                search_uri, format='json', 
+                authentication=self.get_credentials(), 
+                data={ 
+                    SCHEMA.API_PARAM_SEARCH: 'ST0012', 
+                    'search_mode': search_mode })
+            self.assertTrue(
+                resp.status_code == 400, 
+                (search_mode, resp.status_code, self.get_content(resp)))
+        
+        # 5. the "fuzzy" query renders the pg_trgm similarity operator "%" 
+        # (see test_c1_reagent_compound_name_fuzzy_search)
+        query = db.api.WellResource.create_vendor_compound_name_base_query(
+            'fake compund name 3', search_mode='fuzzy')
+        compiled = query.compile(dialect=postgresql.psycopg2.dialect())
+        with connection.cursor() as cursor:
+            sql = cursor.mogrify(str(compiled), compiled.params)
+        self.assertTrue(
+            "lower(small_molecule_compound_name.compound_name) % "
+                "'fake compund name 3'" in sql, sql)
+    
+    def test_c1_reagent_compound_name_fuzzy_search(self):
+        
+        with connection.cursor() as cursor:
+            cursor.execute(
+                "select count(*) from pg_available_extensions "
+                "where name = 'pg_trgm'")
+            if cursor.fetchone()[0] == 0:
+                self.skipTest('pg_trgm extension is not available')
+            # Note: migrations are not run for the test database
+            cursor.execute('CREATE EXTENSION IF NOT EXISTS pg_trgm')
+        self._load_compound_search_library()
+        search = self._compound_search
+        
+        self.assertEqual(search('fake compund name 3'), [])
+        found = search('fake compund name 3', search_mode='fuzzy')
+        self.assertEqual(found[0], '01536:A04', found)
+        self.assertTrue(
+            set(['01536:A01', '01536:A02', '01536:A03', '01536:A05'])
+                <= set(found), found)
+        found = search('ST001244', search_mode='fuzzy')
+        self.assertTrue('01536:A04' in found, found)
     
     def test_a_plate_search_parser(self):
         
@@ -3027,6 +3153,24 @@ class LibraryResource(DBResourceTestCase):
                                 "pubchem_cid", "vendor_identifier", 
                                 "vendor_batch_id", "compound_name", "smiles"]))
             # TODO: check parent_log - library log/ version
+        
+        # Test 3: resubmit the update file: the wells are unchanged
+        reagents = Reagent.objects.filter(
+            well__library__short_name=library_item['short_name'])
+        self.assertTrue(reagents.exists())
+        self.assertFalse(reagents.filter(content_digest__isnull=True).exists())
+        resource_uri = '/'.join([
+            BASE_URI_DB,'library', library_item['short_name'],'well'])
+        data_for_get[DJANGO_ACCEPT_PARAM] = JSON_MIMETYPE
+        resp = self.api_client.patch(
+            resource_uri, format='sdf', data=input_data, 
+            authentication=self.get_credentials(), **data_for_get )
+        self.assertTrue(
+            resp.status_code in [400], 
+            (resp.status_code, self.get_content(resp)))
+        errors = self.deserialize(resp)['errors']
+        logger.info('resubmit errors: %r', errors)
+        self.assertEqual(errors[SCHEMA.API_MSG_UNCHANGED], 4, errors)
     
     
     def test6a_load_dirty_small_molecule_file(self):
@@ -3058,22 +3202,22 @@ class LibraryResource(DBResourceTestCase):
                 u'library_well_type': 
                     [u"'experimentalxxx' is not one of "
                         "[u'undefined', u'experimental', u'empty', u'dmso', u'library_control', u'rnai_buffer']"], 
-                u'line': 131}],
+                u'line': 176}],
             [u'01536:A04', {
                 u'pubchem_cid': [u"parse error: invalid literal for int() with base 10: '558309aaa'"], 
-                u'line': 208}],
+                u'line': 273}],
             [u'01536:A06', {
-                u'line': 388, 
+                u'line': 493, 
                 u'chembank_id': [u"parse error: invalid literal for int() with base 10: '1665724aa'"]}],
             [u'01536:A08', {
-                u'line': 471, 
+                u'line': 595, 
                 u'molecular_mass': [u"parse error: Invalid literal for Decimal: u'bbb368.46602'"]}],
             [u'01536:A09', {
-                u'line: 607': u'duplicate', 
+                u'line: 772': u'duplicate', 
                 u'library_well_type': [u"'void' is not one of "
                     "[u'undefined', u'experimental', u'empty', u'dmso', u'library_control', u'rnai_buffer']"], 
-                u'line': 576}],              
-            [u'line: 301', {
+                u'line': 722}],              
+            [u'line: 386', {
                 u'well_id': u'required'}]]
 
         logger.info('Open and PUT file: %r', filename)
@@ -3826,6 +3970,77 @@ class ScreenResultSerializerTest(TestCase):
             self.assertTrue('plate_number is required' in error)
             self.assertTrue('well_name is required' in error)
 
+    def test5_parallel_parse(self):
+        ''' Test parsing the result value sheets in a process pool '''
+        
+        file = 'ScreenResultTest_1_valid.xlsx'
+        filename = '%s/db/static/test_data/screens/%s' %(APP_ROOT_DIR,file)
+        wb = xlrd.open_workbook(filename)
+        sheets = [wb.sheet_by_index(i) for i in range(wb.nsheets)]
+        columns = screen_result_importer.parse_columns(
+            screen_result_importer.data_column_generator(
+                xlsutils.sheet_cols(sheets[1])))
+        data_sheet = sheets[2]
+        
+        serial_rows = list(screen_result_importer.parse_result_values(
+            columns, [data_sheet], processes=1))
+        self.assertEqual(len(serial_rows), data_sheet.nrows-1)
+        
+        chunk_size = screen_result_importer.PARSE_CHUNK_SIZE
+        min_rows = screen_result_importer.PARALLEL_PARSE_MIN_ROWS
+        screen_result_importer.PARSE_CHUNK_SIZE = 100
+        screen_result_importer.PARALLEL_PARSE_MIN_ROWS = 0
+        try:
+            # No pool is created until the parser is opened
+            result_values = screen_result_importer.parse_result_values(
+                columns, [data_sheet], processes=2)
+            self.assertIsNone(result_values.pool)
+            with result_values:
+                self.assertIsNotNone(result_values.pool)
+                parallel_rows = list(result_values)
+            self.assertEqual(parallel_rows, serial_rows)
+            self.assertIsNone(result_values.pool)
+            self.assertEqual(
+                result_values.get_plate_numbers(), 
+                set(int(row['well_id'].split(':')[0]) for row in serial_rows))
+            self.assertEqual(multiprocessing.active_children(), [])
+            
+            # The pool is created by "open", so that the rows may be 
+            # generated in another thread (see copy_from_generator)
+            thread_rows = []
+            with screen_result_importer.parse_result_values(
+                    columns, [data_sheet], processes=2) as result_values:
+                thread = threading.Thread(
+                    target=lambda: thread_rows.extend(result_values))
+                thread.start()
+                thread.join(60)
+            self.assertEqual(thread_rows, serial_rows)
+            
+            # The workers are terminated if the rows are not all parsed
+            with screen_result_importer.parse_result_values(
+                    columns, [data_sheet], processes=2) as result_values:
+                iter(result_values).next()
+            self.assertEqual(multiprocessing.active_children(), [])
+            
+            # Duplicate wells are detected across sheets
+            parsed_rows = []
+            with self.assertRaises(ParseError) as context:
+                with screen_result_importer.parse_result_values(
+                        columns, [data_sheet, data_sheet], processes=2) \
+                        as result_values:
+                    for row in result_values:
+                        parsed_rows.append(row)
+            self.assertEqual(parsed_rows, serial_rows)
+            errors = context.exception.errors
+            logger.info('duplicate errors: %d', len(errors[data_sheet.name]))
+            self.assertEqual(
+                len(errors[data_sheet.name]), len(serial_rows))
+            self.assertEqual(
+                errors[data_sheet.name][serial_rows[0]['well_id']], 
+                ['duplicate'])
+        finally:
+            screen_result_importer.PARSE_CHUNK_SIZE = chunk_size
+            screen_result_importer.PARALLEL_PARSE_MIN_ROWS = min_rows
             
     @staticmethod
     def validate(testinstance,input_data,output_data):
@@ -3965,6 +4180,71 @@ class ScreenResultSerializerTest(TestCase):
                         % (key, val, val2, msg, input_rv, found_row))
             if i == items_to_test:
                 break
+
+
+class StructureImageIndexTest(TestCase):
+    ''' Test the structure image index used for exports '''
+    
+    def setUp(self):
+        self.image_dir = tempfile.mkdtemp()
+        
+    def tearDown(self):
+        shutil.rmtree(self.image_dir)
+    
+    def _write_image(self, plate, well_name):
+        plate_dir = os.path.join(self.image_dir, plate)
+        if not os.path.exists(plate_dir):
+            os.mkdir(plate_dir)
+        path = os.path.join(plate_dir, '%s%s.png' % (plate, well_name))
+        Image.new('RGB', (40, 20), 'white').save(path, 'PNG')
+        return path
+        
+    def test1_index(self):
+        
+        path = self._write_image('00001', 'A01')
+        self._write_image('00001', 'A02')
+        
+        index = StructureImageIndex(self.image_dir)
+        self.assertEqual(index.refresh(), 1)
+        self.assertEqual(len(index), 2)
+        self.assertEqual(index.get_path('00001', 'A01'), path)
+        self.assertEqual(index.get_path_for_well_id('00001:A01'), path)
+        self.assertIsNone(index.get_path('00001', 'A03'))
+        self.assertIsNone(index.get_path('00002', 'A01'))
+        self.assertIsNone(index.get_path_for_well_id('restricted'))
+        
+        # Only modified plate directories are read on refresh
+        path2 = self._write_image('00002', 'A01')
+        os.utime(self.image_dir, (0, 0))
+        self.assertEqual(index.refresh(), 1)
+        self.assertEqual(index.get_path('00002', 'A01'), path2)
+        self.assertEqual(index.refresh(), 0)
+        
+    def test2_export_image(self):
+        
+        path = self._write_image('00001', 'A01')
+        with io.open(path, 'rb') as image_file:
+            image_bytes = image_file.read()
+        
+        with self.settings(WELL_STRUCTURE_IMAGE_DIR=self.image_dir):
+            self.assertEqual(
+                structure_image_file_resolver('/db/well_image/00001:A01'), 
+                path)
+            with self.assertRaises(Http404):
+                structure_image_file_resolver('/db/well_image/00001:A02')
+            self.assertIsNone(structure_image_file_resolver('/db/'))
+            
+            # The XLSX embeds the file bytes, the view is not called
+            request = RequestFactory().get('/db/api/v1/reagent')
+            output = io.BytesIO()
+            workbook = xlsxwriter.Workbook(output)
+            sheet = workbook.add_worksheet()
+            xlsutils.write_xls_image(sheet, 0, 0, '/db/well_image/00001:A01', request)
+            workbook.close()
+            with ZipFile(output) as zip_file:
+                self.assertEqual(
+                    zip_file.read('xl/media/image1.png'), image_bytes)
+
                 
 class ScreenResultResource(DBResourceTestCase):
 
@@ -4139,6 +4419,48 @@ class ScreenResultResource(DBResourceTestCase):
             self.get_content(resp), XLSX_MIMETYPE)
         
         ScreenResultSerializerTest.validate(self, input_data, output_data)    
+        
+        # The data columns are read from the result_matrix
+        screen_result = db.models.ScreenResult.objects.get(
+            screen__facility_id=screen['facility_id'])
+        positions = db.api.ScreenResultResource()\
+            .get_result_matrix_positions(screen_result)
+        self.assertEqual(
+            len(positions), screen_result.datacolumn_set.all().count())
+        with connection.cursor() as cursor:
+            cursor.execute(
+                'select count(*) from result_matrix '
+                'where screen_result_id = %s', 
+                [screen_result.screen_result_id])
+            self.assertEqual(cursor.fetchone()[0], 
+                screen_result.assaywell_set.all().count())
+        
+        # The migration backfills the result_matrix of existing screen results
+        result_matrix_migration = importlib.import_module(
+            'db.migrations.0102_result_matrix')
+        with connection.cursor() as cursor:
+            cursor.execute(
+                'select well_id, numeric_values, text_values '
+                'from result_matrix where screen_result_id = %s '
+                'order by well_id', [screen_result.screen_result_id])
+            matrix_rows = cursor.fetchall()
+            cursor.execute(
+                'DELETE FROM result_matrix WHERE screen_result_id = %s; '
+                'DELETE FROM result_matrix_layout '
+                'WHERE screen_result_id = %s; ', 
+                [screen_result.screen_result_id]*2)
+            self.assertTrue(
+                result_matrix_migration.backfill_result_matrix(cursor) >= 1)
+            cursor.execute(
+                'select well_id, numeric_values, text_values '
+                'from result_matrix where screen_result_id = %s '
+                'order by well_id', [screen_result.screen_result_id])
+            self.assertEqual(cursor.fetchall(), matrix_rows)
+            self.assertEqual(
+                result_matrix_migration.backfill_result_matrix(cursor), 0)
+        self.assertEqual(
+            db.api.ScreenResultResource()\
+                .get_result_matrix_positions(screen_result), positions)
     
     def _create_valid_input(self, screen_facility_id):
         # create data as already parsed input
@@ -4352,6 +4674,18 @@ class ScreenResultResource(DBResourceTestCase):
         self.assertTrue(screen[key]==expected_value,
             (key,'expected_value',expected_value,
                 'returned value',screen[key]))
+        # The loading statistics accumulated during the load match the 
+        # statistics of the loaded data
+        screen_result = db.models.ScreenResult.objects.get(
+            screen__facility_id=screen_facility_id)
+        self.assertEqual(
+            screen_result.experimental_well_count,
+            screen_result.assaywell_set.filter(
+                well__library_well_type='experimental').count())
+        self.assertEqual(
+            screen_result.replicate_count,
+            max(max([dc.replicate_ordinal or 0 
+                for dc in screen_result.datacolumn_set.all()]), 1))
         key = 'library_plates_data_loaded'
         expected_value = 1
         self.assertTrue(screen[key]==expected_value,
@@ -4585,6 +4919,43 @@ class ScreenResultResource(DBResourceTestCase):
         # NOTE: Further testing of mutual column field visibilty in the 
         # DataSharingLevel tests
         
+        # Verify that the positive index is maintained for each screen
+        screen1_id = Screen.objects.get(
+            facility_id=self.screen1['facility_id']).screen_id
+        screen2_id = Screen.objects.get(
+            facility_id=self.screen2['facility_id']).screen_id
+        sql = (
+            'select screen_id, count(*) from well_data_column_positive_index '
+            'group by screen_id')
+        with connection.cursor() as cursor:
+            cursor.execute(sql)
+            index_counts = dict(cursor.fetchall())
+        logger.info('positive index counts: %r', index_counts)
+        self.assertTrue(index_counts.get(screen1_id) > 0, index_counts)
+        self.assertTrue(index_counts.get(screen2_id) > 0, index_counts)
+        
+        logger.info('delete the second screen result...')
+        resp = self.api_client.delete(
+            resource_uri, authentication=self.get_credentials())
+        self.assertTrue(resp.status_code in [204], resp.status_code)
+        with connection.cursor() as cursor:
+            cursor.execute(sql)
+            counts_after_delete = dict(cursor.fetchall())
+        self.assertEqual(
+            counts_after_delete, { screen1_id: index_counts[screen1_id] })
+        
+        # Verify that the screen_overlap is maintained for the screen
+        with connection.cursor() as cursor:
+            cursor.execute(
+                'select count(*) from screen_overlap '
+                'where screen_id = %s or overlap_screen_id = %s', 
+                [screen2_id, screen2_id])
+            self.assertEqual(cursor.fetchone()[0], 0)
+        screen1 = self.get_screen(
+            self.screen1['facility_id'], { 'includes': '*' })
+        self.assertFalse(self.screen2['facility_id'] in 
+            (screen1.get(SCREEN.OVERLAPPING_POSITIVE_SCREENS, None) or []))
+        
     def test4_result_value_errors_from_file(self):
         
         logger.info('test4_result_value_errors_from_file...')
@@ -5133,6 +5504,341 @@ class ScreenResultResource(DBResourceTestCase):
             self.assertTrue(expected_empty_error_well in errors)
             self.assertTrue('non experimental well, not considered for positives' 
                 in errors[expected_empty_error_well][0])
+
+    def test8_missing_wells(self):
+        '''
+        Wells not found are reported in one error
+        '''
+        self._setup_test_config()
+        logger.info('test8_missing_wells...')
+
+        screen = self.create_screen({ SCREEN_TYPE: 'small_molecule' })
+        
+        fields = {
+            'E': {
+                'ordinal': 0,
+                'name': 'Field1',
+                'data_worksheet_column': 'E',
+                'data_type': 'numeric',
+                'decimal_places': 2, 
+                'description': 'field 1 description',
+                'replicate_ordinal': 1,
+            },
+        }
+        # Well names that are not in the canonical form are not found
+        result_values = [
+            { 'well_id': '00001:A01', 'E': 1.1 },
+            { 'well_id': '00999:A01', 'E': 1.2 },
+            { 'well_id': '00001:a03', 'E': 1.5 },
+            { 'well_id': '00001:A02', 'E': 1.3 },
+            { 'well_id': '00999:B02', 'E': 1.4 },
+            { 'well_id': '00001:A4', 'E': 1.6 },
+        ]
+        expected_missing = ['00999:A01', '00001:a03', '00999:B02', '00001:A4']
+        input_data_put = screen_result_importer.create_output_data(
+            screen[SCHEMA.SCREEN.FACILITY_ID], 
+            fields, 
+            result_values )
+        input_data_put = self.sr_serializer.serialize(
+            input_data_put, XLSX_MIMETYPE)
+        data_for_get = {}
+        data_for_get[HTTP_PARAM_AUTH] = self.get_credentials()
+        data_for_get['CONTENT_TYPE'] = XLSX_MIMETYPE
+        data_for_get[DJANGO_ACCEPT_PARAM] = JSON_MIMETYPE
+        resource_uri = '/'.join([
+            BASE_URI_DB,'screenresult',screen['facility_id']])
+        resp = self.django_client.put(
+            resource_uri, data=input_data_put, **data_for_get )
+        
+        self.assertTrue(
+            resp.status_code == 400, resp.status_code)
+        content = self.deserialize(resp)
+        logger.info('content; %r', content)
+        
+        self.assertTrue('errors' in content)
+        errors = content['errors']
+        self.assertTrue('well_id' in errors, errors)
+        for well_id in expected_missing:
+            self.assertTrue(well_id in json.dumps(errors['well_id']), 
+                (well_id, errors))
+        self.assertTrue('(4)' in json.dumps(errors['well_id']), errors)
+        
+        # Only the wells of the plates of the load are fetched
+        well_map = db.api.ResultWellMap()
+        with connection.cursor() as cursor:
+            well_map.fetch(cursor, 'small_molecule', [1, 999])
+        self.assertEqual(well_map.plates.keys(), [1])
+        self.assertIsNotNone(well_map.get('00001:A03'))
+        self.assertIsNone(well_map.get('00001:a03'))
+        self.assertIsNone(well_map.get('1:A03'))
+        
+        # Only the count and the first wells not found are reported
+        max_missing_wells = db.api.MAX_MISSING_WELLS_TO_REPORT
+        db.api.MAX_MISSING_WELLS_TO_REPORT = 1
+        try:
+            resp = self.django_client.put(
+                resource_uri, data=input_data_put, **data_for_get )
+        finally:
+            db.api.MAX_MISSING_WELLS_TO_REPORT = max_missing_wells
+        self.assertTrue(
+            resp.status_code == 400, resp.status_code)
+        errors = self.deserialize(resp)['errors']
+        logger.info('errors; %r', errors)
+        error = json.dumps(errors['well_id'])
+        self.assertTrue('(4)' in error, errors)
+        self.assertTrue(expected_missing[0] in error, errors)
+        self.assertFalse(expected_missing[1] in error, errors)
+        self.assertTrue('first 1 shown' in error, errors)
+
+    def test9_cached_query_eviction(self):
+        ''' Test the well_query_index cached query eviction policies '''
+        
+        resource = db.api.ScreenResultResource()
+        now = _now()
+        # Cached queries of 100 wells, accessed in order; "old" has the most
+        # hits
+        queries = {}
+        for i, name in enumerate(['old', 'middle', 'recent']):
+            queries[name] = db.models.CachedQuery.objects.create(
+                key=name, sql='select 1', uri='/screenresult/%s' % name,
+                username='testuser', count=100,
+                last_accessed=now - timedelta(hours=3-i),
+                hit_count=10 if name == 'old' else 1)
+        
+        with override_settings(WELL_QUERY_INDEX_EVICTION_POLICY='lru'):
+            evicted = resource.get_cached_queries_to_evict(250)
+            self.assertEqual(
+                [query_id for query_id,count in evicted], 
+                [queries['old'].id])
+            evicted = resource.get_cached_queries_to_evict(
+                250, keep_id=queries['old'].id)
+            self.assertEqual(
+                [query_id for query_id,count in evicted], 
+                [queries['middle'].id])
+        with override_settings(WELL_QUERY_INDEX_EVICTION_POLICY='lfu'):
+            evicted = resource.get_cached_queries_to_evict(250)
+            self.assertEqual(
+                [query_id for query_id,count in evicted], 
+                [queries['middle'].id])
+        
+        with override_settings(
+                WELL_QUERY_INDEX_EVICTION_POLICY='lfu', 
+                MAX_WELL_INDEXES_TO_CACHE=150):
+            resource.clear_cache(None, by_size=True)
+        self.assertEqual(
+            [x.id for x in db.models.CachedQuery.objects.all()], 
+            [queries['old'].id])
+        
+        resp = self.api_client.get(
+            '/'.join([BASE_URI_DB, 'screenresult', 'cache_stats']), 
+            authentication=self.get_credentials(), format='json')
+        self.assertTrue(resp.status_code == 200, resp.status_code)
+        stats = self.deserialize(resp)
+        logger.info('cache stats: %r', stats)
+        well_query_stats = stats['well_query_index']
+        self.assertEqual(well_query_stats['entries'], 1)
+        self.assertEqual(well_query_stats['wells'], 100)
+        self.assertEqual(well_query_stats['stored_hits'], 10)
+        self.assertEqual(
+            well_query_stats['eviction_history'][0]['evicted_queries'], 2)
+        
+    def test10_well_query_backends(self):
+        '''
+        Compare the "table" and "cache" well query backends on a (synthetic)
+        1M well query
+        '''
+        resource = db.api.ScreenResultResource()
+        well_count = 1000000
+        # 1M well_ids, in descending order (not the natural order)
+        _n = func.generate_series(well_count, 1, -1).alias('n')
+        base_stmt = select([
+            func.concat(
+                func.lpad(sqlalchemy.cast(literal_column('n')/384, 
+                    sqlalchemy.Text), 5, '0'), 
+                ':', sqlalchemy.cast(literal_column('n') % 384, sqlalchemy.Text))
+            .label('well_id')]).select_from(_n)
+        base_stmt = base_stmt.order_by(literal_column('n').desc())
+        
+        get_result_cache('screen_cache').clear()
+        timings = {}
+        pages = {}
+        for backend in ['table', 'cache']:
+            with override_settings(WELL_QUERY_INDEX_BACKEND=backend):
+                if backend == 'cache':
+                    create_cached_query = resource.create_cached_well_set
+                else:
+                    create_cached_query = lambda stmt, facility_id: \
+                        resource.create_cached_well_query(
+                            stmt, {}, facility_id, 'testuser')
+                start = time.time()
+                cached_query = create_cached_query(base_stmt, 'bench')
+                timings[backend] = time.time() - start
+                self.assertEqual(cached_query.count, well_count)
+                
+                start = time.time()
+                cached_query = create_cached_query(base_stmt, 'bench')
+                timings['%s_reuse' % backend] = time.time() - start
+                
+                _wqx = resource.build_well_query_page(
+                    cached_query, 25, 500000)
+                # compile, as for the debug log
+                str(select([_wqx.c.well_id]).compile(
+                    dialect=postgresql.dialect(),
+                    compile_kwargs={"literal_binds": True}))
+                with db.api.get_engine().connect() as conn:
+                    pages[backend] = [row[0] for row in conn.execute(
+                        select([_wqx.c.well_id]).order_by(_wqx.c.id))]
+        logger.info('well query backend timings (seconds): %r', timings)
+        self.assertEqual(len(pages['table']), 25)
+        self.assertEqual(pages['table'], pages['cache'])
+        self.assertEqual(
+            pages['cache'][0], '%05d:%d' % ((well_count-500000)/384, 
+                (well_count-500000) % 384))
+        # no well_query_index rows are written by the "cache" backend
+        self.assertEqual(db.models.CachedQuery.objects.count(), 1)
+        
+        # A page reads only the blocks that it spans; evicted blocks are 
+        # stored again
+        cache = get_result_cache('screen_cache')
+        cached_query = resource.create_cached_well_set(base_stmt, 'bench')
+        block_size = db.api.WELL_SET_BLOCK_SIZE
+        page_block_key = '%s_%d' % (cached_query.key, 500000//block_size)
+        first_block_key = '%s_0' % cached_query.key
+        cache.delete(first_block_key)
+        well_ids = resource.get_cached_well_set_page(cached_query, 25, 500000)
+        self.assertEqual(well_ids, pages['cache'])
+        self.assertIsNone(cache.get(first_block_key))
+        cache.delete(page_block_key)
+        well_ids = resource.get_cached_well_set_page(cached_query, 25, 500000)
+        self.assertEqual(well_ids, pages['cache'])
+        self.assertIsNotNone(cache.get(first_block_key))
+        # A page spanning blocks, and the end of the set
+        well_ids = resource.get_cached_well_set_page(
+            cached_query, 10, block_size-5)
+        self.assertEqual(len(well_ids), 10)
+        self.assertEqual(
+            well_ids[5], '%05d:%d' % ((well_count-block_size)/384, 
+                (well_count-block_size) % 384))
+        well_ids = resource.get_cached_well_set_page(
+            cached_query, 25, well_count-5)
+        self.assertEqual(len(well_ids), 5)
+        self.assertEqual(
+            resource.get_cached_well_set_page(cached_query, 25, well_count), [])
+        
+        # The well set is evicted by writes to the tables it reads from (the 
+        # synthetic query reads no tables, and is evicted by any write)
+        self.assertEqual(get_tagged(cache, cached_query.key), well_count)
+        invalidate_tables(['well'])
+        self.assertIsNone(get_tagged(cache, cached_query.key))
+        
+        # The "cache" backend requires the shared result cache, so that the
+        # well sets are evicted for all server processes
+        with override_settings(WELL_QUERY_INDEX_BACKEND='cache'):
+            self.assertEqual(resource.get_well_query_backend(), 'table')
+            with override_settings(USE_SHARED_RESULT_CACHE=True):
+                self.assertEqual(resource.get_well_query_backend(), 'cache')
+
+
+class ResultValuePartitionResource(DBResourceTestCase):
+    '''
+    Test loading, replacing and deleting a screen result with the 
+    result_value and assay_well tables partitioned by screen result:
+    - the tables are partitioned in setUp 
+    (db/migrations/manual/result_value_partition.sql) and restored in tearDown
+    (db/migrations/manual/result_value_unpartition.sql), so that other tests
+    are run with the unpartitioned tables
+    - the screen result is loaded with the ScreenResultResource test 
+    '''
+    
+    def setUp(self):
+        if connection.pg_version < 110000:
+            self.skipTest(
+                'partitioned tables require PostgreSQL >= 11: %r' 
+                % connection.pg_version)
+        super(ResultValuePartitionResource, self).setUp()
+        self.screen_result_test = \
+            ScreenResultResource('test2_load_valid_input')
+        self.screen_result_test.setUp()
+        self._run_manual_script('result_value_partition.sql')
+
+    def tearDown(self):
+        logger.info('=== tearDown...')
+        try:
+            self.screen_result_test.tearDown()
+        finally:
+            resource = db.api.ScreenResultResource()
+            if resource.is_result_value_partitioned():
+                self._run_manual_script('result_value_unpartition.sql')
+            self.assertFalse(resource.is_result_value_partitioned())
+        DBResourceTestCase.tearDown(self)
+    
+    def _run_manual_script(self, script_name):
+        script = os.path.join(
+            APP_ROOT_DIR, 'db', 'migrations', 'manual', script_name)
+        logger.info('run: %r', script)
+        with open(script) as f:
+            with connection.cursor() as cursor:
+                cursor.execute(f.read())
+        
+    def test1_partitioned_result_values(self):
+        
+        resource = db.api.ScreenResultResource()
+        self.assertTrue(resource.is_result_value_partitioned())
+        
+        def get_partitions():
+            with connection.cursor() as cursor:
+                cursor.execute(
+                    'select parent.relname, child.relname '
+                    'from pg_inherits '
+                    'join pg_class parent on parent.oid=inhparent '
+                    'join pg_class child on child.oid=inhrelid '
+                    "where parent.relname in ('result_value', 'assay_well') "
+                    'order by child.relname')
+                return [child for (parent, child) in cursor.fetchall()]
+        
+        self.screen_result_test.test2_load_valid_input()
+        screen_facility_id = self.screen_result_test.screen1['facility_id']
+        screen_result = db.models.ScreenResult.objects.get(
+            screen__facility_id=screen_facility_id)
+        (rv_partition, aw_partition) = resource.get_result_partition_names(
+            screen_result.screen_result_id)
+        self.assertEqual(get_partitions(), [aw_partition, rv_partition])
+        result_value_count = db.models.ResultValue.objects.filter(
+            data_column__screen_result=screen_result).count()
+        self.assertTrue(result_value_count > 0)
+        
+        logger.info('replace the screen result...')
+        input_data = self.screen_result_test._create_valid_input(
+            screen_facility_id)
+        input_data_put = self.sr_serializer.serialize(
+            screen_result_importer.create_output_data(
+                screen_facility_id, input_data['fields'], 
+                input_data['objects']), 
+            XLSX_MIMETYPE)
+        data_for_put = { 
+            HTTP_PARAM_AUTH: self.get_credentials(),
+            'CONTENT_TYPE': XLSX_MIMETYPE, 
+            DJANGO_ACCEPT_PARAM: XLSX_MIMETYPE }
+        resource_uri = '/'.join([
+            BASE_URI_DB, 'screenresult', screen_facility_id])
+        resp = self.django_client.put(
+            resource_uri, data=input_data_put, **data_for_put)
+        self.assertTrue(resp.status_code in [200, 204], resp.status_code)
+        self.assertEqual(get_partitions(), [aw_partition, rv_partition])
+        self.assertEqual(
+            db.models.ResultValue.objects.count(), result_value_count)
+        self.assertEqual(
+            db.models.DataColumn.objects.filter(
+                screen_result=screen_result).count(), 
+            len(input_data['fields']))
+        
+        logger.info('delete the screen result...')
+        resp = self.api_client.delete(
+            resource_uri, authentication=self.get_credentials())
+        self.assertTrue(resp.status_code == 204, resp.status_code)
+        self.assertEqual(get_partitions(), [])
+        self.assertEqual(db.models.ResultValue.objects.count(), 0)
+        self.assertEqual(db.models.AssayWell.objects.count(), 0)
         
 
 class ScreenResource(DBResourceTestCase):
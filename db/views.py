@@ -7,7 +7,6 @@ import os.path
 import sys
 import types
 
-from PIL import Image
 from django.conf import settings
 from django.contrib.auth.decorators import login_required
 from django.core.exceptions import ObjectDoesNotExist
@@ -20,6 +19,7 @@ from db.api import UserGroupAuthorization, PublicationAuthorization,\
     ReagentResourceAuthorization
 from db.models import ScreensaverUser, Reagent, AttachedFile, Publication, \
     RawDataTransform, SmallMoleculeReagent
+from db.support.structure_image_index import get_structure_image_path
 from reports.serialize import XLSX_MIMETYPE
 
 
@@ -52,17 +52,16 @@ def well_image(request, well_id):
                 logger.warn('structure is restricted: %s', well_id)
                 return HttpResponseForbidden()
         
-        _name = '%s%s.png' % (_plate,_well_name)
         structure_image_dir = os.path.abspath(settings.WELL_STRUCTURE_IMAGE_DIR)
-        structure_image_path = os.path.join(
-            structure_image_dir, _plate, _name)
+        structure_image_path = get_structure_image_path(
+            structure_image_dir, _plate, _well_name)
 
         if os.path.exists(structure_image_path):
             try:
-                image = Image.open(structure_image_path)
-                response = HttpResponse(content_type="image/png")
-                image.save(response, "PNG")
-                return response
+                # Serve the PNG file bytes, without decoding the image
+                with open(structure_image_path, 'rb') as image_file:
+                    return HttpResponse(
+                        image_file.read(), content_type="image/png")
             except Exception as e:
                 logger.exception('well_image exception for %r, %r' 
                     % (well_id, e))
@@ -147,14 +147,77 @@ PROFILE_LOG_BASE='/tmp'
 # @see db.views for details
 WELL_STRUCTURE_IMAGE_DIR=''
 
+# ICCBL-Setting: the structure image files are indexed in memory for exports;
+# build the index on startup, and refresh it when older than the seconds given.
+# @see db.support.structure_image_index
+BUILD_STRUCTURE_IMAGE_INDEX_ON_STARTUP=True
+STRUCTURE_IMAGE_INDEX_REFRESH_SECONDS=300
+
+# ICCBL-Setting: processes used to parse the screen result load file data 
+# sheets; if None, use the cpu count (max 4); set to 1 to parse in process.
+# @see db.support.screen_result_importer.parse_result_values
+SCREEN_RESULT_PARSE_PROCESSES=None
+
 # ICCBL-Setting: Maximum rows to cache in the database table "well_query_index"
 # @see db.api.ScreenResultResource
 MAX_WELL_INDEXES_TO_CACHE=3e+08
+# ICCBL-Setting: eviction order for the "well_query_index" cached queries:
+# "lru" (least recently used) or "lfu" (least frequently used)
+WELL_QUERY_INDEX_EVICTION_POLICY='lru'
+# ICCBL-Setting: backend for the filtered well sets of the screen result 
+# queries: "table" (rows in the "well_query_index" table) or "cache" (
+# compressed blocks of the well_id list in the "screen_cache"; no database 
+# writes; requires USE_SHARED_RESULT_CACHE)
+WELL_QUERY_INDEX_BACKEND='table'
+# ICCBL-Setting: Timeout, in seconds, of the "cache" backend well sets
+# @see db.api.ScreenResultResource.create_cached_well_set
+WELL_SET_CACHE_TIMEOUT=60*60*4
 
 # ICCBL-Setting: Maximum rows to cache per query for cached_resultproxy:
 # @see reports.sqlalchemy_resource
 MAX_ROWS_FOR_CACHE_RESULTPROXY=1e4
 
+# ICCBL-Setting: Default policy for the "total_count" of list responses:
+# "exact": execute the count statement,
+# "estimated": use the query planner row estimate,
+# "deferred": use the estimate; compute the exact count in the background, 
+# for subsequent requests.
+# Clients may override with the "total_count_policy" param.
+# @see reports.sqlalchemy_resource
+DEFAULT_TOTAL_COUNT_POLICY='exact'
+
+# ICCBL-Setting: Rows to fetch per batch from the server side cursor used to
+# stream non-JSON (CSV, SDF, XLS) exports
+# @see reports.sqlalchemy_resource
+STREAMING_FETCH_SIZE=2000
+
+# ICCBL-Setting: Use a cross-process, size bounded (LRU) file cache for the 
+# query result caches ("reports_cache", "db_cache", "screen_cache"), instead of
+# the caches configured in CACHES.
+# Note: use a tmpfs directory (e.g. "/dev/shm/...") for a shared memory store.
+# @see reports.utils.result_cache
+USE_SHARED_RESULT_CACHE = False
+SHARED_RESULT_CACHE_DIR = '/tmp/lims_result_cache'
+# Maximum bytes to store per result cache; least recently used entries are 
+# evicted when exceeded.
+SHARED_RESULT_CACHE_MAX_BYTES = 256*1024**2
+
+# ICCBL-Setting: Rows to patch per chunk for list PATCH requests: the input rows
+# are read, and the before/after snapshots for logging are fetched, per chunk.
+# @see reports.api.ApiResource.patch_list
+PATCH_LIST_CHUNK_SIZE = 1000
+
+# ICCBL-Setting: Wells to validate and patch per batch when loading library 
+# wells; the input file records are read incrementally, batch by batch.
+# @see db.api.WellResource.patch_list
+WELL_PATCH_BATCH_SIZE = 2000
+
+# ICCBL-Setting: Maximum wells returned by the vendor identifier and compound
+# name search, best ranked first (0 for no limit); the "search_limit" request 
+# parameter may lower the limit.
+# @see db.api.WellResource.create_vendor_compound_name_base_query
+COMPOUND_SEARCH_LIMIT = 1000
+
 # ICCBL-Setting: Minimum wells for insertion into the well_query_index before 
 # clearing older indexes; for performance tuning on screen result / well queries.
 # @see db.api.ScreenResultResource
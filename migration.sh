@@ -411,6 +411,14 @@ function migrate_result_values {
     || error "manual migrate_result_values failed: $?"
 }
 
+function partition_result_values {
+  echo "Partition result values: $(ts) ...">> "$LOGFILE"
+  psql -U $DBUSER $DB -h $DBHOST -a -1 -v ON_ERROR_STOP=1 \
+    -f ./db/migrations/manual/result_value_partition.sql >>"$LOGFILE" 2>&1 \
+    || error "manual partition_result_values failed: $?"
+  echo "Partition result values completed: $(ts) " >> "$LOGFILE"
+}
+
 function result_value_cleanup {
   echo "Result value cleanup: $(ts) ...">> "$LOGFILE"
   psql -U $DBUSER $DB -h $DBHOST -a \
@@ -824,6 +832,10 @@ function main {
   if [[ $MIGRATE_RESULT_VALUE_TABLE -ne 0 ]]; then
     migrate_result_values
   fi
+  
+  if [[ $PARTITION_RESULT_VALUE_TABLE -ne 0 ]]; then
+    partition_result_values
+  fi
 
 }
 
@@ -23,6 +23,8 @@ HTTP_PARAM_USE_VOCAB = 'use_vocabularies'
 HTTP_PARAM_USE_TITLES = 'use_titles'
 HTTP_PARAM_RAW_LISTS = 'raw_lists'
 HTTP_PARAM_DATA_INTERCHANGE = 'data_interchange'
+# Use the indented (pretty printed) JSON encoding for list responses
+HTTP_PARAM_PRETTY_JSON = 'pretty_json'
 
 API_RESULT_ERROR = SCHEMA.ERROR.resource_name
 
@@ -7,6 +7,7 @@ from decimal import Decimal
 import decimal
 from functools import wraps, partial
 import importlib
+import itertools
 import json
 import logging
 from operator import itemgetter
@@ -62,6 +63,8 @@ from reports.sqlalchemy_resource import SqlAlchemyResource, _concat
 from reports.utils import default_converter
 import reports.utils.background_client_util as background_client_util
 import reports.utils.background_processor as background_processor
+from reports.utils.result_cache import get_result_cache, invalidate_tables, \
+    count_cache_stat
 import reports.utils.si_unit as si_unit
 
 
@@ -84,6 +87,11 @@ API_PARAM_SHOW_PREVIEW = 'show_preview'
 API_PARAM_PREVIEW_LOGS = 'preview_logs'
 API_PARAM_NO_BACKGROUND = 'no_background'
 
+# Tables that define the resource schemas: see ApiResource.invalidate_cache
+SCHEMA_TABLES = set([MetaHash._meta.db_table, Vocabulary._meta.db_table])
+# Tables written by the patch logging: see ApiResource.get_modified_tables
+LOG_TABLES = set([ApiLog._meta.db_table, LogDiff._meta.db_table])
+
 DEBUG_RESOURCES = False or logger.isEnabledFor(logging.DEBUG)
 DEBUG_FIELDS = False or logger.isEnabledFor(logging.DEBUG)
 DEBUG_AUTHORIZATION = False or logger.isEnabledFor(logging.DEBUG)
@@ -597,14 +605,51 @@ class ApiResource(SqlAlchemyResource):
                 self._meta.resource_name, all)
         
         ApiResource.get_cache(self).clear()
+        count_cache_stat('clears')
         if all is True:
             logger.info('clear all caches...')
             for name in ['reports_cache', 'resource_cache','screen_cache','db_cache']:
                 logger.info('clearing cache: %r', name)
-                caches[name].clear()
+                get_result_cache(name).clear()
 
     def get_cache(self):
-        return caches['reports_cache']
+        return get_result_cache('reports_cache')
+
+    def get_modified_tables(self):
+        '''
+        Return the tables declared by the resource schema (the resource and
+        the field "table"), and the log tables, as the tables that a write to
+        the resource may modify;
+        - returns None if the resource does not declare any tables.
+        '''
+        try:
+            schema = self.build_schema()
+        except Exception:
+            logger.exception('schema not found for resource: %r', 
+                self._meta.resource_name)
+            return None
+        tables = set([schema.get('table')])
+        tables.update(
+            field.get('table') for field in schema[RESOURCE.FIELDS].values())
+        tables -= set([None, '', 'None'])
+        if not tables:
+            return None
+        return tables | LOG_TABLES
+
+    def invalidate_cache(self, modified_tables):
+        '''
+        Evict the cached results that read from the modified_tables:
+        - clear the caches if the modified tables are not known, 
+        - clear all caches if the resource schema tables are modified
+        (field, resource, and vocabulary definitions effect the cached schemas
+        and sorting).
+        '''
+        if modified_tables is None:
+            self.clear_cache(None)
+        elif modified_tables & SCHEMA_TABLES:
+            ApiResource.clear_cache(self, None, all=True)
+        else:
+            invalidate_tables(modified_tables)
 
     def get_resource_resource(self):
         if self.resource_resource is None:
@@ -1126,7 +1171,8 @@ class ApiResource(SqlAlchemyResource):
         '''
         Patch a list of serialized data.
         
-        - Take a snapshot before and after patching for logging.
+        - Take a snapshot before and after patching each chunk of 
+        PATCH_LIST_CHUNK_SIZE rows for logging.
         '''
 
         logger.info('patch list, user: %r, resource: %r' 
@@ -1143,15 +1189,14 @@ class ApiResource(SqlAlchemyResource):
         if API_RESULT_DATA in deserialized:
             deserialized = deserialized[API_RESULT_DATA]
         
-        # Unspool the generator in memory
-        # Note: Memory performance optimizations should override patch_list;
-        # e.g. see WellResource.patch_list
+        # Note: the rows are read and patched in chunks, so that the 
+        # (streamed) input is not unspooled in memory
         if isinstance(deserialized, dict):
             deserialized = [deserialized]
-        else:
-            deserialized = [x for x in deserialized]
+        rows = iter(deserialized)
+        first_rows = list(itertools.islice(rows, 2))
             
-        if len(deserialized) == 0:
+        if len(first_rows) == 0:
             meta = { 
                 SCHEMA.API_MSG_RESULT: {
                     SCHEMA.API_MSG_SUBMIT_COUNT : 0, 
@@ -1165,46 +1210,16 @@ class ApiResource(SqlAlchemyResource):
             return self.build_response(
                 request, { API_RESULT_META: meta }, response_class=HttpResponse, **kwargs)
 
-        if len(deserialized) == 1 or isinstance(deserialized, dict):
+        if len(first_rows) == 1:
             # send to patch detail to bypass parent log creation
-            if not isinstance(deserialized,dict):
-                kwargs['data'] = deserialized[0]
-            else:
-                kwargs['data'] = deserialized
+            kwargs['data'] = first_rows[0]
             return self.patch_detail(request, **kwargs)
+        rows = itertools.chain(first_rows, rows)
         
-        logger.debug(
-            'Limit the potential candidates for logging to found id_kwargs...')
         schema = kwargs.pop('schema', None)
         if not schema:
             raise Exception('schema not initialized')
         
-        kwargs_for_log = kwargs.copy()
-        kwargs_for_log['visibilities'] = ['d','l']
-        kwargs_for_log['schema'] = schema
-
-        # 20180227 - set visibilities to detail and list to make up for removing
-        # includes='*' from get_list_internal
-        includes = set()
-        for _data in deserialized:
-            includes |= set(_data.keys())
-        kwargs_for_log['includes'] = list(includes)
-            
-        (id_query_params,rows_to_ids) = self._parse_list_ids(deserialized, schema)
-        original_data = []
-        if not id_query_params:
-            logger.info('No ids found for PATCH (may be ok if id is generated)')
-            raise ValidationError(key='id_kwargs', msg='No IDs found in patch data')
-        else:
-            kwargs_for_log.update(id_query_params)
-            try:
-                logger.debug('get original state, for logging... %r', 
-                    { k:v for k,v in kwargs_for_log.items() if k != 'schema'} )
-                original_data = self._get_list_response_internal(**kwargs_for_log)
-                logger.info('original state retrieved: %d', len(original_data))
-            except Exception as e:
-                logger.exception('original state not obtained')
-
         if 'parent_log' not in kwargs:
             parent_log = self.make_log(request, schema=schema)
             parent_log.key = self._meta.resource_name
@@ -1213,27 +1228,25 @@ class ApiResource(SqlAlchemyResource):
             kwargs['parent_log'] = parent_log
         parent_log = kwargs['parent_log']    
 
-        logger.info('perform patch_list: %d', len(deserialized))
-        for _row,_dict in enumerate(deserialized):
-            try:
-            
-                self.patch_obj(request, _dict, **kwargs)
-        
-            except ValidationError, e:
-                # TODO: consider CumulativeError
-                e.errors['input_row'] = _row
-                e.errors.setdefault('input_id', rows_to_ids[_row])
-                raise
-        
-        logger.debug('Get new state, for logging: %r...',
-            {k:v for k,v in kwargs_for_log.items() if k != 'schema'})
-        new_data = self._get_list_response_internal(**kwargs_for_log)
-        logger.info('new data: %d, log patches...', len(new_data))
-        
-        logs = self.log_patches(request, original_data,new_data,schema=schema,**kwargs)
-        logger.info('patch logs created: %d', len(logs) if logs else 0 )
+        chunk_size = int(getattr(settings, 'PATCH_LIST_CHUNK_SIZE', 1000))
+        patch_count = 0
+        logs = []
+        id_query_params = defaultdict(list)
+        includes = set()
+        while True:
+            chunk = list(itertools.islice(rows, chunk_size))
+            if not chunk:
+                break
+            (chunk_logs, chunk_id_query_params, chunk_includes) = \
+                self._patch_list_chunk(
+                    request, chunk, schema, row_offset=patch_count, **kwargs)
+            patch_count += len(chunk)
+            logs.extend(chunk_logs)
+            for key, ids in chunk_id_query_params.items():
+                id_query_params[key].extend(ids)
+            includes |= chunk_includes
+        logger.info('patch logs created: %d', len(logs))
         
-        patch_count = len(deserialized)
         update_count = len([x for x in logs if x.diffs ])
         logger.debug('updates: %r', [x for x in logs if x.diffs ])
         create_count = len([x for x in logs if x.api_action == API_ACTION.CREATE])
@@ -1250,6 +1263,12 @@ class ApiResource(SqlAlchemyResource):
         if deserialize_meta:
             meta.update(deserialize_meta)
         
+        kwargs_for_log = kwargs.copy()
+        kwargs_for_log['visibilities'] = ['d','l']
+        kwargs_for_log['schema'] = schema
+        kwargs_for_log['includes'] = list(includes)
+        kwargs_for_log.update(id_query_params)
+        
         param_hash = self._convert_request_to_dict(request)
         if 'test_only' in param_hash:
             logger.info('test_only flag: %r', kwargs.get('test_only'))    
@@ -1270,6 +1289,67 @@ class ApiResource(SqlAlchemyResource):
             response.status_code = 200
             return response
  
+    def _patch_list_chunk(
+            self, request, deserialized, schema, row_offset=0, **kwargs):
+        '''
+        Patch a chunk of the rows for patch_list:
+        - take a snapshot of the chunk before and after patching for logging
+        @param row_offset the input row of the first row of the chunk
+        @return (logs, id_query_params, includes) for the chunk
+        '''
+        logger.debug(
+            'Limit the potential candidates for logging to found id_kwargs...')
+        kwargs_for_log = kwargs.copy()
+        kwargs_for_log['visibilities'] = ['d','l']
+        kwargs_for_log['schema'] = schema
+
+        # 20180227 - set visibilities to detail and list to make up for removing
+        # includes='*' from get_list_internal
+        includes = set()
+        for _data in deserialized:
+            includes |= set(_data.keys())
+        kwargs_for_log['includes'] = list(includes)
+        
+        try:
+            (id_query_params,rows_to_ids) = \
+                self._parse_list_ids(deserialized, schema)
+        except ValidationError, e:
+            e.errors['input_row'] += row_offset
+            raise
+        original_data = []
+        if not id_query_params:
+            logger.info('No ids found for PATCH (may be ok if id is generated)')
+            raise ValidationError(key='id_kwargs', msg='No IDs found in patch data')
+        else:
+            kwargs_for_log.update(id_query_params)
+            try:
+                logger.debug('get original state, for logging... %r', 
+                    { k:v for k,v in kwargs_for_log.items() if k != 'schema'} )
+                original_data = self._get_list_response_internal(**kwargs_for_log)
+                logger.info('original state retrieved: %d', len(original_data))
+            except Exception as e:
+                logger.exception('original state not obtained')
+
+        logger.info('perform patch_list: %d', len(deserialized))
+        for _row,_dict in enumerate(deserialized):
+            try:
+            
+                self.patch_obj(request, _dict, **kwargs)
+        
+            except ValidationError, e:
+                # TODO: consider CumulativeError
+                e.errors['input_row'] = row_offset + _row
+                e.errors.setdefault('input_id', rows_to_ids[_row])
+                raise
+        
+        logger.debug('Get new state, for logging: %r...',
+            {k:v for k,v in kwargs_for_log.items() if k != 'schema'})
+        new_data = self._get_list_response_internal(**kwargs_for_log)
+        logger.info('new data: %d, log patches...', len(new_data))
+        
+        logs = self.log_patches(request, original_data,new_data,schema=schema,**kwargs)
+        return (logs or [], id_query_params, includes)
+    
     @write_authorization
     @un_cache 
     @transaction.atomic       
@@ -2093,6 +2173,8 @@ class ApiResource(SqlAlchemyResource):
                                 si_unit.convert_decimal(x, 1, int(decimals), multiplier)}
            
         logger.debug('output number formatters: %r', formatters)
+        row_converters = { key: formatter['converter'] 
+            for key,formatter in formatters.items() }
         def number_formatter_rowproxy_generator(cursor):
             if extant_generator is not None:
                 cursor = extant_generator(cursor)
@@ -2116,6 +2198,10 @@ class ApiResource(SqlAlchemyResource):
                         return self.row[key]
             for row in cursor:
                 yield Row(row)
+        # Expose the converters, so that the cursor_generator may apply them 
+        # in place of the Row wrapper (see RowProjection)
+        number_formatter_rowproxy_generator.row_converters = row_converters
+        number_formatter_rowproxy_generator.extant_generator = extant_generator
         return number_formatter_rowproxy_generator
  
 
@@ -2132,6 +2218,18 @@ class ApiResource(SqlAlchemyResource):
         '''
         vocabularies = ApiResource.get_vocabularies(field_hash)
 
+        def vocabulary_converter(key, raw_val):
+            val = str(raw_val)
+            if val not in vocabularies[key]:
+                logger.error(
+                    ('Unknown vocabulary:'
+                     ' scope:%s key:%s val:%r, keys defined: %r'),
+                    field_hash[key]['vocabulary_scope_ref'], key, 
+                    val,vocabularies[key].keys() )
+                return raw_val
+            else:
+                return vocabularies[key][val][SCHEMA.VOCABULARY.TITLE]
+        
         class Row:
             def __init__(self, row):
                 self.row = row
@@ -2144,24 +2242,20 @@ class ApiResource(SqlAlchemyResource):
                 if not val:
                     return val
                 if key in vocabularies:
-                    val = str(val)
-                    if val not in vocabularies[key]:
-                        logger.error(
-                            ('Unknown vocabulary:'
-                             ' scope:%s key:%s val:%r, keys defined: %r'),
-                            field_hash[key]['vocabulary_scope_ref'], key, 
-                            val,vocabularies[key].keys() )
-                        return self.row[key]
-                    else:
-                        return vocabularies[key][val][SCHEMA.VOCABULARY.TITLE]
+                    return vocabulary_converter(key, val)
                 else:
-                    return self.row[key]
+                    return val
                 
         def vocabulary_rowproxy_generator(cursor):
             if extant_generator is not None:
                 cursor = extant_generator(cursor)
             for row in cursor:
                 yield Row(row)
+        # Expose the converters, so that the cursor_generator may apply them 
+        # in place of the Row wrapper (see RowProjection)
+        vocabulary_rowproxy_generator.row_converters = {
+            key: partial(vocabulary_converter, key) for key in vocabularies }
+        vocabulary_rowproxy_generator.extant_generator = extant_generator
         return vocabulary_rowproxy_generator
     
     def make_child_log(self, parent_log):
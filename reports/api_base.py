@@ -2,7 +2,7 @@
 from __future__ import unicode_literals
 
 import base64
-from functools import wraps
+from functools import wraps, partial
 import logging
 import sys
 import traceback
@@ -15,6 +15,7 @@ from django.core.exceptions import ObjectDoesNotExist, PermissionDenied, \
     ImproperlyConfigured
 import django.core.exceptions
 import django.core.signals
+from django.db import transaction
 from django.http.response import HttpResponseBase, HttpResponse, \
     HttpResponseNotFound, Http404, HttpResponseForbidden, HttpResponseBadRequest, \
     HttpResponseServerError
@@ -30,7 +31,7 @@ from django.utils.http import is_same_domain
 from django.views.decorators.csrf import csrf_exempt
 
 from reports import HTTP_PARAM_DATA_INTERCHANGE, HTTP_PARAM_RAW_LISTS, \
-    HTTP_PARAM_USE_VOCAB, HTTP_PARAM_USE_TITLES
+    HTTP_PARAM_USE_VOCAB, HTTP_PARAM_USE_TITLES, HTTP_PARAM_PRETTY_JSON
 from reports import ValidationError, InformationError, BadRequestError, \
     ApiNotImplemented, BackgroundJobImmediateResponse, LoginFailedException, \
     ConfigurationError, API_RESULT_ERROR
@@ -40,6 +41,7 @@ from reports.serialize import XLSX_MIMETYPE, SDF_MIMETYPE, XLS_MIMETYPE, \
 from reports.serializers import BaseSerializer, LimsSerializer
 from reports.utils import default_converter
 from reports.utils.django_requests import convert_request_method_to_put
+from reports.utils.result_cache import get_cache_stats
 
 
 # Django <1.10 compatibility fixture:
@@ -67,15 +69,21 @@ def un_cache(_func):
     '''
     Wrapper function to disable caching for 
     SQLAlchemyResource.stream_response_from_statement and other caches
+    
+    - after the write is committed, evict the cached results that read 
+    from the tables declared by the resource (see invalidate_cache); the 
+    transaction boundaries are left to the wrapped method
     ''' 
     @wraps(_func)
     def _inner(self, *args, **kwargs):
         logger.debug('decorator un_cache: %r, %r, %r', 
             self, _func,args )
-        self.clear_cache(None, **kwargs)
         self.set_caching(False)
         result = _func(self, *args, **kwargs)
         self.set_caching(True)
+        # Note: run immediately if not in a transaction
+        transaction.on_commit(
+            partial(self.invalidate_cache, self.get_modified_tables()))
         logger.debug('decorator un_cache done: %s, %s', self, _func )
         return result
 
@@ -434,6 +442,9 @@ class IccblBaseResource(six.with_metaclass(DeclarativeMetaclass)):
             url(r'^(?P<resource_name>%s)/clear_all_caches%s$' 
                 % (self._meta.resource_name, TRAILING_SLASH), 
                 self.wrap_view('dispatch_clear_all_caches'), name='api_clear_cache'),
+            url(r'^(?P<resource_name>%s)/cache_stats%s$' 
+                % (self._meta.resource_name, TRAILING_SLASH), 
+                self.wrap_view('dispatch_cache_stats'), name='api_cache_stats'),
         ]
         urls += self.prepend_urls()
         urls += self.base_urls()
@@ -639,6 +650,10 @@ class IccblBaseResource(six.with_metaclass(DeclarativeMetaclass)):
         self.clear_cache(request, all=True)
         return self.build_response(request, 'ok', **kwargs)
 
+    def dispatch_cache_stats(self, request, **kwargs):
+        
+        return self.build_response(request, get_cache_stats(), **kwargs)
+
     def set_caching(self,use_cache):
         logger.debug('set_caching: %r, %r', use_cache, self._meta.resource_name)
         self.use_cache = use_cache
@@ -646,6 +661,21 @@ class IccblBaseResource(six.with_metaclass(DeclarativeMetaclass)):
     def get_cache(self):
         raise ApiNotImplemented(self._meta.resource_name, 'get_cache')
 
+    def get_modified_tables(self):
+        '''
+        Return the tables that may be modified by a write to the resource, or 
+        None if not known (see un_cache)
+        '''
+        return None
+
+    def invalidate_cache(self, modified_tables):
+        '''
+        Evict cached results after a write (see un_cache)
+        @param modified_tables tables modified by the write, or None if the 
+        tables are not known
+        '''
+        self.clear_cache(None)
+
     def deserialize(self, request, format=None, schema=None):
         '''Provide standard deserialization of request data.'''
         
@@ -688,38 +718,46 @@ class IccblBaseResource(six.with_metaclass(DeclarativeMetaclass)):
             # file type.
             # FIXME: rework to use the multipart Content-Type here
             if 'sdf' in request.FILES:  
+                # Note: SDF records are generated as the file is read
                 file = request.FILES['sdf']
                 return (
-                    self.get_serializer().deserialize(
-                        file.read(), SDF_MIMETYPE), 
+                    self.get_serializer().deserialize(file, SDF_MIMETYPE), 
                     { 'filename': file.name })
+            # Note: rows are generated as the (spooled) upload file is read
             elif 'xls' in request.FILES:
                 file = request.FILES['xls']
                 return (
                     self.get_serializer().deserialize(
-                        file.read(), XLS_MIMETYPE, list_keys=list_keys), 
+                        file, XLS_MIMETYPE, list_keys=list_keys), 
                     { 'filename': file.name } )
             elif 'xlsx' in request.FILES:
                 file = request.FILES['xlsx']
                 return (
                     self.get_serializer().deserialize(
-                        file.read(), XLS_MIMETYPE, list_keys=list_keys), 
+                        file, XLS_MIMETYPE, list_keys=list_keys), 
                     { 'filename': file.name } )
             elif 'csv' in request.FILES:
                 file = request.FILES['csv']
                 return (
                     self.get_serializer().deserialize(
-                        file.read(), CSV_MIMETYPE, list_keys=list_keys), 
+                        file, CSV_MIMETYPE, list_keys=list_keys), 
                     { 'filename': file.name } )
             else:
                 raise BadRequestError({
                     'Files':
                     'Unsupported multipart file keys: %r' % request.FILES.keys()})
         
-        elif content_type in [XLS_MIMETYPE,XLSX_MIMETYPE,CSV_MIMETYPE]:
+        elif content_type in [XLS_MIMETYPE,XLSX_MIMETYPE]:
             return (
                 self.get_serializer().deserialize(
                     request.body,content_type, list_keys=list_keys), None )
+        elif content_type in [CSV_MIMETYPE, SDF_MIMETYPE]:
+            # Read the CSV rows, or SDF records, from the request stream
+            if not int(request.META.get('CONTENT_LENGTH') or 0):
+                return {}, None
+            return (
+                self.get_serializer().deserialize(
+                    request,content_type, list_keys=list_keys), None )
         else:
             return self.get_serializer().deserialize(request.body,content_type), None
             
@@ -862,7 +900,7 @@ class IccblBaseResource(six.with_metaclass(DeclarativeMetaclass)):
         # Parse known boolean params for convenience
         http_boolean_params = [
             HTTP_PARAM_DATA_INTERCHANGE,HTTP_PARAM_RAW_LISTS,
-            HTTP_PARAM_USE_VOCAB, HTTP_PARAM_USE_TITLES]
+            HTTP_PARAM_USE_VOCAB, HTTP_PARAM_USE_TITLES, HTTP_PARAM_PRETTY_JSON]
         for key in http_boolean_params:
             _dict[key] = parse_val(
                 _dict.get(key, False),key, 'boolean')
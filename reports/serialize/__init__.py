@@ -20,6 +20,8 @@ from reports import ValidationError
 logger = logging.getLogger(__name__)
 
 JSON_MIMETYPE = 'application/json'
+# JSON list response with rows as arrays, see json_columnar_generator
+JSON_COLUMNAR_MIMETYPE = 'application/vnd.iccbl.columnar+json'
 CSV_MIMETYPE = 'text/csv'
 XLS_MIMETYPE = 'application/xls'
 XLSX_MIMETYPE = 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'
@@ -191,6 +193,31 @@ def parse_json_field(val, key, json_field_type):
         raise NotImplementedError(
             'unknown json_field_type: %s' % json_field_type)
 
+# Functions that find the image file for an image uri, so that the image need
+# not be fetched through its view; see register_image_file_resolver
+_image_file_resolvers = []
+
+def register_image_file_resolver(resolver):
+    '''
+    Register a resolver function(uri) that returns the path of the image file 
+    for the uri, raises Http404 if there is no image for the uri, or returns 
+    None if the uri is not handled by the resolver.
+    '''
+    if resolver not in _image_file_resolvers:
+        _image_file_resolvers.append(resolver)
+
+def resolve_image_file(uri):
+    '''
+    Return the path of the image file for the uri, or None if the uri is not
+    handled by a registered resolver.
+    - raises Http404 if the image does not exist
+    '''
+    for resolver in _image_file_resolvers:
+        path = resolver(uri)
+        if path is not None:
+            return path
+    return None
+
 def resolve_image(request, uri):
     view, args, kwargs = resolve(uri)
     kwargs['request'] = request
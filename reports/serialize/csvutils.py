@@ -6,6 +6,7 @@ import numbers
 import re
 
 from django.utils.encoding import smart_text, force_text
+import six
 
 from reports.serialize import to_simple
 
@@ -30,6 +31,13 @@ def utf_8_encoder(unicode_csv_data):
     for line in unicode_csv_data:
         yield line.encode('utf-8')
 
+def utf_8_decoder(csv_file):
+    ''' Decode the lines of the (byte) file as they are read '''
+    for line in csv_file:
+        if isinstance(line, six.binary_type):
+            line = line.decode('utf-8')
+        yield line
+
 def from_csv(csvfile, list_delimiters=None, list_keys=None):
     '''
     Returns an in memory matrix (array of arrays) for the input file
@@ -1,6 +1,6 @@
 from __future__ import unicode_literals
 
-import cStringIO
+import io
 import logging
 import re
 import six
@@ -70,51 +70,52 @@ def first_nonempty_line(preamble):
         if len(txt):
             return txt
                                         
-def parse_sdf(data, _delimre=re.compile(ur'(?<=\n)\$\$\$\$')):
+def parse_sdf(data, _delimre=re.compile(ur'^\$\$\$\$')):
     """
-    for mol_record in sdf2py.parse_sdf(sdf_data_as_a_string):
+    Generate the records of the SDF data, with the (1-based) line number of the
+    first line of each record; records are read line by line, so that only 
+    the current record is held in memory.
+    
+    for mol_record in sdf2py.parse_sdf(sdf_data):
         preamble = mol_record.pop(_params.MOLDATAKEY)
         title = first_nonempty_line(preamble) or 'WARNING: NO TITLE FOUND'
         print title
         for tag, value in mol_record.items():
             print (u'%s: %s' % (tag, value)).encode(_params.ENCODING)
         print
-        
-    # TODO: implement this as a generator
+    
+    @param data a string, or an iterable of lines (e.g. a file object); 
+    byte strings are decoded as UTF-8
     """
-    result = []
-    if isinstance(data, six.string_types):
-        data = data.strip()
-        data = data.strip(u'$')
-        
-        cumulative_lines = 1
-
-        mols = _delimre.split(data)
-        for mol in mols:
-            mol_lines = len(_dos_unix_le.split(mol))
-            x = dict(parse_mol(mol))
-            x[INPUT_FILE_DESERIALIZE_LINE_NUMBER_KEY] = cumulative_lines
-            cumulative_lines += mol_lines-1
-            
-            result.append(x)
-    else: # treat the data as an iterable
-        buffer = cStringIO.StringIO()
-        linecount = 0
-        record_line = 0
-        for line in data:
-            if _delimre.match(line):
-                x = dict(parse_mol(buffer.read()))
-                x[INPUT_FILE_DESERIALIZE_LINE_NUMBER_KEY] = record_line
-                record_line = 0
-                result.append(x)
-                buffer = cStringIO.StringIO()
-            else:
-                if record_line == 0:
-                    record_line = linecount
-                buffer.write(line)
-            linecount += 1
-    return tuple(result)
-
+    if isinstance(data, six.text_type):
+        data = io.StringIO(data)
+    elif isinstance(data, six.binary_type):
+        data = io.BytesIO(data)
+    
+    lines = []
+    record_line = None
+    for linecount, line in enumerate(data, 1):
+        if isinstance(line, six.binary_type):
+            line = line.decode('utf-8')
+        if _delimre.match(line):
+            if record_line is not None:
+                yield _parse_record(lines, record_line)
+            lines = []
+            record_line = None
+        elif record_line is None:
+            # Note: blank lines before the record are not part of the record
+            if line.strip():
+                record_line = linecount
+                lines.append(line)
+        else:
+            lines.append(line)
+    if record_line is not None:
+        yield _parse_record(lines, record_line)
+
+def _parse_record(lines, record_line):
+    x = dict(parse_mol(u''.join(lines)))
+    x[INPUT_FILE_DESERIALIZE_LINE_NUMBER_KEY] = record_line
+    return x
 
 def to_sdf(data,output):
     '''
@@ -7,9 +7,12 @@ from __future__ import unicode_literals
 
 import cStringIO
 from collections import OrderedDict
+from functools import partial
+from itertools import izip
 import json
 import logging
 import numbers
+from operator import itemgetter
 import os.path
 import re
 import shutil
@@ -22,6 +25,7 @@ from django.conf import settings
 from django.db.utils import ProgrammingError
 from django.http.response import StreamingHttpResponse, Http404
 import six
+from sqlalchemy.engine.result import RowProxy
 import unicodecsv
 import xlsxwriter
 
@@ -44,6 +48,9 @@ MOLDATAKEY = sdfutils.MOLDATAKEY
 
 DEBUG_STREAMING = False or logger.isEnabledFor(logging.DEBUG)
 
+# Rows to encode per string yielded by the (compact) json_generator
+JSON_BATCH_SIZE = 1000
+
 
 def closing_iterator_wrapper(iterable, close):
     '''For use with database connections that must be closed after iterating.'''
@@ -137,6 +144,29 @@ def interpolate_value_template(value_template, row):
             return ''
     return re.sub(r'{([^}]+)}', get_value_from_template, value_template)
 
+def _get_image_uri(request, val):
+    '''
+    Return the absolute URI for the image value, or None if the image can not
+    be fetched.
+    '''
+    try:
+        # Test whether image exists
+        if reports.serialize.resolve_image_file(val) is None:
+            reports.serialize.resolve_image(request, val)
+        # If it exists, write the fullpath to the file
+        fullpath = request.build_absolute_uri(val)
+        logger.debug(
+            'image exists: %r, abs_uri: %r', val, fullpath)
+        return fullpath
+    except Http404, e:
+        logger.debug('no image found at: %r', val)
+        return None
+    except Exception, e:
+        logger.exception(
+            'image could not be retrieved: %r, e: %r',
+            val, e)
+        return None
+
 def image_generator(rows, image_keys, request):
     '''
     Check that any image values in the rows can be fetched:
@@ -146,38 +176,92 @@ def image_generator(rows, image_keys, request):
     
     TODO: inject or wrap dependency on well.library_well_type 
     '''
+    if not image_keys:
+        for row in rows:
+            yield row
+        return
     for row in rows:
-        for key,val in row.items():
+        for key in image_keys:
+            val = row.get(key)
             if not val:
                 continue
-            if key in image_keys:
-                # Hack to speed things up for the db.api:
-                if ( key == 'structure_image' and
-                        'library_well_type' in row and
-                        row['library_well_type'] == 'empty' ):
-                    row[key] = None
-                else:
-                    try:
-                        # Test whether image exists
-                        image = reports.serialize.resolve_image(request, val)
-                        # If it exists, write the fullpath to the file
-                        fullpath = request.build_absolute_uri(val)
-                        logger.debug(
-                            'image exists: %r, abs_uri: %r', val, fullpath)
-                        row[key] = fullpath
-                    except Http404, e:
-                        logger.debug('no image found at: %r', val)
-                        row[key] = None
-                    except Exception, e:
-                        logger.exception(
-                            'image could not be retrieved: %r, e: %r',
-                            val, e)
-                        row[key] = None
+            # Hack to speed things up for the db.api:
+            if ( key == 'structure_image' and
+                    'library_well_type' in row and
+                    row['library_well_type'] == 'empty' ):
+                row[key] = None
+            else:
+                row[key] = _get_image_uri(request, val)
         yield row
 
+def image_tuple_generator(rows, ordered_keys, image_keys, request):
+    '''
+    Check that any image values in the rows can be fetched:
+    - replace the raw value given with the absolute URI
+    
+    @param rows an iterator that returns a tuple for each row, with values in
+    the ordered_keys order (see cursor_generator "as_tuples")
+    '''
+    image_indexes = [
+        i for i,key in enumerate(ordered_keys) if key in image_keys]
+    if not image_indexes:
+        for row in rows:
+            yield row
+        return
+    well_type_index = None
+    if 'library_well_type' in ordered_keys:
+        well_type_index = ordered_keys.index('library_well_type')
+    for row in rows:
+        row = list(row)
+        for i in image_indexes:
+            val = row[i]
+            if not val:
+                continue
+            # Hack to speed things up for the db.api:
+            if ( ordered_keys[i] == 'structure_image' 
+                    and well_type_index is not None
+                    and row[well_type_index] == 'empty' ):
+                row[i] = None
+            else:
+                row[i] = _get_image_uri(request, val)
+        yield tuple(row)
+
 
-def json_generator(data, meta, is_for_detail=False):
-    '''Yield the given data list as a JSON encoded char array'''
+def _json_batch_generator(data, encoder, batch_size):
+    '''
+    Yield the rows encoded as the comma separated elements of a JSON array,
+    in batches of batch_size rows.
+    '''
+    batch = []
+    is_first_batch = True
+    for row in data:
+        batch.append(row)
+        if len(batch) >= batch_size:
+            # Encode the batch as a list, and remove the brackets
+            encoded = encoder.encode(batch)[1:-1]
+            if not is_first_batch:
+                encoded = ',' + encoded
+            is_first_batch = False
+            batch = []
+            yield encoded
+    if batch:
+        encoded = encoder.encode(batch)[1:-1]
+        if not is_first_batch:
+            encoded = ',' + encoded
+        yield encoded
+
+def json_generator(data, meta, is_for_detail=False, pretty=False, 
+        batch_size=JSON_BATCH_SIZE):
+    '''
+    Yield the given data list as a JSON encoded char array
+    
+    @param pretty if True, encode each row with indent=2 and sorted keys; 
+    otherwise use the compact encoding:
+    - no whitespace, and keys in row order: the rows of the cursor_generator
+    are ordered by the "ordered_keys" of the resource,
+    - rows are encoded in batches of batch_size rows, so that a single string
+    is yielded for each batch.
+    '''
     
     if DEBUG_STREAMING: logger.info('meta: %r', meta )
     
@@ -185,37 +269,72 @@ def json_generator(data, meta, is_for_detail=False):
     # chars to be encoded using ascii or escaped unicode; 
     # because some chars in db might be non-UTF8
     # and downstream programs have trouble with mixed encoding (cStringIO)
+    if pretty is True:
+        encoder = LimsJSONEncoder(
+            sort_keys=True, ensure_ascii=True, indent=2, encoding="utf-8")
+        separator = ', '
+    else:
+        encoder = LimsJSONEncoder(
+            ensure_ascii=True, separators=(',',':'), encoding="utf-8")
     if not is_for_detail:
-        yield ( '{ "meta": %s, "objects": [' 
-            % json.dumps(meta, cls=LimsJSONEncoder, ensure_ascii=True, encoding="utf-8"))
+        if pretty is True:
+            yield ( '{ "meta": %s, "objects": [' 
+                % json.dumps(meta, cls=LimsJSONEncoder, ensure_ascii=True, 
+                    encoding="utf-8"))
+        else:
+            yield '{"meta":%s,"objects":[' % encoder.encode(meta)
     try:
-        for rownum, row in enumerate(data):
-            try:
-                if rownum == 0:
-                    # NOTE, using "ensure_ascii" = True to force encoding of all 
-                    # chars to the ascii charset; otherwise, cStringIO has problems
-                    yield json.dumps(row, cls=LimsJSONEncoder,
-                        sort_keys=True, ensure_ascii=True, indent=2, encoding="utf-8")
-                else:
+        if pretty is True:
+            for rownum, row in enumerate(data):
+                try:
                     # NOTE, using "ensure_ascii" = True to force encoding of all 
                     # chars to the ascii charset; otherwise, cStringIO has problems
                     # e.g. "tm" becomes \u2122
                     # CStringIO doesn't support UTF-8 mixed with ascii, for instance
                     # NOTE2: control characters are not allowed: should convert \n to "\\n"
-                    yield ', ' + json.dumps(row, cls=LimsJSONEncoder,
-                        sort_keys=True, ensure_ascii=True, indent=2, encoding="utf-8")
-            except Exception, e:
-                logger.exception('dict: %r', row)
-                raise e
+                    if rownum == 0:
+                        yield encoder.encode(row)
+                    else:
+                        yield separator + encoder.encode(row)
+                except Exception, e:
+                    logger.exception('dict: %r', row)
+                    raise e
+        else:
+            for encoded in _json_batch_generator(data, encoder, batch_size):
+                yield encoded
         logger.debug('streaming finished')
         
         if not is_for_detail:
-            yield ' ] }'
+            if pretty is True:
+                yield ' ] }'
+            else:
+                yield ']}'
     except Exception, e:
         logger.exception('json streaming')
         raise e                      
 
 
+def json_columnar_generator(data, meta, fields, batch_size=JSON_BATCH_SIZE):
+    '''
+    Yield the given data list as a "columnar" JSON encoded char array:
+    { "meta": {...}, "fields": [field keys], "objects": [[row values],...] }
+    
+    @param data an iterator that returns a tuple (or list) of values for each 
+    row, in the order of the fields
+    '''
+    encoder = LimsJSONEncoder(
+        ensure_ascii=True, separators=(',',':'), encoding="utf-8")
+    yield '{"meta":%s,"fields":%s,"objects":[' % (
+        encoder.encode(meta), encoder.encode(fields))
+    try:
+        for encoded in _json_batch_generator(data, encoder, batch_size):
+            yield encoded
+        yield ']}'
+    except Exception, e:
+        logger.exception('json columnar streaming')
+        raise e                      
+
+
 class Echo(object):
     '''Implement the write method of the file-like interface.'''
     
@@ -296,50 +415,197 @@ def sdf_generator(data, title_function=None):
         raise
 
 
-def cursor_generator(cursor, visible_fields, list_fields=None, value_templates=None):
+def _split_list_value(value, row):
+    if isinstance(value, six.string_types):
+        # NOTE: filter empty strings; func.array_to_string inserts 
+        # a separator before every element, even if list has one value
+        value = list(filter(None,value.split(LIST_DELIMITER_SQL_ARRAY)))
+    return value
+
+def _convert_value(converter, value, row):
+    if not value:
+        return value
+    return converter(value)
+
+
+class _ConvertedRow(object):
     '''
-    Yield the given cursor as a row of dicts:
-    
-    @param visible_fields fields to extract from the cursor
-    @param list_fields fields to extract as list values
-    @param value_templates
+    Row wrapper applying the row converters, for value template interpolation
+    '''
+    def __init__(self, row, converters):
+        self.row = row
+        self.converters = converters
+    def has_key(self, key):
+        return self.row.has_key(key)
+    def keys(self):
+        return self.row.keys()
+    def __getitem__(self, key):
+        value = self.row[key]
+        for converters in self.converters:
+            if value and key in converters:
+                value = converters[key](value)
+        return value
+
 
+class ProjectedRow(dict):
     '''
-    logger.debug('visible: %r, list: %r, value templates: %r', 
-        visible_fields, list_fields, value_templates)
+    Dict of the visible field values of a row, that iterates in the visible 
+    field order.
     
-    for row in cursor:
-        
-        output_row = []
+    Note: constructing an OrderedDict (pure Python in 2.7) for each row costs 
+    more than the rest of the projection; the ProjectedRow is constructed as 
+    a dict, and the field order is shared by the rows of the projection.
+    '''
+    ordered_keys = ()
+    
+    def keys(self):
+        keys = self.ordered_keys
+        if len(self) != len(keys):
+            # keys were added after the projection
+            keys = list(keys)
+            keys.extend(key for key in dict.keys(self) if key not in keys)
+        return keys
     
-        for key in visible_fields:
+    def values(self):
+        return [self[key] for key in self.keys()]
+    
+    def items(self):
+        return [(key, self[key]) for key in self.keys()]
+    
+    def __iter__(self):
+        return iter(self.keys())
+    
+    def iterkeys(self):
+        return iter(self.keys())
+    
+    def itervalues(self):
+        return iter(self.values())
+    
+    def iteritems(self):
+        return iter(self.items())
+    
+    def __delitem__(self, key):
+        dict.__delitem__(self, key)
+        self.ordered_keys = [k for k in self.ordered_keys if k != key]
         
-            value = None
-            if row.has_key(key):
-                value = row[key]
-            else:
-                logger.debug('no value for key: %r, %r', key, row)
-            
-            if value is not None and list_fields is not None \
-                and key in list_fields:
-            
-                if isinstance(value, six.string_types):
-                    # NOTE: filter empty strings; func.array_to_string inserts 
-                    # a separator before every element, even if list has one value
-                    value = list(filter(None,value.split(LIST_DELIMITER_SQL_ARRAY)))
-            
+    def pop(self, key, *args):
+        if key in self:
+            self.ordered_keys = [k for k in self.ordered_keys if k != key]
+        return dict.pop(self, key, *args)
+    
+    def copy(self):
+        row = ProjectedRow(self)
+        row.ordered_keys = self.keys()
+        return row
+    
+
+class RowProjection(object):
+    '''
+    Projection of the cursor rows to the output values, compiled once per 
+    request:
+    - the position of each visible field in the result row is found from the
+    first row, so that values are extracted by position,
+    - only the fields that have a transform (list split, row converter, value
+    template) are visited for each row.
+    
+    @param converters (optional) list of {key: function} dicts, applied in 
+    order to the (non empty) values, in place of the rowproxy generators that 
+    provide them (see ApiResource.create_vocabulary_rowproxy_generator).
+    '''
+    def __init__(self, visible_fields, list_fields=None, value_templates=None,
+            converters=None):
+        self.visible_fields = list(visible_fields)
+        self.converters = converters or []
+        transforms = []
+        for i,key in enumerate(self.visible_fields):
             if value_templates and key in value_templates:
-                
-                value_template = value_templates[key]
-                new_value = interpolate_value_template(value_template, row)
-                if DEBUG_STREAMING: 
-                    logger.info('field: %r, value: %r, new_value: %r, value_template: %r', 
-                        key, value, new_value, value_template)
-                value = new_value
+                transforms.append(
+                    (i, partial(self._interpolate, value_templates[key])))
+                continue
+            for converters in self.converters:
+                if key in converters:
+                    transforms.append(
+                        (i, partial(_convert_value, converters[key])))
+            if list_fields and key in list_fields:
+                transforms.append((i, _split_list_value))
+        self.transforms = transforms
+        self._extract = None
+    
+    def _interpolate(self, value_template, value, row):
+        if self.converters:
+            row = _ConvertedRow(row, self.converters)
+        return interpolate_value_template(value_template, row)
+    
+    def _compile_extract(self, row):
+        '''
+        Create the function to extract the visible field values from the row
+        '''
+        visible_fields = self.visible_fields
+        if not isinstance(row, RowProxy):
+            # Row wrappers (see rowproxy_generator) support key access only
+            def extract(row):
+                return [row[key] if row.has_key(key) else None 
+                    for key in visible_fields]
+            return extract
         
-            output_row.append(value)
+        positions = {}
+        for i,key in enumerate(row.keys()):
+            positions.setdefault(key, i)
+        missing = [key for key in visible_fields if key not in positions]
+        if missing:
+            logger.debug('no values for keys: %r', missing)
+        # Missing fields are read from a None value appended to the row
+        missing_position = len(positions)
+        getter = itemgetter(*[positions.get(key, missing_position) 
+            for key in visible_fields])
+        if len(visible_fields) == 1:
+            item_getter = getter
+            getter = lambda values: (item_getter(values),)
+        if missing:
+            return lambda row: getter(tuple(row) + (None,))
+        return lambda row: getter(tuple(row))
+    
+    def project(self, row):
+        ''' Return the sequence of visible field values for the row '''
+        if self._extract is None:
+            self._extract = self._compile_extract(row)
+        values = self._extract(row)
+        if self.transforms:
+            values = list(values)
+            for i, transform in self.transforms:
+                values[i] = transform(values[i], row)
+        return values
+    
 
-        yield OrderedDict(zip(visible_fields,output_row))
+def cursor_generator(cursor, visible_fields, list_fields=None, 
+        value_templates=None, as_tuples=False, converters=None):
+    '''
+    Yield the given cursor as a row of dicts (ProjectedRow, in the order of
+    the visible_fields):
+    
+    @param visible_fields fields to extract from the cursor
+    @param list_fields fields to extract as list values
+    @param value_templates
+    @param as_tuples if True, yield a tuple of the values for each row, in 
+    the order of the visible_fields
+    @param converters (optional) row converters (see RowProjection)
+    '''
+    logger.debug('visible: %r, list: %r, value templates: %r', 
+        visible_fields, list_fields, value_templates)
+    
+    projection = RowProjection(
+        visible_fields, list_fields=list_fields, 
+        value_templates=value_templates, converters=converters)
+    project = projection.project
+    if as_tuples is True:
+        for row in cursor:
+            yield tuple(project(row))
+    else:
+        visible_fields = projection.visible_fields
+        for row in cursor:
+            output_row = ProjectedRow(izip(visible_fields,project(row)))
+            output_row.ordered_keys = visible_fields
+            yield output_row
 
 
 def get_xls_response(
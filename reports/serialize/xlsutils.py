@@ -5,6 +5,8 @@ import io
 import logging
 import numbers
 
+from PIL import Image
+import openpyxl
 import six
 import xlrd
 import xlsxwriter
@@ -159,19 +161,23 @@ def write_xls_image(worksheet, filerow, col, val, request):
     '''
     logger.debug('write image %r to row: %d col %d', val, filerow, col)
     try:
-        image = reports.serialize.resolve_image(request, val)
+        path = reports.serialize.resolve_image_file(val)
+        if path is not None:
+            # Embed the file bytes; PIL reads only the header for the size
+            with io.open(path, 'rb') as image_file:
+                bytes = io.BytesIO(image_file.read())
+            image = Image.open(bytes)
+        else:
+            image = reports.serialize.resolve_image(request, val)
+            bytes = io.BytesIO()
+            image.save(bytes, image.format)
         fullpath = request.build_absolute_uri(val)
-        # view, args, kwargs = resolve(val)
-        # kwargs['request'] = request
-        # response = view(*args, **kwargs)
-        # image = Image.open(io.BytesIO(response.content))
         height = image.size[1]
         width = image.size[0]
         worksheet.set_row(filerow, height)
         scaling = 0.130 # trial and error width in default excel font
         worksheet.set_column(col,col, width*scaling)
-        bytes = io.BytesIO()
-        image.save(bytes, image.format)
+        bytes.seek(0)
         worksheet.insert_image(filerow, col, fullpath, {'image_data': bytes })
     except Exception, e:
         logger.info('no image at: %r, %r', val,e)
@@ -182,11 +188,17 @@ def read_string(cell):
     - empty strings are convervted to None
     - integer cells are read as strings
     '''
-    value = cell.value
-    logger.debug('read string: %r: %r', cell, value)
+    logger.debug('read string: %r: %r', cell, cell.value)
+    return read_cell_string(cell.ctype, cell.value)
+
+def read_cell_string(ctype, value):
+    '''
+    Read the cell value as a string, given the xlrd cell type (as returned by 
+    Sheet.row_types), see read_string.
+    '''
     if value is None:
         return None
-    elif cell.ctype == xlrd.XL_CELL_NUMBER:
+    elif ctype == xlrd.XL_CELL_NUMBER:
         ival = int(value)
         if value == ival:
             value = ival
@@ -208,6 +220,75 @@ def sheet_rows(workbook_sheet):
     for row in range(workbook_sheet.nrows):
         yield read_row(row)
 
+def is_xlsx(file):
+    ''' XLSX workbooks are zip archives; the file position is not changed '''
+    position = file.tell()
+    signature = file.read(4)
+    file.seek(position)
+    return signature == b'PK\x03\x04'
+
+def read_xlsx_value(value):
+    '''
+    Read the (openpyxl) cell value as a string, as for read_cell_string
+    '''
+    if value is None:
+        return None
+    elif isinstance(value, bool):
+        return int(value)
+    elif isinstance(value, numbers.Number):
+        ival = int(value)
+        if value == ival:
+            value = ival
+        return str(value)
+    elif isinstance(value, six.string_types):
+        value = value.strip()
+        if not value:
+            return None
+        return value
+    elif hasattr(value, 'isoformat'):
+        return value.isoformat()
+    return value
+
+def xlsx_sheet_rows(file):
+    '''
+    Generate the rows of the first sheet of the XLSX workbook file:
+    - the workbook is opened in read-only mode, so that rows are read from the
+    file as they are generated
+    @return (sheet name, row generator)
+    '''
+    wb = openpyxl.load_workbook(file, read_only=True, data_only=True)
+    if len(wb.worksheets) > 1:
+        logger.warn('only first page of workbooks is supported')
+    sheet = wb.worksheets[0]
+    
+    def read_rows():
+        # Note: the sheet dimensions may include trailing (formatted) empty
+        # rows and columns:
+        # - as for xlrd "nrows", empty rows are only read if followed by a
+        # non-empty row,
+        # - rows are read to the width of the first (header) row
+        empty_row_count = 0
+        width = None
+        try:
+            for row in sheet.iter_rows():
+                values = [read_xlsx_value(cell.value) for cell in row]
+                if all(value is None for value in values):
+                    empty_row_count += 1
+                    continue
+                if width is None:
+                    width = len(values)
+                    while values[width-1] is None:
+                        width -= 1
+                for _ in range(empty_row_count):
+                    yield [None] * width
+                empty_row_count = 0
+                values = values[:width]
+                values.extend([None] * (width - len(values)))
+                yield values
+        finally:
+            wb.close()
+    return (sheet.title, read_rows())
+
 def sheet_rows_dicts(sheet):
     '''
     Read the sheet as an array of dicts, with the first row as the dict keys
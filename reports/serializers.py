@@ -5,6 +5,7 @@ from __future__ import unicode_literals
 import StringIO
 import cStringIO
 from collections import OrderedDict
+import io
 import json
 import logging
 
@@ -20,7 +21,8 @@ import xlrd
 from db.support import screen_result_importer
 from reports import BadRequestError
 from reports.serialize import XLSX_MIMETYPE, XLS_MIMETYPE, SDF_MIMETYPE, \
-    JSON_MIMETYPE, CSV_MIMETYPE, to_simple, LimsJSONEncoder
+    JSON_MIMETYPE, CSV_MIMETYPE, JSON_COLUMNAR_MIMETYPE, to_simple, \
+    LimsJSONEncoder
 from reports.serialize.csvutils import LIST_DELIMITER_CSV, dict_to_rows
 import reports.serialize.csvutils as csvutils
 import reports.serialize.sdfutils as sdfutils
@@ -248,6 +250,47 @@ class BaseSerializer(object):
             sort_keys=True, ensure_ascii=True, indent=json_indent, 
             encoding="utf-8")
 
+    def to_json_columnar(self, data, options=None):
+        '''
+        Serialize to the columnar JSON format (see json_columnar_generator):
+        { "meta": {...}, "fields": [field keys], "objects": [[row values]] }
+        '''
+        if isinstance(data, dict) and 'objects' in data:
+            meta = data.get('meta', {})
+            objects = data['objects']
+        elif isinstance(data, (list,tuple)):
+            meta = {}
+            objects = data
+        else:
+            return self.to_json(data, options=options)
+        fields = []
+        for obj in objects:
+            for key in obj.keys():
+                if key not in fields:
+                    fields.append(key)
+        return json.dumps(
+            OrderedDict((
+                ('meta', meta),
+                ('fields', fields),
+                ('objects', [ 
+                    [obj.get(key, None) for key in fields] 
+                        for obj in objects]),
+            )),
+            cls=LimsJSONEncoder, ensure_ascii=True, separators=(',',':'),
+            encoding="utf-8")
+    
+    def from_json_columnar(self, content, **kwargs):
+        '''
+        Deserialize the columnar JSON format, returning rows as dicts
+        '''
+        result = self.from_json(content, **kwargs)
+        if isinstance(result, dict) and 'fields' in result:
+            fields = result['fields']
+            result['objects'] = [
+                OrderedDict(zip(fields, row)) 
+                    for row in result.get('objects', [])]
+        return result
+
     def from_json(self, content, **kwargs):
         """
         Override to quote attributes from the client.
@@ -286,14 +329,19 @@ class SDFSerializer(BaseSerializer):
     
     def from_sdf(self, content, root='objects', **kwargs):
         '''
+        @param content a string, or a file-like object (iterable of lines); 
+            for a file-like object, the records are generated as the file is 
+            read (see sdfutils.parse_sdf)
         @param root - property to nest the return object iterable in for the 
             response (None if no nesting, and return object will be an iterable)
 
         '''
-        if isinstance(content, six.binary_type):
-            content = force_text(content)
-         
-        objects = sdfutils.parse_sdf(content)
+        if isinstance(content, six.string_types):
+            if isinstance(content, six.binary_type):
+                content = force_text(content)
+            objects = tuple(sdfutils.parse_sdf(content))
+        else:
+            objects = sdfutils.parse_sdf(content)
         if root and not isinstance(objects, dict):
             return { root: objects }
         else:
@@ -337,37 +385,41 @@ class XLSSerializer(BaseSerializer):
 
     def from_xls(self, content, root='objects', list_keys=None, 
             list_delimiters=None, **kwargs):
-        
+        '''
+        @param content a string, or a seekable file-like object (e.g. the 
+            uploaded file): XLSX workbooks are read in read-only mode, so that 
+            the rows are generated as the file is read; for XLS workbooks, only
+            the first sheet is loaded
+        '''
         logger.info('deserialize from_xls...')
         if isinstance(content, six.string_types):
-            wb = xlrd.open_workbook(file_contents=content)
+            content = io.BytesIO(content)
+        
+        if xlsutils.is_xlsx(content):
+            sheet_name, sheet_rows = xlsutils.xlsx_sheet_rows(content)
         else:
-            wb = xlrd.open_workbook(cStringIO.StringIO(content))
+            wb = xlrd.open_workbook(
+                file_contents=content.read(), on_demand=True)
+            if wb.nsheets > 1:
+                # TODO: concatentate all sheets?
+                logger.warn('only first page of workbooks is supported')
             
-        if wb.nsheets > 1:
-            # TODO: concatentate all sheets?
-            logger.warn('only first page of workbooks is supported')
-        
-        logger.info('read first sheet ...') 
-        # TODO: if root is specified, then get the sheet by name
-        sheet = wb.sheet_by_index(0)
+            logger.info('read first sheet ...') 
+            # TODO: if root is specified, then get the sheet by name
+            sheet = wb.sheet_by_index(0)
+            sheet_name = sheet.name
+            sheet_rows = xlsutils.sheet_rows(sheet)
          
-        if sheet.name.lower() in ['error', 'errors']:
-            return xlsutils.sheet_rows(sheet)
+        if sheet_name.lower() in ['error', 'errors']:
+            return sheet_rows
              
         list_delimiters = list_delimiters or [LIST_DELIMITER_XLS,]
         
         # Workbooks are treated like sets of csv sheets
         data = csvutils.input_spreadsheet_reader(
-            xlsutils.sheet_rows(sheet), 
+            sheet_rows, 
             list_delimiters=list_delimiters, 
             list_keys=list_keys)
-        
-        # # TODO: use csv_generator
-        # data = csvutils.input_spreadsheet_reader(
-        #     xlsutils.sheet_rows(sheet),
-        #     list_delimiters=list_delimiters, 
-        #     list_keys=list_keys)
  
         if root:
             return { root: data }
@@ -432,18 +484,22 @@ class CSVSerializer(BaseSerializer):
     def from_csv(self, content, root='objects', list_keys=None, 
             list_delimiters=None, **kwargs):
         '''
+        @param content a string, or a file-like object (iterable of lines); 
+            for a file-like object, the rows are generated as the file is read
         @param root - property to nest the return object iterable in for the 
             response (None if no nesting, and return object will be an iterable)
 
         '''
-        if isinstance(content, six.binary_type):
-            content = force_text(content)
+        if isinstance(content, six.string_types):
+            if isinstance(content, six.binary_type):
+                content = force_text(content)
+            # Note: do not use cStringIO here, because Unicode data will be read
+            content = StringIO.StringIO(content)
+        else:
+            content = csvutils.utf_8_decoder(content)
 
         data = csvutils.from_csv(
-            StringIO.StringIO(content),
-            # Note: do not use cStringIO here, because Unicode data will be read
-            # cStringIO.StringIO(content),
-            list_keys=list_keys, list_delimiters=list_delimiters)
+            content, list_keys=list_keys, list_delimiters=list_delimiters)
         if root:
             return { root: data }
         else:
@@ -458,6 +514,7 @@ class ScreenResultSerializer(XLSSerializer,SDFSerializer,CSVSerializer):
             ('xls', XLS_MIMETYPE),
             ('xlsx', XLSX_MIMETYPE),
             ('csv', CSV_MIMETYPE),
+            ('json_columnar', JSON_COLUMNAR_MIMETYPE),
             ('json', JSON_MIMETYPE),
          ))
 
@@ -477,7 +534,7 @@ class ScreenResultSerializer(XLSSerializer,SDFSerializer,CSVSerializer):
         if isinstance(content, six.string_types):
             wb = xlrd.open_workbook(file_contents=content)
         else:
-            wb = xlrd.open_workbook(cStringIO.StringIO(content))
+            wb = xlrd.open_workbook(file_contents=content.read())
         return screen_result_importer.read_workbook(wb)
 
     def to_json(self, data, options=None):
@@ -613,6 +670,7 @@ class LimsSerializer(CSVSerializer,SDFSerializer, XLSSerializer):
             ('xls', XLS_MIMETYPE),
             ('xlsx', XLSX_MIMETYPE),
             ('csv', CSV_MIMETYPE),
+            ('json_columnar', JSON_COLUMNAR_MIMETYPE),
             ('json', JSON_MIMETYPE),
          ))
 
@@ -1,17 +1,24 @@
 from __future__ import unicode_literals
 
+import base64
 from collections import OrderedDict
+import datetime
+import decimal
 from functools import wraps
 import hashlib
 import json
 import logging
 import re
+import threading
 import urllib
 
 from aldjemy.core import get_engine, get_tables
+import dateutil.parser
 from django.conf import settings
+from django.db import connection, transaction
 from django.http.request import HttpRequest
 from django.http.response import StreamingHttpResponse, HttpResponse, Http404
+import psycopg2.extensions
 import six
 from sqlalchemy import select, asc, text
 import sqlalchemy
@@ -28,15 +35,19 @@ import sqlalchemy.sql.sqltypes
 from reports import LIST_DELIMITER_SQL_ARRAY, LIST_DELIMITER_URL_PARAM, \
     LIST_BRACKETS, MAX_IMAGE_ROWS_PER_XLS_FILE, MAX_ROWS_PER_XLS_FILE, \
     HTTP_PARAM_RAW_LISTS, HTTP_PARAM_DATA_INTERCHANGE, HTTP_PARAM_USE_TITLES, \
-    HTTP_PARAM_USE_VOCAB, BadRequestError
+    HTTP_PARAM_USE_VOCAB, HTTP_PARAM_PRETTY_JSON, BadRequestError
 from reports.api_base import IccblBaseResource, un_cache
 import reports.schema as SCHEMA
 from reports.serialize import XLSX_MIMETYPE, SDF_MIMETYPE, XLS_MIMETYPE, \
-    JSON_MIMETYPE, CSV_MIMETYPE, parse_val
+    JSON_MIMETYPE, CSV_MIMETYPE, JSON_COLUMNAR_MIMETYPE, parse_val
 from reports.serialize.streaming_serializers import sdf_generator, \
     json_generator, get_xls_response, csv_generator, ChunkIterWrapper, \
-    cursor_generator, image_generator, closing_iterator_wrapper
+    cursor_generator, image_generator, closing_iterator_wrapper, \
+    json_columnar_generator, image_tuple_generator
 from reports.serializers import LimsSerializer
+from reports.utils.copy_stream import copy_to_generator
+from reports.utils.result_cache import get_statement_tables, get_table_tags, \
+    is_tag_current, count_cache_stat, get_tagged, set_tagged
 
 
 logger = logging.getLogger(__name__)
@@ -51,6 +62,22 @@ DATA_TYPE = SCHEMA.VOCAB.field.data_type
 VISIBILITY = SCHEMA.VOCAB.field.visibility
 FILTER_TYPE = SCHEMA.VOCAB.filter_type
 
+# Policies for the "total_count" of list responses
+COUNT_POLICY_EXACT = 'exact'
+COUNT_POLICY_ESTIMATED = 'estimated'
+COUNT_POLICY_DEFERRED = 'deferred'
+COUNT_POLICIES = (
+    COUNT_POLICY_EXACT, COUNT_POLICY_ESTIMATED, COUNT_POLICY_DEFERRED)
+
+# PostgreSQL integer types: output identically by COPY and csv_generator
+COPY_INTEGER_TYPES = (
+    psycopg2.extensions.INTEGER.values 
+    + psycopg2.extensions.LONGINTEGER.values)
+
+# Deferred count statements being executed in this process
+_deferred_counts = set()
+_deferred_counts_lock = threading.Lock()
+
 def _concat(*args):
     '''
     Use as a replacement for sqlalchemy.sql.functions.concat
@@ -392,9 +419,192 @@ class SqlAlchemyResource(IccblBaseResource):
                     'order_by field %r not in visible fields, skipping: ', 
                     order_by)
         if DEBUG_ORDERING:
-            logger.info('order_clauses %s',order_clauses)     
+            logger.info('order_clauses %s',order_clauses)
         return order_clauses
-    
+
+    @staticmethod
+    def build_sqlalchemy_keyset(order_params, visible_fields, id_attribute):
+        '''
+        Return the keyset for "seek" pagination: a list of
+        (field_name, is_descending, is_alphanumeric), for the order_params,
+        followed by the id_attribute fields, so that the ordering is unique.
+
+        @param order_params passed as list in the request.GET hash
+        @param id_attribute the schema id_attribute fields
+        '''
+        if order_params and isinstance(order_params, basestring):
+            order_params = [order_params]
+        keyset = []
+        for order_by in (order_params or []):
+            field_name = order_by
+            is_descending = False
+            if order_by.startswith(FILTER_TYPE.INVERTED):
+                field_name = order_by[1:]
+                is_descending = True
+            field = visible_fields.get(field_name, None)
+            if field is None:
+                logger.warn(
+                    'order_by field %r not in visible fields, skipping: ',
+                    order_by)
+                continue
+            if field_name in [key[0] for key in keyset]:
+                continue
+            is_alphanumeric = (
+                field[FIELD.DATA_TYPE] == DATA_TYPE.STRING
+                and field.get(FIELD.IS_ALPHANUMERIC, False) is True )
+            keyset.append((field_name, is_descending, is_alphanumeric))
+        for field_name in id_attribute:
+            if field_name in [key[0] for key in keyset]:
+                continue
+            if field_name not in visible_fields:
+                raise BadRequestError({
+                    'after': 'id field must be included for '
+                        'keyset pagination: %r' % field_name })
+            keyset.append((field_name, False, False))
+        return keyset
+
+    @staticmethod
+    def _keyset_sort_keys(keyset, values=None):
+        '''
+        Return a list of (sort expression, is_descending, value) for the
+        keyset: alphanumeric fields are sorted by the numeric prefix, then
+        by the text remainder (see build_sqlalchemy_ordering).
+        '''
+        sort_keys = []
+        for i, (field_name, is_descending, is_alphanumeric) in \
+                enumerate(keyset):
+            value = values[i] if values is not None else None
+            if is_alphanumeric is not True:
+                sort_keys.append((column(field_name), is_descending, value))
+                continue
+            number_value = None
+            text_value = None
+            if value is not None:
+                value = six.text_type(value)
+                match = re.match(r'^[0-9]+', value)
+                if match:
+                    number_value = int(match.group())
+                match = re.search(r'[^0-9_].*$', value)
+                if match:
+                    text_value = match.group()
+            sort_keys.append((
+                literal_column(
+                    "(substring({field_name}, '^[0-9]+'))::int"
+                    .format(field_name=field_name)),
+                is_descending, number_value))
+            sort_keys.append((
+                literal_column(
+                    "substring({field_name}, '[^0-9_].*$')"
+                    .format(field_name=field_name)),
+                is_descending, text_value))
+        return sort_keys
+
+    @classmethod
+    def wrap_keyset_statement(cls, stmt, keyset, values=None):
+        '''
+        Wrap the statement for keyset pagination:
+        - order by the keyset,
+        - if values are given, select only the rows that sort after the values.
+
+        Note: nulls sort first in ascending order and last in descending order,
+        as for build_sqlalchemy_ordering.
+
+        @param stmt a select statement, with columns labeled by field_name
+        @param values of the keyset fields for the last row of the prior page
+        '''
+        stmt = select([text('*')]).select_from(Alias(stmt.order_by(None)))
+        sort_keys = cls._keyset_sort_keys(keyset, values)
+        order_clauses = []
+        for expression, is_descending, value in sort_keys:
+            if is_descending:
+                order_clauses.append(nullslast(desc(expression)))
+            else:
+                order_clauses.append(nullsfirst(asc(expression)))
+        if values is not None:
+            # Row comparison is not used because sort direction and null
+            # ordering may vary per key:
+            # (k1 > v1) or (k1 = v1 and k2 > v2) or ...
+            seek_clauses = []
+            equal_clauses = []
+            for expression, is_descending, value in sort_keys:
+                if is_descending:
+                    if value is None:
+                        after_clause = None
+                    else:
+                        after_clause = or_(
+                            expression < value, expression.is_(None))
+                else:
+                    if value is None:
+                        after_clause = expression.isnot(None)
+                    else:
+                        after_clause = expression > value
+                if after_clause is not None:
+                    seek_clauses.append(and_(*(equal_clauses+[after_clause])))
+                if value is None:
+                    equal_clauses.append(expression.is_(None))
+                else:
+                    equal_clauses.append(expression == value)
+            if seek_clauses:
+                stmt = stmt.where(or_(*seek_clauses))
+            else:
+                stmt = stmt.where(text('false'))
+        return stmt.order_by(*order_clauses)
+
+    @staticmethod
+    def encode_keyset_token(keyset, row):
+        '''
+        Return an opaque token for the keyset values of the row.
+        - values are encoded as [type tag, value], so that decimal, date and
+        datetime values are restored exactly on decode (JSON would convert
+        decimals to floats and dates to strings).
+        '''
+        values = []
+        for key in keyset:
+            value = row[key[0]]
+            if isinstance(value, decimal.Decimal):
+                value = ['decimal', six.text_type(value)]
+            elif isinstance(value, datetime.datetime):
+                value = ['datetime', value.isoformat()]
+            elif isinstance(value, datetime.date):
+                value = ['date', value.isoformat()]
+            else:
+                value = [None, value]
+            values.append(value)
+        token = {
+            'keys': [key[0] for key in keyset],
+            'values': values }
+        return base64.urlsafe_b64encode(json.dumps(token, ensure_ascii=True))
+
+    @staticmethod
+    def decode_keyset_token(keyset, token):
+        '''
+        Return the keyset values encoded in the token.
+        '''
+        try:
+            token = json.loads(base64.urlsafe_b64decode(str(token)))
+            keys = token['keys']
+            values = []
+            for type_tag, value in token['values']:
+                if value is None or type_tag is None:
+                    pass
+                elif type_tag == 'decimal':
+                    value = decimal.Decimal(value)
+                elif type_tag == 'datetime':
+                    value = dateutil.parser.parse(value)
+                elif type_tag == 'date':
+                    value = datetime.datetime.strptime(value, '%Y-%m-%d').date()
+                else:
+                    raise ValueError('unknown type tag: %r' % type_tag)
+                values.append(value)
+        except Exception:
+            logger.warn('invalid keyset token: %r', token)
+            raise BadRequestError({ 'after': 'Invalid token: %r' % token })
+        if keys != [key[0] for key in keyset] or len(values) != len(keys):
+            raise BadRequestError({
+                'after': 'Token does not match the ordering: %r, %r'
+                    % (keys, [key[0] for key in keyset]) })
+        return values
+
     @staticmethod
     def parse_filter_value(value, filter_type):
         if isinstance(value, six.string_types):
@@ -723,7 +933,136 @@ class SqlAlchemyResource(IccblBaseResource):
 
         return (filter_hash, readable_filter_hash)
 
-    def _cached_resultproxy(self, conn, stmt, count_stmt, param_hash, limit, offset):
+    @staticmethod
+    def estimate_count(conn, count_stmt):
+        '''
+        Return the query planner estimate of the number of rows counted by the 
+        count_stmt (see wrap_statement), using "EXPLAIN".
+        '''
+        compiled_stmt = str(count_stmt.compile(
+            dialect=postgresql.dialect(), 
+            compile_kwargs={"literal_binds": True}))
+        # Note: use the DBAPI cursor, so that the literal statement is not
+        # parsed for bind params
+        cursor = conn.connection.cursor()
+        try:
+            cursor.execute('EXPLAIN (FORMAT JSON) ' + compiled_stmt)
+            plan = cursor.fetchone()[0]
+        finally:
+            cursor.close()
+        if isinstance(plan, basestring):
+            plan = json.loads(plan)
+        plan = plan[0]['Plan']
+        # The count aggregate returns one row: use the estimate of the rows 
+        # aggregated
+        if plan.get('Node Type') == 'Aggregate' and plan.get('Plans'):
+            plan = plan['Plans'][0]
+        return int(plan['Plan Rows'])
+
+    def get_deferred_count(self, conn, count_stmt):
+        '''
+        Return (count, policy) for the count_stmt:
+        - if the count has been computed, return (count, COUNT_POLICY_EXACT),
+        - otherwise start a background thread to compute the count and store it
+        in the result cache, and return the planner estimate, 
+        (estimate, COUNT_POLICY_DEFERRED).
+        '''
+        compiled_stmt = str(count_stmt.compile(
+            dialect=postgresql.dialect(), 
+            compile_kwargs={"literal_binds": True}))
+        m = hashlib.md5()
+        m.update('deferred_count_%s' % compiled_stmt)
+        key = m.hexdigest()
+        cache = self.get_cache()
+        count = get_tagged(cache, key)
+        if count is not None:
+            return (count, COUNT_POLICY_EXACT)
+        
+        with _deferred_counts_lock:
+            is_running = key in _deferred_counts
+            if not is_running:
+                _deferred_counts.add(key)
+        if not is_running:
+            tables = get_statement_tables(count_stmt)
+            # Obtain the tags before counting, so that writes made during the
+            # count evict the result
+            tags = get_table_tags(cache, tables)
+            
+            def deferred_count():
+                try:
+                    _conn = get_engine().connect()
+                    try:
+                        count = _conn.execute(count_stmt).scalar()
+                    finally:
+                        _conn.close()
+                    logger.info('deferred count: %d, %r', count, key)
+                    set_tagged(cache, key, count, timeout=None, tags=tags)
+                except Exception:
+                    logger.exception('deferred count failed: %r', 
+                        compiled_stmt)
+                finally:
+                    with _deferred_counts_lock:
+                        _deferred_counts.discard(key)
+                    # Django opens a connection for each thread
+                    connection.close()
+            
+            thread = threading.Thread(
+                target=deferred_count, name='deferred_count_%s' % key)
+            thread.daemon = True
+            thread.start()
+        
+        return (self.estimate_count(conn, count_stmt), COUNT_POLICY_DEFERRED)
+    
+    def get_total_count(self, conn, count_stmt, count_policy):
+        '''
+        Return (count, policy used) for the count_stmt, using the count_policy:
+        - COUNT_POLICY_EXACT: execute the count_stmt,
+        - COUNT_POLICY_ESTIMATED: return the query planner estimate,
+        - COUNT_POLICY_DEFERRED: see get_deferred_count
+        '''
+        if count_policy == COUNT_POLICY_ESTIMATED:
+            return (self.estimate_count(conn, count_stmt), count_policy)
+        elif count_policy == COUNT_POLICY_DEFERRED:
+            return self.get_deferred_count(conn, count_stmt)
+        else:
+            return (conn.execute(count_stmt).scalar(), COUNT_POLICY_EXACT)
+
+    @staticmethod
+    def execute_server_side(conn, stmt, fetch_size=None):
+        '''
+        Execute the stmt using a named (server side) cursor, and return an
+        iterator over the result rows:
+        - rows are fetched in batches of (up to) fetch_size rows (default:
+        settings.STREAMING_FETCH_SIZE), so that memory use is bounded by the
+        fetch size, rather than by the size of the result set.
+        
+        NOTE: a named cursor must be used within a transaction: the 
+        transaction.atomic block is held open across the yields, until the 
+        iterator is exhausted or closed; the caller must ensure that:
+        - the iterator is consumed, or closed, on the thread that started it: 
+        the atomic block belongs to the Django connection of that thread (the 
+        aldjemy conn uses the Django connection),
+        - the iterator is closed if it is not exhausted: wrap it with 
+        closing_iterator_wrapper, and return it as the content of a 
+        StreamingHttpResponse (the response closes the content when it is 
+        closed, also if the client disconnects). Until then, the transaction,
+        and the connection, are held.
+        '''
+        if fetch_size is None:
+            fetch_size = getattr(settings, 'STREAMING_FETCH_SIZE', 2000)
+        with transaction.atomic():
+            result = conn.execution_options(
+                stream_results=True, max_row_buffer=fetch_size).execute(stmt)
+            if DEBUG_STREAMING:
+                logger.info('executed stmt, fetch size: %d', fetch_size)
+            try:
+                for row in result:
+                    yield row
+            finally:
+                result.close()
+    
+    def _cached_resultproxy(self, conn, stmt, count_stmt, param_hash, limit, 
+            offset, count_policy=COUNT_POLICY_EXACT):
         ''' 
         Cache for resultsets:
         - Always returns the cache object with a resultset, either from the cache,
@@ -732,6 +1071,8 @@ class SqlAlchemyResource(IccblBaseResource):
         NOTE: limit and offset are included because this version of sqlalchemy
         does not support printing of them with the select.compile() function.
         
+        @param count_policy the total_count policy: the cache entry 
+        "count_policy" records the policy used for the "count"
         '''
         # Limit check removed with the use of "use_caching" flag
         # if limit == 0:
@@ -754,7 +1095,8 @@ class SqlAlchemyResource(IccblBaseResource):
                 compiled_stmt[:compiled_stmt.lower().rfind('limit')]
         if DEBUG_CACHE:
             logger.info('compiled_stmt for hash key: %s', compiled_stmt)
-        key_digest = '%s_%s_%s' %(compiled_stmt, str(limit), str(offset))
+        key_digest = '%s_%s_%s_%s' %(
+            compiled_stmt, str(limit), str(offset), count_policy)
         m = hashlib.md5()
         m.update(key_digest)
         key = m.hexdigest()
@@ -768,9 +1110,17 @@ class SqlAlchemyResource(IccblBaseResource):
                     cache_hit['stmt'] != compiled_stmt):
                 cache_hit = None
                 logger.warn('cache collision for key: %r, %r', key, stmt)
+            elif not is_tag_current(self.get_cache(), cache_hit.get('tags')):
+                if DEBUG_CACHE:
+                    logger.info('evict, tables modified: %r', 
+                        cache_hit.get('tags'))
+                self.get_cache().delete(key)
+                count_cache_stat('stale_evictions')
+                cache_hit = None
         
         if cache_hit is None:
         
+            count_cache_stat('misses')
             if DEBUG_CACHE:
                 logger.info('no cache hit for key: %r, executing stmt', key)
             
@@ -790,6 +1140,14 @@ class SqlAlchemyResource(IccblBaseResource):
             if new_limit > 0:
                 stmt = stmt.limit(new_limit)
             
+            # Tag the cached results with the tables read by the statement;
+            # obtain the tags before executing, so that writes made during 
+            # the query evict the results
+            tables = get_statement_tables(stmt)
+            if DEBUG_CACHE:
+                logger.info('tables for cache tags: %r', tables)
+            tags = get_table_tags(self.get_cache(), tables)
+            
             resultset = conn.execute(stmt)
             prefetched_result = [
                 dict(row) for row in resultset] if resultset else []
@@ -797,6 +1155,7 @@ class SqlAlchemyResource(IccblBaseResource):
             if DEBUG_CACHE:
                 logger.info('executed stmt %d', len(prefetched_result))
             
+            used_count_policy = COUNT_POLICY_EXACT
             if len(prefetched_result) < new_limit and offset == 0:
                 # Optimize, skip count if first page and less than limit are found.
                 count = len(prefetched_result)
@@ -808,7 +1167,8 @@ class SqlAlchemyResource(IccblBaseResource):
                         logger.info('set count to 1, detail view')
                     count = 1
                 else:
-                    count = conn.execute(count_stmt).scalar()
+                    (count, used_count_policy) = self.get_total_count(
+                        conn, count_stmt, count_policy)
             
             if limit==0 and count > settings.MAX_ROWS_FOR_CACHE_RESULTPROXY:
                 logger.warn('too many rows to cache: %r, limit: %r, '
@@ -830,8 +1190,9 @@ class SqlAlchemyResource(IccblBaseResource):
                 if _start < len(prefetched_result):
                     # Create a more specific cache key for the exact number of rows
                     
-                    key_digest = '%s_%s_%s' %(
-                        compiled_stmt, str(limit), str(new_offset))
+                    key_digest = '%s_%s_%s_%s' %(
+                        compiled_stmt, str(limit), str(new_offset), 
+                        count_policy)
                     m = hashlib.md5()
                     m.update(key_digest)
                     key = m.hexdigest()
@@ -843,6 +1204,8 @@ class SqlAlchemyResource(IccblBaseResource):
                         'stmt': compiled_stmt,
                         'cached_result': _result,
                         'count': count,
+                        'count_policy': used_count_policy,
+                        'tags': tags,
                         'key': key }
                     if DEBUG_CACHE:
                         logger.info(
@@ -862,6 +1225,7 @@ class SqlAlchemyResource(IccblBaseResource):
             if DEBUG_CACHE:
                 logger.info('store cached iterations: %s', cached_count)
         else:
+            count_cache_stat('hits')
             if DEBUG_CACHE:
                 logger.info('cache hit for key: %r', key)   
             
@@ -879,6 +1243,25 @@ class SqlAlchemyResource(IccblBaseResource):
         - self.use_caching is True, use_caching is not False, and limit > 0, or,
         - limit == 0 and use_caching is True
         
+        Keyset pagination: if the "after" param is sent, use the keyset
+        ("seek") mode in place of the offset:
+        - the rows are ordered by the "order_by" fields, then by the
+        id_attribute fields,
+        - "after" is empty for the first page, or the "next_after" token from
+        the prior response "meta"; only rows that sort after the last row of
+        the prior page are selected, so that each page costs the same as the
+        first page.
+        
+        Total count (for json responses only): the "total_count_policy" param
+        (default: settings.DEFAULT_TOTAL_COUNT_POLICY) is one of:
+        - "exact": execute the count statement,
+        - "estimated": use the query planner row estimate,
+        - "deferred": use the estimate, and compute the exact count in a
+        background thread; the exact count is served from the result cache for
+        subsequent requests.
+        The meta "total_count_policy" reports the policy used for the 
+        "total_count": "exact", "estimated" or "deferred" (an estimate, the 
+        exact count is pending).
         '''
         
         debug_param_hash = param_hash.copy()
@@ -894,10 +1277,6 @@ class SqlAlchemyResource(IccblBaseResource):
         except Exception:
             raise BadRequestError({
                 'limit': 'Please provide a positive integer: %r' % limit})
-        if limit > 0:    
-            stmt = stmt.limit(limit)
-        if is_for_detail:
-            limit = 1
 
         offset = param_hash.get('offset', 0 )
         try:
@@ -907,8 +1286,34 @@ class SqlAlchemyResource(IccblBaseResource):
                 'offset': 'Please provide a positive integer: %r' % offset })
         if offset < 0:    
             offset = -offset
+        
+        count_policy = param_hash.get('total_count_policy', 
+            getattr(settings, 'DEFAULT_TOTAL_COUNT_POLICY', COUNT_POLICY_EXACT))
+        if count_policy not in COUNT_POLICIES:
+            raise BadRequestError({
+                'total_count_policy': 'Must be one of: %r, %r' 
+                    % (COUNT_POLICIES, count_policy) })
+        
+        after = param_hash.get('after', None)
+        keyset = None
+        if after is not None and is_for_detail is not True:
+            schema = self.build_schema(user=request.user)
+            keyset = self.build_sqlalchemy_keyset(
+                param_hash.get('order_by', []), field_hash, 
+                schema['id_attribute'])
+            after_values = None
+            if after:
+                after_values = self.decode_keyset_token(keyset, after)
+            stmt = self.wrap_keyset_statement(stmt, keyset, after_values)
+            offset = 0
+        
+        if limit > 0:    
+            stmt = stmt.limit(limit)
+        if is_for_detail:
+            limit = 1
         stmt = stmt.offset(offset)
         
+        row_converters = None
         conn = get_engine().connect()
         
         if DEBUG_STREAMING:
@@ -932,7 +1337,7 @@ class SqlAlchemyResource(IccblBaseResource):
             self.get_serializer().get_accept_content_type(request)
 
         result = None
-        if content_type == JSON_MIMETYPE:
+        if content_type in [JSON_MIMETYPE, JSON_COLUMNAR_MIMETYPE]:
             # Check cache
             # Create response "meta" counts
             
@@ -945,14 +1350,22 @@ class SqlAlchemyResource(IccblBaseResource):
                     and ( use_caching is True or limit > 0)
                     and is_for_detail is not True):
                 cache_hit = self._cached_resultproxy(
-                    conn, stmt, count_stmt, param_hash, limit, offset)
+                    conn, stmt, count_stmt, param_hash, limit, offset,
+                    count_policy=count_policy)
                 if cache_hit:
                     result = cache_hit['cached_result']
                     count = cache_hit['count']
+                    used_count_policy = cache_hit.get(
+                        'count_policy', COUNT_POLICY_EXACT)
+                    if used_count_policy == COUNT_POLICY_DEFERRED:
+                        # check if the deferred count is finished
+                        (count, used_count_policy) = \
+                            self.get_deferred_count(conn, count_stmt)
                 else:
                     # cache routine should always return a cache object
                     logger.info('cache not set: execute stmt')
-                    count = conn.execute(count_stmt).scalar()
+                    (count, used_count_policy) = self.get_total_count(
+                        conn, count_stmt, count_policy)
                     result = conn.execute(stmt)
                 logger.info('====count: %d, limit: %d ====', count, limit)
                 
@@ -964,7 +1377,12 @@ class SqlAlchemyResource(IccblBaseResource):
                 #     compile_kwargs={"literal_binds": True}))
                 # logger.info('compiled count stmt: %s', compiled_stmt)
                 
-                count = conn.execute(count_stmt).scalar()
+                if is_for_detail:
+                    (count, used_count_policy) = (
+                        conn.execute(count_stmt).scalar(), COUNT_POLICY_EXACT)
+                else:
+                    (count, used_count_policy) = self.get_total_count(
+                        conn, count_stmt, count_policy)
                 if DEBUG_STREAMING:
                     logger.info('excuted count stmt: %d', count)
                 result = conn.execute(stmt)
@@ -975,19 +1393,31 @@ class SqlAlchemyResource(IccblBaseResource):
                 meta = {
                     'limit': limit,
                     'offset': offset,
-                    'total_count': count
+                    'total_count': count,
+                    'total_count_policy': used_count_policy
                     }
             else:
                 temp = {
                     'limit': limit,
                     'offset': offset,
-                    'total_count': count
+                    'total_count': count,
+                    'total_count_policy': used_count_policy
                     }
                 temp.update(meta)    
                 meta = temp
             
+            if keyset is not None:
+                # Read the page, to create the token for the next page
+                result = list(result)
+                meta['after'] = after
+                meta['next_after'] = None
+                if limit > 0 and len(result) == limit:
+                    meta['next_after'] = \
+                        self.encode_keyset_token(keyset, result[-1])
+            
             if rowproxy_generator:
-                result = rowproxy_generator(result)
+                result, row_converters = self.apply_rowproxy_generator(
+                    rowproxy_generator, result)
                 
             if DEBUG_STREAMING:
                 logger.info('is for detail: %r, count: %r', is_for_detail, count)
@@ -1000,13 +1430,24 @@ class SqlAlchemyResource(IccblBaseResource):
                 logger.info('json setup done, s: %r', meta)
 
         else: # not json
-        
-            logger.info('excute stmt')
-            result = conn.execute(stmt)
-            logger.info('excuted stmt')
+            
+            if (content_type == CSV_MIMETYPE and rowproxy_generator is None
+                    and is_for_detail is not True):
+                copy_csv = self.build_copy_csv_statement(
+                    conn, stmt, field_hash, param_hash, 
+                    title_function=title_function)
+                if copy_csv is not None:
+                    conn.close()
+                    (copy_stmt, header) = copy_csv
+                    return self.stream_response_from_copy(
+                        copy_stmt, header, output_filename)
+            
+            logger.info('excute stmt, using a server side cursor')
+            result = self.execute_server_side(conn, stmt)
             
             if rowproxy_generator:
-                result = rowproxy_generator(result)
+                result, row_converters = self.apply_rowproxy_generator(
+                    rowproxy_generator, result)
         
         result = closing_iterator_wrapper(result, conn.close)
         return self.stream_response_from_cursor(
@@ -1014,16 +1455,171 @@ class SqlAlchemyResource(IccblBaseResource):
             is_for_detail=is_for_detail, 
             downloadID=downloadID, 
             title_function=title_function, 
-            meta=meta, format=format)
+            meta=meta, format=format, row_converters=row_converters)
+    
+    @staticmethod
+    def apply_rowproxy_generator(rowproxy_generator, result):
+        '''
+        Wrap the result with the rowproxy_generator:
+        - the outermost generators that expose "row_converters" (see 
+        ApiResource.create_vocabulary_rowproxy_generator) are not applied; 
+        their converters are returned, to be applied by the cursor_generator.
+        
+        @return (result, row_converters) - the converters are listed in the 
+        order that the generators would apply them.
+        '''
+        row_converters = []
+        generator = rowproxy_generator
+        while (generator is not None 
+                and getattr(generator, 'row_converters', None) is not None):
+            row_converters.insert(0, generator.row_converters)
+            generator = generator.extant_generator
+        if generator is not None:
+            result = generator(result)
+        return result, row_converters
+    
+    def build_copy_csv_statement(
+            self, conn, stmt, field_hash, param_hash, title_function=None):
+        '''
+        Return (copy_sql, header) - a "COPY (...) TO STDOUT WITH CSV" statement
+        for the stmt, and the CSV header line - if the CSV output of the COPY 
+        matches the output of csv_generator, otherwise return None:
+        - no image, list, or value template fields, 
+        - all visible fields are columns of the stmt, of the PostgreSQL types 
+        that are output identically: integer, text, boolean, date, and numeric
+        table columns having a scale of at most 6 (python Decimal uses 
+        exponent notation for smaller values); float and timestamp columns 
+        are serialized by the csv_generator,
+        - (the caller must check that there is no rowproxy_generator).
+        
+        NOTE: the COPY is run on the connection of the copy_to_generator
+        thread, so the fast path is not used inside a transaction, as the 
+        COPY would not see the uncommitted data.
+        NOTE: text values containing a carriage return (without a line feed),
+        or equal to "\\.", are quoted by the COPY (but not by csv_generator);
+        both are read as the same value.
+        '''
+        if param_hash.get(HTTP_PARAM_DATA_INTERCHANGE, False):
+            return None
+        if connection.in_atomic_block:
+            return None
+        for key, field in field_hash.items():
+            if field.get(FIELD.DISPLAY_TYPE, None) == 'image':
+                return None
+            if field.get(FIELD.VALUE_TEMPLATE):
+                return None
+            if ( field.get('json_field_type',None) == 'fields.ListField' 
+                    or field.get('linked_field_type',None) == 'fields.ListField'
+                    or field.get(FIELD.DATA_TYPE) == DATA_TYPE.LIST ):
+                return None
+        
+        ordered_keys = sorted(field_hash.keys(), 
+            key=lambda x: field_hash[x].get(FIELD.ORDINAL,x))
+        if len(ordered_keys) < 2:
+            # csv writes a single empty value as '""'
+            return None
+        
+        result = conn.execute(stmt.limit(0))
+        stmt_columns = { col.name: col for col in result.cursor.description }
+        result.close()
+        missing_columns = set(ordered_keys) - set(stmt_columns.keys())
+        if missing_columns:
+            logger.info('not all fields are columns, not using copy: %r',
+                missing_columns)
+            return None
+        
+        numeric_columns = { key: stmt_columns[key] for key in ordered_keys
+            if stmt_columns[key].type_code in psycopg2.extensions.DECIMAL.values }
+        numeric_scales = self._get_column_scales(conn, numeric_columns)
+        
+        columns = []
+        for key in ordered_keys:
+            col = column(key)
+            type_code = stmt_columns[key].type_code
+            if type_code in COPY_INTEGER_TYPES:
+                pass
+            elif type_code in psycopg2.extensions.UNICODE.values:
+                # csv_generator writes empty strings as NULL (unquoted)
+                col = func.nullif(col, '')
+            elif type_code in psycopg2.extensions.BOOLEAN.values:
+                # Match csvutils.convert_list_vals
+                col = sqlalchemy.case(
+                    [(col == True, 'TRUE'), (col == False, 'FALSE')], 
+                    else_=None)
+            elif type_code in psycopg2.extensions.DATE.values:
+                # Match date.isoformat, regardless of the DateStyle
+                col = func.to_char(col, 'YYYY-MM-DD')
+            elif type_code in psycopg2.extensions.DECIMAL.values:
+                scale = numeric_scales.get(key)
+                if scale is None or scale > 6:
+                    logger.info(
+                        'numeric column scale: %r, not using copy: %r', 
+                        scale, key)
+                    return None
+            else:
+                logger.info('column type: %r, not using copy: %r', 
+                    type_code, key)
+                return None
+            columns.append(col)
+        copy_select = select(columns).select_from(Alias(stmt))
+        compiled_stmt = str(copy_select.compile(
+            dialect=postgresql.dialect(), 
+            compile_kwargs={"literal_binds": True}))
+        
+        header = next(csv_generator(
+            [OrderedDict((key, None) for key in ordered_keys)], 
+            title_function=title_function))
+        return ('COPY (%s) TO STDOUT WITH CSV' % compiled_stmt, header)
+    
+    @staticmethod
+    def _get_column_scales(conn, columns):
+        '''
+        Return the {key: scale} of the numeric columns that are table columns 
+        declared with a scale (e.g. "numeric(10,3)")
+        @param columns {key: psycopg2 Column}
+        '''
+        scales = {}
+        for key, col in columns.items():
+            if not col.table_oid or not col.table_column:
+                continue
+            atttypmod = conn.execute(
+                'select atttypmod from pg_attribute '
+                'where attrelid = %s and attnum = %s', 
+                (col.table_oid, col.table_column)).scalar()
+            if atttypmod is not None and atttypmod >= 4:
+                scales[key] = (atttypmod - 4) & 0xffff
+        return scales
+    
+    def stream_response_from_copy(self, copy_stmt, header, output_filename):
+        '''
+        Stream the output of the "COPY ... TO STDOUT WITH CSV" statement to 
+        the response (see build_copy_csv_statement):
+        - the header is written before the first row; as for csv_generator,
+        nothing is written if there are no rows.
+        '''
+        logger.info('stream csv using copy: %r', output_filename)
+        if DEBUG_STREAMING:
+            logger.info('copy stmt: %s', copy_stmt)
+        def copy_generator():
+            for i, chunk in enumerate(copy_to_generator(copy_stmt)):
+                if i == 0:
+                    yield header
+                yield chunk
+        response = StreamingHttpResponse(
+            copy_generator(), content_type=CSV_MIMETYPE)
+        response['Content-Disposition'] = \
+            'attachment; filename=%s.csv' % output_filename
+        return response
     
     def stream_response_from_cursor(
             self, request, result, output_filename, field_hash, param_hash,
             is_for_detail=False, downloadID=None, title_function=None, 
-            meta=None, format=None):
+            meta=None, format=None, row_converters=None):
         '''
         Stream the given result (SQLAlchemy cursor) to the response
         
         @param result a SQLAlchemy cursor
+        @param row_converters (optional) see apply_rowproxy_generator
         '''
           
         list_brackets = LIST_BRACKETS
@@ -1050,16 +1646,31 @@ class SqlAlchemyResource(IccblBaseResource):
             for key,field in field_hash.items() 
                 if field.get(FIELD.VALUE_TEMPLATE)}
         logger.debug('list fields: %r', list_fields)
+        if content_type == JSON_COLUMNAR_MIMETYPE:
+            data = cursor_generator(
+                result,ordered_keys,list_fields=list_fields,
+                value_templates=value_templates, as_tuples=True,
+                converters=row_converters)
+            response = StreamingHttpResponse(
+                ChunkIterWrapper(
+                    json_columnar_generator(
+                        image_tuple_generator(
+                            data, ordered_keys, image_keys, request),
+                        meta, ordered_keys)))
+            response['Content-Type'] = content_type
+            return response
+        
         data = cursor_generator(
             result,ordered_keys,list_fields=list_fields,
-            value_templates=value_templates)
+            value_templates=value_templates, converters=row_converters)
         response = None
         if content_type == JSON_MIMETYPE:
             response = StreamingHttpResponse(
                 ChunkIterWrapper(
                     json_generator(
                         image_generator(data, image_keys, request), 
-                        meta, is_for_detail=is_for_detail)))
+                        meta, is_for_detail=is_for_detail,
+                        pretty=param_hash.get(HTTP_PARAM_PRETTY_JSON, False))))
             response['Content-Type'] = content_type
         
         elif( content_type == XLS_MIMETYPE or
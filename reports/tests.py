@@ -49,45 +49,64 @@ $ ./manage.py test --settings=lims.test_settings
 
 from __future__ import unicode_literals
 
+from collections import OrderedDict
+import cStringIO
+import csv
 from datetime import datetime
 from decimal import Decimal
 import json
 import logging
 import os
 import re
+import resource
 import shutil
 import sys
+import time
 import unittest
 import urlparse
 
+from aldjemy.core import get_engine
 import dateutil.parser
 from django.conf import settings
 from django.contrib.auth.models import User
 from django.core.exceptions import ObjectDoesNotExist
+from django.db import connection
 from django.db.utils import ProgrammingError
 from django.http.response import StreamingHttpResponse
 from django.test import TestCase
 from django.test.client import Client, FakePayload
 from django.test.runner import DiscoverRunner
 from django.test.testcases import SimpleTestCase
+from django.test.utils import override_settings
+from sqlalchemy import select
+from sqlalchemy.sql.expression import column, table, exists, text
+from sqlalchemy.sql.functions import func
 
 from reports import HEADER_APILOG_COMMENT, DJANGO_ACCEPT_PARAM, \
-    HTTP_PARAM_AUTH, HTTP_PARAM_CONTENT_TYPE
+    HTTP_PARAM_AUTH, HTTP_PARAM_CONTENT_TYPE, HTTP_PARAM_USE_TITLES, \
+    HTTP_PARAM_USE_VOCAB
 import reports; 
-from reports.api import compare_dicts, API_RESULT_DATA, API_RESULT_META
+from reports.api import compare_dicts, API_RESULT_DATA, API_RESULT_META, \
+    ApiResource
 from reports.utils.dump_obj import dumpObj
 from reports.models import MetaHash, UserGroup, \
     UserProfile, ApiLog, Permission, Job
 import reports.schema as SCHEMA
 from reports.serialize import parse_val, JSON_MIMETYPE, CSV_MIMETYPE, \
-    MULTIPART_MIMETYPE
+    MULTIPART_MIMETYPE, INPUT_FILE_DESERIALIZE_LINE_NUMBER_KEY
 import reports.serialize.csvutils as csvutils
+from reports.serialize.streaming_serializers import closing_iterator_wrapper, \
+    json_generator, cursor_generator, csv_generator
 from reports.serialize.sdfutils import MOLDATAKEY
 from reports.serializers import CSVSerializer, SDFSerializer, \
     LimsSerializer, XLSSerializer
 import reports.utils.background_processor
+from reports.utils.copy_stream import copy_from_generator
 import reports.utils.log_utils
+import reports.utils.result_cache as result_cache
+from reports.utils.result_cache import SizeBoundedFileCache, get_result_cache
 import reports.utils.si_unit
+from reports.sqlalchemy_resource import SqlAlchemyResource
 
 
 logger = logging.getLogger(__name__)
@@ -949,6 +968,28 @@ M  END'''            }
                         
                         self.fail('input object not found')
 
+    def test3_stream_sdf(self):
+        ''' records are generated from the file, with the line numbers '''
+        
+        serializer = SDFSerializer()
+        filename = ( APP_ROOT_DIR 
+            + '/db/static/test_data/libraries/clean_data_small_molecule.sdf' )
+        with open(filename) as fin:
+            record_lines = [1] + [
+                i+2 for i,line in enumerate(fin) if line.startswith('$$$$')]
+        with open(filename) as fin:
+            input_data = serializer.from_sdf(fin.read(), root=None)
+        
+        with open(filename) as fin:
+            _data = serializer.from_sdf(fin, root=None)
+            self.assertFalse(isinstance(_data, (list, tuple)))
+            for i, record in enumerate(_data):
+                self.assertEqual(record, input_data[i])
+                self.assertEqual(
+                    record[INPUT_FILE_DESERIALIZE_LINE_NUMBER_KEY], 
+                    record_lines[i])
+            self.assertEqual(i+1, len(input_data))
+
 
 class XlsSerializerTest(SimpleTestCase):
     
@@ -990,6 +1031,26 @@ class XlsSerializerTest(SimpleTestCase):
                                 obj[k] == v, 
                                 ('values not equal', k, record[k], 'read:', v))
 
+    def test1a_read_xlsx_file(self):
+        ''' rows are generated from the (read-only) XLSX workbook file '''
+        
+        records = [{
+            'key1': 'aval%d' % i,
+            'key2': i,
+            'key3': ['a','b','c'] } for i in range(100) ]
+
+        serializer = XLSSerializer()
+        _data = serializer.to_xlsx(records)
+        input_file = cStringIO.StringIO(_data)
+        _data = serializer.from_xlsx(input_file, root=None)
+        self.assertFalse(isinstance(_data, (list, tuple)))
+        final_data = [x for x in _data]
+        self.assertEqual(len(final_data), len(records))
+        for record, obj in zip(records, final_data):
+            self.assertEqual(obj['key1'], record['key1'])
+            self.assertEqual(obj['key2'], str(record['key2']))
+            self.assertEqual(obj['key3'], record['key3'])
+
     def test2_clean_data(self):
 
         serializer = XLSSerializer()
@@ -1121,8 +1182,517 @@ class SiUnitTest(TestCase):
             logger.info('input: %r, result: %r, expected: %r, Note: %s', 
                 args, result, expected_result, note)
             self.assertEqual(str(result), expected_result)
+
+
+class ResultCacheTest(SimpleTestCase):
+
+    def setUp(self):
+        self.cache_dir = os.path.join(
+            settings.TEMP_FILE_DIR, 'test_result_cache_%d' % os.getpid())
+
+    def tearDown(self):
+        shutil.rmtree(self.cache_dir, ignore_errors=True)
+
+    def test_lru_eviction_by_size(self):
+
+        entry = { 'cached_result': [{ 'well_id': 'x'*1000 }] }
+        cache = SizeBoundedFileCache(self.cache_dir, {})
+        entry_size = None
+        for i in range(3):
+            cache.set('key%d' % i, entry, None)
+            if entry_size is None:
+                entry_size = cache.get_size()
+
+        # Set the budget to 3 entries; touch key0 so that key1 is the LRU entry
+        cache = SizeBoundedFileCache(
+            self.cache_dir, { 'OPTIONS': { 'MAX_BYTES': entry_size*3 }})
+        os.utime(cache._key_to_file('key1'), (0,0))
+        os.utime(cache._key_to_file('key2'), (1,1))
+        os.utime(cache._key_to_file('key0'), (2,2))
+        self.assertEqual(cache.get('key0'), entry)
+
+        cache.set('key3', entry, None)
+
+        self.assertTrue(cache.get_size() <= entry_size*3, cache.get_size())
+        self.assertIsNone(cache.get('key1'))
+        for key in ['key0','key2','key3']:
+            self.assertEqual(cache.get(key), entry, key)
+
+    def test_entry_exceeds_max_bytes(self):
+
+        cache = SizeBoundedFileCache(
+            self.cache_dir, { 'OPTIONS': { 'MAX_BYTES': 100 }})
+        cache.set('small', 'x', None)
+        cache.set('large', os.urandom(1000), None)
+        self.assertIsNone(cache.get('large'))
+        self.assertEqual(cache.get('small'), 'x')
+
+    def test_running_size(self):
+
+        entry = { 'cached_result': [{ 'well_id': 'x'*1000 }] }
+        cache = SizeBoundedFileCache(self.cache_dir, {})
+        for i in range(3):
+            cache.set('key%d' % i, entry, None)
+        # Replacing an entry is not counted twice
+        cache.set('key0', entry, None)
+        self.assertEqual(cache._read_size(), (cache.get_size(), 3))
+        
+        # The cache is listed, and the total corrected, when the recorded 
+        # total exceeds the MAX_BYTES
+        entry_size = cache.get_size()/3
+        cache.delete('key2')
+        self.assertEqual(cache._read_size(), (entry_size*3, 3))
+        cache = SizeBoundedFileCache(
+            self.cache_dir, { 'OPTIONS': { 'MAX_BYTES': entry_size*3 }})
+        cache.set('key3', entry, None)
+        self.assertEqual(cache._read_size(), (entry_size*3, 3))
+        self.assertEqual(cache.get('key1'), entry)
+        
+        cache.clear()
+        self.assertEqual(cache._read_size(), (0, 0))
+        
+        # Clearing a cache that has no directory yet
+        shutil.rmtree(self.cache_dir)
+        cache.clear()
+        self.assertFalse(os.path.exists(self.cache_dir))
+        cache.set('key0', entry, None)
+        self.assertEqual(cache._read_size(), (entry_size, 1))
+
+    def test_table_tag_invalidation(self):
+
+        _well = table('well', column('well_id'))
+        _reagent = table('reagent', column('well_id'), column('vendor_name'))
+        _cw = table('copy_well', column('well_id'), column('plate_id'))
+        reagents = (
+            select([_well.c.well_id, _reagent.c.vendor_name])
+            .select_from(_well.join(
+                _reagent, _well.c.well_id==_reagent.c.well_id))
+            .cte('reagents'))
+        stmt = (
+            select([reagents.c.well_id])
+            .where(exists(
+                select([_cw.alias('cw').c.plate_id])
+                .where(_cw.c.well_id=='x'))))
+        tables = result_cache.get_statement_tables(stmt)
+        self.assertEqual(tables, set(['well','reagent','copy_well']))
+        # Tables read by text clauses can not be determined
+        self.assertIsNone(result_cache.get_statement_tables(
+            select([reagents.c.well_id]).where(
+                text("exists (select null from screen)"))))
+
+        cache = get_result_cache('db_cache')
+        cache.clear()
+        result_cache.reset_cache_stats()
+        result_cache.set_tagged(cache, 'reagents', [1,2,3], tables)
+        result_cache.set_tagged(cache, 'screens', [4], ['screen'])
+        result_cache.set_tagged(cache, 'untagged', [5])
+        self.assertEqual(result_cache.get_tagged(cache, 'reagents'), [1,2,3])
+
+        result_cache.invalidate_tables(['plate','screen'])
+
+        self.assertEqual(result_cache.get_tagged(cache, 'reagents'), [1,2,3])
+        self.assertIsNone(result_cache.get_tagged(cache, 'screens'))
+        self.assertIsNone(result_cache.get_tagged(cache, 'untagged'))
+        stats = result_cache.get_cache_stats()
+        logger.info('cache stats: %r', stats)
+        self.assertEqual(stats['hits'], 2)
+        self.assertEqual(stats['stale_evictions'], 2)
+        self.assertEqual(stats['invalidations'], 1)
+        self.assertEqual(stats['invalidated_tables'], 2)
+
+
+class JsonGeneratorTest(SimpleTestCase):
+
+    def test_compact_encoding(self):
+
+        ordered_keys = ['well_id', 'plate_number', 'vendor_name', 'is_control']
+        rows = [
+            OrderedDict(zip(ordered_keys,
+                ['%05d:A%02d' % (i, i%24+1), i, 'vendor \u2122 %d' % i,
+                    i%2==0]))
+            for i in range(2500)]
+        meta = { 'limit': 0, 'offset': 0, 'total_count': len(rows) }
+
+        pretty = list(json_generator(iter(rows), meta, pretty=True))
+        compact = list(json_generator(iter(rows), meta, batch_size=1000))
+
+        pretty_json = ''.join(pretty)
+        compact_json = ''.join(compact)
+        self.assertEqual(json.loads(pretty_json), json.loads(compact_json))
+        # meta, 3 batches, closing brackets
+        self.assertEqual(len(compact), 5)
+        self.assertTrue(len(compact_json) < 0.9*len(pretty_json),
+            (len(compact_json), len(pretty_json)))
+        # keys are in the row order
+        first_row = json.loads(
+            compact_json, object_pairs_hook=OrderedDict)['objects'][0]
+        self.assertEqual(first_row.keys(), ordered_keys)
+
+        detail = ''.join(json_generator(iter(rows[:1]), meta,
+            is_for_detail=True))
+        self.assertEqual(json.loads(detail), rows[0])
+
+        empty = ''.join(json_generator(iter([]), meta))
+        self.assertEqual(json.loads(empty)['objects'], [])
+
+
+class StreamingBenchmarkTest(TestCase):
+    '''
+    Benchmark the memory used to stream large result sets
+    '''
+
+    def _stream_rows(self, row_count, fetch_size=1000):
+        stmt = (
+            select([
+                column('n'),
+                func.repeat('x', 200).label('padding')])
+            .select_from(func.generate_series(1, row_count).alias('n')))
+        conn = get_engine().connect()
+        result = closing_iterator_wrapper(
+            SqlAlchemyResource.execute_server_side(
+                conn, stmt, fetch_size=fetch_size),
+            conn.close)
+        count = 0
+        for row in result:
+            count += 1
+        return count
+
+    def test_server_side_cursor_close(self):
+        
+        # The atomic block is held until the iterator is closed
+        savepoints = len(connection.savepoint_ids)
+        stmt = select([column('n')]).select_from(
+            func.generate_series(1, 10000).alias('n'))
+        conn = get_engine().connect()
+        result = closing_iterator_wrapper(
+            SqlAlchemyResource.execute_server_side(conn, stmt, fetch_size=10),
+            conn.close)
+        self.assertEqual(result.next()['n'], 1)
+        self.assertEqual(len(connection.savepoint_ids), savepoints+1)
+        result.close()
+        self.assertEqual(len(connection.savepoint_ids), savepoints)
+    
+    def test_server_side_cursor_rss(self):
+
+        # Note: ru_maxrss is the peak resident set size (KB on linux)
+        self._stream_rows(1000)
+        peak_rss = [resource.getrusage(resource.RUSAGE_SELF).ru_maxrss]
+        row_counts = [100000, 200000, 400000]
+        for row_count in row_counts:
+            start = time.time()
+            count = self._stream_rows(row_count)
+            self.assertEqual(count, row_count)
+            peak_rss.append(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss)
+            logger.info('streamed rows: %d, time: %0.2f s, peak rss: %d KB',
+                row_count, time.time()-start, peak_rss[-1])
+
+        # The peak RSS stays flat as the result set grows (buffering 400000
+        # rows client side uses > 100 MB)
+        self.assertTrue(peak_rss[-1] - peak_rss[0] < 32*1024,
+            ('peak rss grew with the result set size',
+                zip([1000]+row_counts, peak_rss)))
+
+    def _legacy_cursor_generator(self, cursor, visible_fields, list_fields):
+        # The per row, per field projection replaced by the RowProjection
+        for row in cursor:
+            output_row = []
+            for key in visible_fields:
+                value = None
+                if row.has_key(key):
+                    value = row[key]
+                if value is not None and key in list_fields:
+                    value = list(filter(None,value.split(
+                        reports.LIST_DELIMITER_SQL_ARRAY)))
+                output_row.append(value)
+            yield OrderedDict(zip(visible_fields,output_row))
+    
+    def test_row_projection_rate(self):
+        
+        row_count = 100000
+        stmt = (
+            select([
+                column('n'),
+                func.concat('name_', column('n')).label('name'),
+                (column('n')*0.5).label('amount'),
+                func.concat(
+                    reports.LIST_DELIMITER_SQL_ARRAY, 'a', 
+                    reports.LIST_DELIMITER_SQL_ARRAY, column('n')
+                    ).label('tags'),
+                func.repeat('x', 20).label('comment')])
+            .select_from(func.generate_series(1, row_count).alias('n')))
+        conn = get_engine().connect()
+        try:
+            rows = conn.execute(stmt).fetchall()
+        finally:
+            conn.close()
+        visible_fields = ['n','name','amount','tags','comment','not_selected']
+        list_fields = ['tags']
+        
+        start = time.time()
+        legacy_rows = list(self._legacy_cursor_generator(
+            rows, visible_fields, list_fields))
+        legacy_time = time.time() - start
+
+        start = time.time()
+        projected_rows = list(cursor_generator(
+            rows, visible_fields, list_fields=list_fields))
+        projection_time = time.time() - start
+        
+        # Timings are logged only: wall clock comparisons are not reliable on 
+        # shared test machines
+        logger.info(
+            'rows: %d, legacy: %0.3fs (%0.0f rows/s), '
+            'projection: %0.3fs (%0.0f rows/s)',
+            row_count, legacy_time, row_count/legacy_time, 
+            projection_time, row_count/projection_time)
+        self.assertEqual(len(projected_rows), row_count)
+        self.assertEqual(projected_rows, legacy_rows)
+        self.assertEqual(projected_rows[1]['tags'], ['a','2'])
+        self.assertEqual(projected_rows[1]['not_selected'], None)
+        
+        # Row converters replace the number format Row wrapper
+        field_hash = {
+            'amount': { 'key': 'amount', 'data_type': 'decimal',
+                'display_options': "{ 'decimals': 1 }" } }
+        rowproxy_generator = ApiResource.create_number_format_generator(
+            field_hash, None)
+        legacy_rows = list(self._legacy_cursor_generator(
+            rowproxy_generator(rows[:100]), visible_fields, list_fields))
+        result, row_converters = SqlAlchemyResource.apply_rowproxy_generator(
+            rowproxy_generator, rows[:100])
+        self.assertEqual(len(row_converters), 1)
+        projected_rows = list(cursor_generator(
+            result, visible_fields, list_fields=list_fields, 
+            converters=row_converters))
+        self.assertEqual(projected_rows, legacy_rows)
+        self.assertEqual(projected_rows[2]['amount'], Decimal('1.5'))
+
+    def test_copy_from_generator(self):
+        
+        row_count = 100000
+        def generate_rows():
+            for n in range(row_count):
+                yield b'%d,name_%d\n' % (n, n)
+        with connection.cursor() as cursor:
+            cursor.execute(
+                'create temp table copy_from_test (n integer, name text)')
+            start = time.time()
+            copied = copy_from_generator(
+                cursor, 'COPY copy_from_test FROM STDIN WITH (FORMAT CSV)', 
+                generate_rows(), queue_size=4)
+            logger.info('copied rows: %d, time: %0.2f s', 
+                copied, time.time()-start)
+            self.assertEqual(copied, row_count)
+            cursor.execute('select count(*), max(name) from copy_from_test')
+            self.assertEqual(
+                cursor.fetchone(), (row_count, 'name_%d' % 99999))
+        
+        # Errors raised by the generator abort the COPY
+        def generate_error():
+            yield b'1,one\n'
+            raise ValueError('bad input')
+        with connection.cursor() as cursor:
+            cursor.execute('savepoint copy_error')
+            with self.assertRaises(ValueError):
+                copy_from_generator(
+                    cursor, 'COPY copy_from_test FROM STDIN WITH (FORMAT CSV)', 
+                    generate_error())
+            cursor.execute('rollback to savepoint copy_error')
+
+
+class CopyCsvExportTest(unittest.TestCase):
+    '''
+    The "COPY TO" CSV fast path must write the same bytes as csv_generator
+    - not a django.test.TestCase: the COPY is run on the connection of the 
+    copy_to_generator thread, and is not used inside a transaction
+    '''
+    
+    def setUp(self):
+        with connection.cursor() as cursor:
+            cursor.execute(
+                'create table copy_csv_test (id integer, name text, '
+                'float_value double precision, decimal_value numeric(9,3), '
+                'small_decimal_value numeric(12,9), date_value date, '
+                'timestamp_value timestamp with time zone)')
+            cursor.execute(
+                "insert into copy_csv_test values "
+                "(1, 'one', 1.0, 1.5, 0.00000001, '2020-01-02', "
+                "  '2020-01-02 03:04:05+00'), "
+                "(2, '', 0.1, 100, 0, null, null), "
+                "(3, 'a, \"b\"', 1e20, -0.001, null, '1999-12-31', null)")
+    
+    def tearDown(self):
+        with connection.cursor() as cursor:
+            cursor.execute('drop table copy_csv_test')
+    
+    def _export(self, fields, min_id=0):
+        '''
+        Return (copy output, csv_generator output) for the fields, 
+        copy output is None if the fast path is not used
+        @param fields (key, column, data_type) tuples
+        '''
+        _table = table(
+            'copy_csv_test', 
+            *[column(x) for x in set(['id'] + [x[1] for x in fields])])
+        stmt = (
+            select([_table.c[col].label(key) for key, col, _ in fields])
+            .where(_table.c.id > min_id)
+            .order_by(_table.c.id))
+        field_hash = OrderedDict(
+            (key, { 'key': key, 'ordinal': i, 'data_type': data_type })
+                for i, (key, col, data_type) in enumerate(fields))
+        title_function = lambda key: key.replace('_',' ').title()
+        resource = SqlAlchemyResource()
+        conn = get_engine().connect()
+        try:
+            copy_csv = resource.build_copy_csv_statement(
+                conn, stmt, field_hash, {}, title_function=title_function)
+            expected = b''.join(csv_generator(
+                cursor_generator(conn.execute(stmt), field_hash.keys()),
+                title_function=title_function))
+        finally:
+            conn.close()
+        if copy_csv is None:
+            return (None, expected)
+        (copy_stmt, header) = copy_csv
+        response = resource.stream_response_from_copy(
+            copy_stmt, header, 'copy_csv_test')
+        return (b''.join(response.streaming_content), expected)
+    
+    def test_copy_csv_output(self):
+        
+        fields = [
+            ('id', 'id', 'integer'),
+            ('name', 'name', 'string'),
+            ('decimal_value', 'decimal_value', 'decimal'),
+            ('date_value', 'date_value', 'date')]
+        (output, expected) = self._export(fields)
+        logger.info('csv: %r', expected)
+        self.assertIsNotNone(output)
+        self.assertEqual(output, expected)
+        self.assertTrue('1.500' in expected, expected)
+        
+        # No header is written if there are no rows
+        (output, expected) = self._export(fields, min_id=3)
+        self.assertEqual(expected, b'')
+        self.assertEqual(output, expected)
+        
+        # Types that are not output identically are not copied:
+        # - float: "1" vs "1.0"
+        # - decimals with a scale > 6: "0.000000010" vs "1.0E-8"
+        # - timestamps (on a "date" field): the local time isoformat
+        for field in [
+                ('float_value', 'float_value', 'float'),
+                ('small_decimal_value', 'small_decimal_value', 'decimal'),
+                ('date_value', 'timestamp_value', 'date')]:
+            (output, expected) = self._export(fields + [field])
+            self.assertIsNone(output, field)
+
+
+class KeysetPaginationTest(unittest.TestCase):
+    '''
+    Keyset tokens must restore the exact values of the last row, so that 
+    paging on decimal and date columns neither skips nor repeats rows
+    - not a django.test.TestCase: the statements are run on a separate 
+    (SqlAlchemy) connection
+    '''
+    
+    def setUp(self):
+        with connection.cursor() as cursor:
+            cursor.execute(
+                'create table keyset_test (id integer, '
+                'decimal_value numeric(30,20), date_value date, '
+                'timestamp_value timestamp with time zone)')
+            # Decimals that are equal as floats; repeated dates
+            cursor.execute(
+                "insert into keyset_test values "
+                "(1, 1.00000000000000000003, '2020-01-02', "
+                "  '2020-01-02 03:04:05.123456+00'), "
+                "(2, 1.00000000000000000001, '2020-01-01', "
+                "  '2020-01-02 03:04:05.123457+00'), "
+                "(3, 1.00000000000000000002, '2020-01-02', "
+                "  '2020-01-02 03:04:05.123455+00'), "
+                "(4, null, '2019-12-31', null), "
+                "(5, 1.00000000000000000001, null, "
+                "  '2020-01-02 03:04:05.123456+00'), "
+                "(6, 0.5, '2020-01-01', '2020-01-01 00:00:00+00')")
+    
+    def tearDown(self):
+        with connection.cursor() as cursor:
+            cursor.execute('drop table keyset_test')
+    
+    def _page_ids(self, keyset):
+        '''
+        Return the ids of all rows, paged one row at a time, and the ids of 
+        the unpaged ordering
+        '''
+        _table = table(
+            'keyset_test', 
+            *[column(x) for x in [
+                'id','decimal_value','date_value','timestamp_value']])
+        stmt = select([_table.c[key[0]] for key in keyset])
+        resource = SqlAlchemyResource()
+        conn = get_engine().connect()
+        try:
+            expected = [
+                row['id'] for row in 
+                    conn.execute(resource.wrap_keyset_statement(stmt, keyset))]
+            ids = []
+            token = None
+            for _ in range(len(expected)+1):
+                values = None
+                if token is not None:
+                    values = resource.decode_keyset_token(keyset, token)
+                page_stmt = \
+                    resource.wrap_keyset_statement(stmt, keyset, values)
+                result = conn.execute(page_stmt.limit(1)).fetchall()
+                if not result:
+                    break
+                ids.append(result[0]['id'])
+                token = resource.encode_keyset_token(keyset, result[0])
+        finally:
+            conn.close()
+        return (ids, expected)
+    
+    def test_keyset_token_types(self):
+        
+        keyset = [
+            ('decimal_value', False, False), ('date_value', False, False),
+            ('timestamp_value', False, False), ('id', False, False)]
+        row = {
+            'decimal_value': Decimal('1.00000000000000000001'),
+            'date_value': dateutil.parser.parse('2020-01-02').date(),
+            'timestamp_value': 
+                dateutil.parser.parse('2020-01-02T03:04:05.123456+00:00'),
+            'id': 1 }
+        token = SqlAlchemyResource.encode_keyset_token(keyset, row)
+        values = SqlAlchemyResource.decode_keyset_token(keyset, token)
+        self.assertEqual(values, [row[key[0]] for key in keyset])
+        for key, value in zip(keyset, values):
+            self.assertEqual(type(value), type(row[key[0]]), key)
+    
+    def test_decimal_pagination(self):
+        
+        for is_descending in [False, True]:
+            keyset = [
+                ('decimal_value', is_descending, False), ('id', False, False)]
+            (ids, expected) = self._page_ids(keyset)
+            logger.info('keyset: %r, ids: %r', keyset, ids)
+            self.assertEqual(len(expected), 6)
+            self.assertEqual(ids, expected)
+    
+    def test_date_pagination(self):
         
-   
+        for field_name in ['date_value', 'timestamp_value']:
+            for is_descending in [False, True]:
+                keyset = [
+                    (field_name, is_descending, False), ('id', False, False)]
+                (ids, expected) = self._page_ids(keyset)
+                logger.info('keyset: %r, ids: %r', keyset, ids)
+                self.assertEqual(len(expected), 6)
+                self.assertEqual(ids, expected)
+
+
 class LogCompareTest(TestCase):
     
     def test_compare_dicts(self):
@@ -2296,6 +2866,35 @@ class VocabularyResource(IResourceTestCase):
                 result, 
                 ('vocab item not found', item, final_data))
 
+    def test2_patch_list_chunks(self):
+        ''' the patch_list rows are streamed and patched in chunks '''
+        
+        test_vocabs = [
+            {'scope': 'test.vocab.chunks', 'key': 'test%d' % i, 'ordinal': i, 
+             'title': 'Test %d' % i } for i in range(7) ]
+        uri = BASE_URI + '/vocabulary'
+        with override_settings(PATCH_LIST_CHUNK_SIZE=3):
+            resp = self.api_client.patch(uri, 
+                format='csv', data={ API_RESULT_DATA: test_vocabs }, 
+                authentication=self.get_credentials(), 
+                **{ DJANGO_ACCEPT_PARAM: JSON_MIMETYPE })
+        self.assertTrue(
+            resp.status_code <= 204, 
+            (resp.status_code, self.get_content(resp)))
+        result = self.deserialize(resp)[API_RESULT_META][SCHEMA.API_MSG_RESULT]
+        self.assertEqual(result[SCHEMA.API_MSG_SUBMIT_COUNT], len(test_vocabs))
+        self.assertEqual(result[SCHEMA.API_MSG_CREATED], len(test_vocabs))
+        
+        resp = self.api_client.get(uri, format='json', 
+            authentication=self.get_credentials(), 
+            data={ 'limit': 0, 'scope__eq': 'test.vocab.chunks' })
+        final_data = self.deserialize(resp)[API_RESULT_DATA]
+        self.assertEqual(len(final_data), len(test_vocabs), final_data)
+        for item in test_vocabs:
+            result, obj = find_obj_in_list(item, final_data)
+            self.assertTrue(
+                result, ('vocab item not found', item, final_data))
+
 
 class UserUsergroupSharedTest(object):
             
@@ -2547,7 +3146,160 @@ class UserResource(IResourceTestCase, UserUsergroupSharedTest):
             (resp.status_code, self.get_content(resp)))
 
         logger.debug('==== test4_user_write_permissions done =====')
-        
+
+    def test5_keyset_pagination(self):
+
+        logger.info('test5_keyset_pagination...')
+        self.test0_create_user()
+
+        uri = BASE_URI + '/user'
+        for order_by in [['last_name'],['-first_name','last_name'],[]]:
+            data_for_get = {
+                'limit': 0, 'order_by': order_by+['username'] }
+            resp = self.api_client.get(uri, format='json',
+                authentication=self.get_credentials(), data=data_for_get)
+            self.assertTrue(
+                resp.status_code in [200],
+                (resp.status_code, self.get_content(resp)))
+            expected = [ x['username']
+                for x in self.deserialize(resp)[API_RESULT_DATA]]
+            logger.info('order_by: %r, expected: %r', order_by, expected)
+
+            usernames = []
+            after = ''
+            while after is not None:
+                data_for_get = {
+                    'limit': 1, 'order_by': order_by, 'after': after }
+                resp = self.api_client.get(uri, format='json',
+                    authentication=self.get_credentials(), data=data_for_get)
+                self.assertTrue(
+                    resp.status_code in [200],
+                    (resp.status_code, self.get_content(resp)))
+                new_obj = self.deserialize(resp)
+                usernames.extend(
+                    [x['username'] for x in new_obj[API_RESULT_DATA]])
+                self.assertTrue(len(usernames) <= len(expected),
+                    (usernames, expected))
+                after = new_obj[API_RESULT_META]['next_after']
+            self.assertEqual(usernames, expected)
+
+        data_for_get = {
+            'limit': 1, 'order_by': ['last_name'], 'after': 'not_a_token' }
+        resp = self.api_client.get(uri, format='json',
+            authentication=self.get_credentials(), data=data_for_get)
+        self.assertTrue(
+            resp.status_code == 400,
+            (resp.status_code, self.get_content(resp)))
+
+    def test6_total_count_policy(self):
+
+        logger.info('test6_total_count_policy...')
+        self.test0_create_user()
+
+        uri = BASE_URI + '/user'
+        resp = self.api_client.get(uri, format='json',
+            authentication=self.get_credentials(), data={ 'limit': 0 })
+        expected_count = len(self.deserialize(resp)[API_RESULT_DATA])
+
+        data_for_get = {
+            'limit': 2, 'offset': 1, 'total_count_policy': 'estimated' }
+        resp = self.api_client.get(uri, format='json',
+            authentication=self.get_credentials(), data=data_for_get)
+        self.assertTrue(
+            resp.status_code in [200],
+            (resp.status_code, self.get_content(resp)))
+        meta = self.deserialize(resp)[API_RESULT_META]
+        logger.info('estimated count meta: %r', meta)
+        self.assertEqual(meta['total_count_policy'], 'estimated')
+        self.assertTrue(meta['total_count'] >= 0, meta)
+
+        # The deferred count is computed in the background, then served from
+        # the cache
+        data_for_get['total_count_policy'] = 'deferred'
+        for i in range(20):
+            resp = self.api_client.get(uri, format='json',
+                authentication=self.get_credentials(), data=data_for_get)
+            self.assertTrue(
+                resp.status_code in [200],
+                (resp.status_code, self.get_content(resp)))
+            meta = self.deserialize(resp)[API_RESULT_META]
+            logger.info('deferred count meta: %r', meta)
+            if meta['total_count_policy'] == 'exact':
+                break
+            self.assertEqual(meta['total_count_policy'], 'deferred')
+            time.sleep(0.5)
+        self.assertEqual(meta['total_count_policy'], 'exact')
+        self.assertEqual(meta['total_count'], expected_count)
+
+        data_for_get['total_count_policy'] = 'unknown'
+        resp = self.api_client.get(uri, format='json',
+            authentication=self.get_credentials(), data=data_for_get)
+        self.assertTrue(
+            resp.status_code == 400,
+            (resp.status_code, self.get_content(resp)))
+
+    def test7_csv_copy_export(self):
+
+        logger.info('test7_csv_copy_export...')
+        self.test0_create_user()
+
+        uri = BASE_URI + '/user'
+        data_for_get = {
+            'limit': 0, 'order_by': ['username'],
+            'exact_fields': [
+                'username','first_name','last_name','email','is_active'] }
+        for use_titles in [False, True]:
+            data_for_get[HTTP_PARAM_USE_TITLES] = use_titles
+            # The "COPY TO" fast path is used for plain fields
+            resp = self.api_client.get(uri, format='csv',
+                authentication=self.get_credentials(), data=data_for_get)
+            self.assertTrue(
+                resp.status_code in [200],
+                (resp.status_code, self.get_content(resp)))
+            copy_rows = list(csv.reader(
+                cStringIO.StringIO(self.get_content(resp))))
+            # The vocabulary generator disables the fast path
+            resp = self.api_client.get(uri, format='csv',
+                authentication=self.get_credentials(),
+                data=dict(data_for_get, **{ HTTP_PARAM_USE_VOCAB: True }))
+            self.assertTrue(
+                resp.status_code in [200],
+                (resp.status_code, self.get_content(resp)))
+            generator_rows = list(csv.reader(
+                cStringIO.StringIO(self.get_content(resp))))
+            logger.info('copy rows: %r', copy_rows)
+            self.assertTrue(len(copy_rows) > 3, copy_rows)
+            self.assertEqual(copy_rows, generator_rows)
+
+    def test8_json_columnar(self):
+
+        logger.info('test8_json_columnar...')
+        self.test0_create_user()
+
+        uri = BASE_URI + '/user'
+        data_for_get = { 'limit': 0, 'order_by': ['username'] }
+        resp = self.api_client.get(uri, format='json',
+            authentication=self.get_credentials(), data=data_for_get)
+        self.assertTrue(
+            resp.status_code in [200],
+            (resp.status_code, self.get_content(resp)))
+        expected = self.deserialize(resp)
+
+        resp = self.api_client.get(uri, format='json_columnar',
+            authentication=self.get_credentials(), data=data_for_get)
+        self.assertTrue(
+            resp.status_code in [200],
+            (resp.status_code, self.get_content(resp)))
+        columnar = json.loads(self.get_content(resp))
+        fields = columnar['fields']
+        self.assertEqual(columnar['meta'], expected[API_RESULT_META])
+        self.assertEqual(
+            len(columnar['objects']), len(expected[API_RESULT_DATA]))
+        for row, expected_obj in zip(
+                columnar['objects'], expected[API_RESULT_DATA]):
+            self.assertTrue(isinstance(row, list), row)
+            self.assertEqual(dict(zip(fields, row)), expected_obj)
+
 
 class UserGroupResource(IResourceTestCase, UserUsergroupSharedTest):
 
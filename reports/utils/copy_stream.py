@@ -0,0 +1,219 @@
+from __future__ import unicode_literals
+'''
+Stream data to and from the PostgreSQL "COPY" command.
+
+psycopg2 "copy_expert" blocks until the COPY is complete, writing to (or
+reading from) a file-like object:
+- copy_to_generator: to stream the COPY output, the COPY is run in a producer
+thread that writes to a bounded queue, read by a generator in the calling
+thread.
+NOTE: Django opens a database connection for each thread, so the COPY is run
+in a separate transaction, and will not see uncommitted data of the caller.
+- copy_from_generator: to stream the COPY input, the COPY is run in the calling
+thread (and transaction), reading from a bounded queue filled by a generator
+iterated in a producer thread; so that the rows are generated while the
+database is loading the previous rows.
+NOTE: database access in the generator uses the producer thread connection;
+prefetch the data used by the generator on the calling thread.
+'''
+
+import logging
+import Queue
+import threading
+
+from django.db import connection
+
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_CHUNK_SIZE = 64*1024
+DEFAULT_QUEUE_SIZE = 16
+
+_DONE = object()
+
+
+class CopyCancelled(Exception):
+    ''' Raised in the producer thread if the consumer stops reading '''
+    pass
+
+
+class _QueueWriter(object):
+    '''
+    File-like object for "copy_expert": buffer the rows written by the COPY,
+    and put chunks of chunk_size bytes on the queue.
+    '''
+    def __init__(self, queue, cancelled, chunk_size):
+        self.queue = queue
+        self.cancelled = cancelled
+        self.chunk_size = chunk_size
+        self.buffer = []
+        self.size = 0
+
+    def write(self, data):
+        self.buffer.append(data)
+        self.size += len(data)
+        if self.size >= self.chunk_size:
+            self.flush()
+
+    def flush(self):
+        if not self.buffer:
+            return
+        chunk = b''.join(self.buffer)
+        self.buffer = []
+        self.size = 0
+        self.put(chunk)
+
+    def put(self, item):
+        while True:
+            if self.cancelled.is_set():
+                raise CopyCancelled()
+            try:
+                self.queue.put(item, timeout=1)
+                return
+            except Queue.Full:
+                continue
+
+
+class _QueueReader(object):
+    '''
+    File-like object for "copy_expert": read the chunks put on the queue by
+    the producer.
+    '''
+    def __init__(self, queue):
+        self.queue = queue
+        self.buffer = b''
+        self.done = False
+        self.error = None
+
+    def read(self, size=-1):
+        while not self.done and (size < 0 or len(self.buffer) < size):
+            chunk = self.queue.get()
+            if chunk is _DONE:
+                self.done = True
+            elif isinstance(chunk, Exception):
+                # Note: psycopg2 aborts the COPY, raising QueryCanceled
+                self.error = chunk
+                raise chunk
+            else:
+                self.buffer += chunk
+        if size < 0 or size >= len(self.buffer):
+            data, self.buffer = self.buffer, b''
+        else:
+            data, self.buffer = self.buffer[:size], self.buffer[size:]
+        return data
+
+    readline = read
+
+
+def copy_to_generator(
+        copy_sql, chunk_size=DEFAULT_CHUNK_SIZE, queue_size=DEFAULT_QUEUE_SIZE):
+    '''
+    Yield the output of the "COPY ... TO STDOUT" statement in chunks of (about)
+    chunk_size bytes:
+    - memory use is bounded by chunk_size * queue_size,
+    - if the generator is closed before the COPY is complete, the COPY is
+    cancelled.
+
+    @param copy_sql a complete "COPY (...) TO STDOUT" statement: literal
+    values must be bound in the statement.
+    '''
+    queue = Queue.Queue(maxsize=queue_size)
+    cancelled = threading.Event()
+
+    def producer():
+        try:
+            writer = _QueueWriter(queue, cancelled, chunk_size)
+            with connection.cursor() as cursor:
+                cursor.copy_expert(copy_sql, writer)
+            writer.flush()
+            queue.put(_DONE)
+        except CopyCancelled:
+            logger.info('copy cancelled')
+        except Exception, e:
+            logger.exception('copy failed: %r', copy_sql)
+            queue.put(e)
+        finally:
+            connection.close()
+
+    thread = threading.Thread(target=producer, name='copy_to_generator')
+    thread.daemon = True
+    thread.start()
+    try:
+        while True:
+            chunk = queue.get()
+            if chunk is _DONE:
+                break
+            if isinstance(chunk, Exception):
+                raise chunk
+            yield chunk
+    finally:
+        cancelled.set()
+        # unblock the producer, if waiting on a full queue
+        while thread.is_alive():
+            try:
+                queue.get(timeout=0.1)
+            except Queue.Empty:
+                pass
+        thread.join()
+
+
+def copy_from_generator(
+        cursor, copy_sql, generator, chunk_size=DEFAULT_CHUNK_SIZE, 
+        queue_size=DEFAULT_QUEUE_SIZE):
+    '''
+    Execute the "COPY ... FROM STDIN" statement with the cursor, reading the 
+    input data from the generator:
+    - the generator is iterated in a producer thread, and the data are passed
+    to the COPY in chunks of (about) chunk_size bytes; memory use is bounded by 
+    chunk_size * queue_size,
+    - if the generator raises an exception, the COPY is aborted and the 
+    exception is raised in the calling thread.
+    
+    NOTE: database access in the generator uses a separate connection, and
+    transaction, of the producer thread, which does not see the uncommitted 
+    data of the caller: fetch the data used by the generator before calling.
+    
+    @param generator yields byte strings in the COPY input format
+    @return the number of rows copied
+    '''
+    queue = Queue.Queue(maxsize=queue_size)
+    cancelled = threading.Event()
+
+    def producer():
+        writer = _QueueWriter(queue, cancelled, chunk_size)
+        try:
+            for data in generator:
+                writer.write(data)
+            writer.flush()
+            writer.put(_DONE)
+        except CopyCancelled:
+            logger.info('copy cancelled')
+        except Exception, e:
+            logger.exception('copy input failed: %r', copy_sql)
+            try:
+                writer.put(e)
+            except CopyCancelled:
+                pass
+        finally:
+            connection.close()
+
+    thread = threading.Thread(target=producer, name='copy_from_generator')
+    thread.daemon = True
+    reader = _QueueReader(queue)
+    thread.start()
+    try:
+        cursor.copy_expert(copy_sql, reader, size=chunk_size)
+        return cursor.rowcount
+    except Exception:
+        if reader.error is not None:
+            raise reader.error
+        raise
+    finally:
+        cancelled.set()
+        # unblock the producer, if waiting on a full queue
+        while thread.is_alive():
+            try:
+                queue.get(timeout=0.1)
+            except Queue.Empty:
+                pass
+        thread.join()
@@ -0,0 +1,417 @@
+'''
+Cross-process, size-bounded cache for query result sets.
+
+The LocMemCache is private to each server process, so each gunicorn/mod_wsgi
+worker pays the cost of a page query once, and the memory used is not bounded
+by size. The SizeBoundedFileCache stores entries as files in a shared directory
+(use a tmpfs mount, e.g. "/dev/shm/...", for a shared memory backed store), and
+evicts the least recently used entries when the total size of the cache
+exceeds "MAX_BYTES".
+
+Use directly as a Django cache backend:
+
+CACHES = {
+    'db_cache': {
+        'BACKEND': 'reports.utils.result_cache.SizeBoundedFileCache',
+        'LOCATION': '/dev/shm/lims_result_cache/db_cache',
+        'TIMEOUT': None,
+        'OPTIONS': {
+            'MAX_BYTES': 512*1024**2,
+            'MAX_ENTRIES': 100000,
+        }
+    },
+    ...
+
+or set settings.USE_SHARED_RESULT_CACHE = True to replace the result caches
+used by the API resources (see get_result_cache).
+
+Table tags:
+Cached results are tagged with the tables that they read, so that writes evict
+only the results that read from the tables they modify:
+- each table has a version token, stored in each result cache,
+- a tagged entry records the version of each of its tables when it is cached,
+- invalidate_tables replaces the version tokens of the modified tables;
+entries tagged with an old version are evicted when they are next read.
+- the tables read are found from the SQLAlchemy statement; the tables modified
+are those declared by the writing resource (see ApiResource.get_modified_tables)
+'''
+from __future__ import unicode_literals
+
+from collections import Counter
+import errno
+import fcntl
+import io
+import logging
+import os
+import threading
+import uuid
+
+from django.conf import settings
+from django.core.cache import caches
+from django.core.cache.backends.base import DEFAULT_TIMEOUT
+from django.core.cache.backends.filebased import FileBasedCache
+from sqlalchemy.sql import visitors
+from sqlalchemy.sql.elements import TextClause
+from sqlalchemy.sql.selectable import TableClause, TextAsFrom
+
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_MAX_BYTES = 256*1024**2
+
+# Result caches that may be replaced by the shared result cache
+RESULT_CACHE_ALIASES = ['reports_cache', 'db_cache', 'screen_cache']
+
+TABLE_TAG_PREFIX = 'table_tag:'
+# Tag for entries where the tables read can not be determined:
+# these entries are evicted by any write
+ANY_TABLE = '*'
+
+_shared_caches = {}
+
+_cache_stats = Counter()
+_cache_stats_lock = threading.Lock()
+
+def count_cache_stat(name, count=1):
+    with _cache_stats_lock:
+        _cache_stats[name] += count
+
+def get_cache_stats():
+    '''
+    Return the result cache counters for this server process:
+    - hits, misses: tagged result lookups,
+    - stale_evictions: entries evicted on lookup because a table was modified,
+    - invalidations: writes that evicted entries by table,
+    - invalidated_tables: sum of the tables modified by each invalidation,
+    - clears: full cache clears
+    '''
+    with _cache_stats_lock:
+        stats = dict(_cache_stats)
+    for name in ['hits','misses','stale_evictions','invalidations',
+            'invalidated_tables','clears']:
+        stats.setdefault(name, 0)
+    lookups = stats['hits'] + stats['misses']
+    stats['hit_rate'] = float(stats['hits'])/lookups if lookups else None
+    return stats
+
+def reset_cache_stats():
+    with _cache_stats_lock:
+        _cache_stats.clear()
+
+def get_result_cache(alias):
+    '''
+    Return the cache for the alias:
+    - if settings.USE_SHARED_RESULT_CACHE is True, and the alias is one of the
+    RESULT_CACHE_ALIASES, return a SizeBoundedFileCache located in
+    settings.SHARED_RESULT_CACHE_DIR/alias,
+    - otherwise return the cache configured in settings.CACHES
+    '''
+    if getattr(settings, 'USE_SHARED_RESULT_CACHE', False) is not True:
+        return caches[alias]
+    if alias not in RESULT_CACHE_ALIASES:
+        return caches[alias]
+
+    cache = _shared_caches.get(alias)
+    if cache is None:
+        location = os.path.join(settings.SHARED_RESULT_CACHE_DIR, alias)
+        cache = SizeBoundedFileCache(location, {
+            'TIMEOUT': None,
+            'OPTIONS': {
+                'MAX_BYTES': getattr(
+                    settings, 'SHARED_RESULT_CACHE_MAX_BYTES',
+                    DEFAULT_MAX_BYTES),
+                'MAX_ENTRIES': getattr(
+                    settings, 'SHARED_RESULT_CACHE_MAX_ENTRIES', 100000),
+            }
+        })
+        logger.info('using shared result cache: %r, %r', alias, location)
+        _shared_caches[alias] = cache
+    return cache
+
+def get_statement_tables(stmt):
+    '''
+    Return the set of table names read by the SQLAlchemy statement, found by
+    traversing the statement elements (including subqueries, aliases and CTEs);
+    - returns None if the statement contains text clauses, as the tables read
+    by raw SQL can not be determined: set_tagged then tags the entry with 
+    ANY_TABLE.
+    '''
+    tables = set()
+    for element in visitors.iterate(stmt, {}):
+        if isinstance(element, TableClause):
+            tables.add(element.name)
+        elif isinstance(element, (TextClause, TextAsFrom)):
+            return None
+    return tables
+
+def _table_tag_key(table):
+    return '%s%s' % (TABLE_TAG_PREFIX, table)
+
+def get_table_tags(cache, tables):
+    '''
+    Return a dict of {table: version} for the tables, to store with a cache
+    entry; the table version is created if it does not exist.
+    - if no tables are given, the entry is tagged with ANY_TABLE
+    '''
+    tables = set(tables or [ANY_TABLE])
+    tag_keys = { _table_tag_key(table): table for table in tables }
+    versions = cache.get_many(tag_keys.keys())
+    tags = {}
+    for tag_key, table in tag_keys.items():
+        version = versions.get(tag_key)
+        if version is None:
+            version = uuid.uuid4().hex
+            if not cache.add(tag_key, version, None):
+                # created by another process
+                version = cache.get(tag_key, version)
+        tags[table] = version
+    return tags
+
+def is_tag_current(cache, tags):
+    '''
+    Return True if the table versions recorded in the tags are current
+    '''
+    if not tags:
+        return False
+    tag_keys = { _table_tag_key(table): version
+        for table, version in tags.items() }
+    versions = cache.get_many(tag_keys.keys())
+    for tag_key, version in tag_keys.items():
+        if versions.get(tag_key) != version:
+            return False
+    return True
+
+def get_tagged(cache, key, default=None):
+    '''
+    Get a value stored with set_tagged; if any of the tables it is tagged with
+    has been modified, evict the entry and return the default.
+    '''
+    entry = cache.get(key)
+    if entry is None:
+        count_cache_stat('misses')
+        return default
+    if not is_tag_current(cache, entry.get('tags')):
+        count_cache_stat('stale_evictions')
+        count_cache_stat('misses')
+        cache.delete(key)
+        return default
+    count_cache_stat('hits')
+    return entry['value']
+
+def set_tagged(cache, key, value, tables=None, timeout=DEFAULT_TIMEOUT,
+        tags=None):
+    '''
+    Store the value, tagged with the tables it was read from;
+    - if tables are not specified, the value is tagged with ANY_TABLE, and is
+    evicted by any write.
+    @param tags (optional) table tags obtained (see get_table_tags) before the
+    value was read; use so that writes made while reading evict the value.
+    '''
+    if tags is None:
+        tags = get_table_tags(cache, tables)
+    cache.set(key, {
+        'tags': tags,
+        'value': value }, timeout)
+
+def invalidate_tables(tables):
+    '''
+    Evict the entries in the result caches that are tagged with any of the
+    tables, and the entries tagged with ANY_TABLE.
+    
+    Note: the table versions are stored in the result caches; for a process
+    local cache (LocMemCache), only the entries cached by the current process
+    are evicted (as for cache.clear()); use the shared result cache 
+    (settings.USE_SHARED_RESULT_CACHE) for multi-process servers.
+    '''
+    tables = set(tables)
+    tables.add(ANY_TABLE)
+    for alias in RESULT_CACHE_ALIASES:
+        get_result_cache(alias).set_many({
+            _table_tag_key(table): uuid.uuid4().hex for table in tables }, None)
+    count_cache_stat('invalidations')
+    count_cache_stat('invalidated_tables', len(tables)-1)
+    logger.info('invalidate cached results for tables: %r', sorted(tables))
+
+class SizeBoundedFileCache(FileBasedCache):
+    '''
+    File based cache that evicts least recently used entries to keep the total
+    size of the cache files below "MAX_BYTES":
+
+    - the cache file modification time records the last access; it is updated
+    on each cache hit,
+    - the total size and number of the entries are kept in a sidecar file
+    (".size"), updated by each set; the cache directory is only listed (and
+    the least recently used entries evicted) when the total exceeds 
+    MAX_BYTES or MAX_ENTRIES,
+    - the sidecar file is updated, and eviction performed, under an exclusive
+    lock on the cache directory, so that concurrent workers do not evict the
+    same entries.
+    
+    Note: entries removed other than by set (expired, deleted) are not 
+    subtracted from the total; the total is an upper bound, corrected when 
+    the directory is listed.
+    '''
+    lock_file_name = '.cull.lock'
+    size_file_name = '.size'
+
+    def __init__(self, dir, params):
+        super(SizeBoundedFileCache, self).__init__(dir, params)
+        options = params.get('OPTIONS', {})
+        self._max_bytes = int(options.get('MAX_BYTES', DEFAULT_MAX_BYTES))
+
+    def get(self, key, default=None, version=None):
+        value = super(SizeBoundedFileCache, self).get(
+            key, default=default, version=version)
+        if value is not default:
+            self._touch(self._key_to_file(key, version))
+        return value
+
+    def set(self, key, value, timeout=DEFAULT_TIMEOUT, version=None):
+        fname = self._key_to_file(key, version)
+        old_size = self._get_file_size(fname)
+        super(SizeBoundedFileCache, self).set(
+            key, value, timeout=timeout, version=version)
+        entry_size = self._get_file_size(fname)
+        if entry_size is None:
+            return
+        if entry_size > self._max_bytes:
+            logger.warn(
+                'cache entry size: %d, exceeds the MAX_BYTES: %d, not cached',
+                entry_size, self._max_bytes)
+            self._delete(fname)
+            entry_size = None
+        self._update_size(
+            (entry_size or 0) - (old_size or 0),
+            (entry_size is not None) - (old_size is not None), 
+            keep=fname)
+
+    def clear(self):
+        super(SizeBoundedFileCache, self).clear()
+        if not os.path.exists(self._dir):
+            # Nothing has been cached; the lock file can not be created
+            return
+        with self._lock():
+            self._write_size(0, 0)
+
+    def get_size(self):
+        ''' Return the total size, in bytes, of the cache files '''
+        return sum(size for (fname, mtime, size) in self._list_cache_entries())
+
+    def _cull(self):
+        # Disable the random cull of the parent: eviction is performed after
+        # the new entry is written (see _update_size)
+        pass
+
+    def _touch(self, fname):
+        try:
+            os.utime(fname, None)
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
+
+    def _get_file_size(self, fname):
+        ''' Return the size of the file, or None if it does not exist '''
+        try:
+            return os.path.getsize(fname)
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
+            return None
+
+    def _lock(self):
+        return _DirectoryLock(os.path.join(self._dir, self.lock_file_name))
+
+    def _read_size(self):
+        '''
+        Return the (total size, number of entries) recorded in the sidecar 
+        file, or None if it does not exist, or can not be read
+        '''
+        try:
+            with io.open(
+                    os.path.join(self._dir, self.size_file_name), 'rb') as f:
+                total_size, num_entries = f.read().split()
+                return (int(total_size), int(num_entries))
+        except (IOError, OSError, ValueError):
+            return None
+
+    def _write_size(self, total_size, num_entries):
+        path = os.path.join(self._dir, self.size_file_name)
+        with io.open(path, 'wb') as f:
+            f.write(b'%d %d' % (max(total_size, 0), max(num_entries, 0)))
+
+    def _update_size(self, delta_size, delta_entries, keep=None):
+        '''
+        Add the deltas to the total recorded in the sidecar file; cull the
+        cache if the total exceeds MAX_BYTES or MAX_ENTRIES.
+        '''
+        with self._lock():
+            current = self._read_size()
+            if current is None:
+                self._cull_to_size(keep=keep)
+                return
+            total_size = current[0] + delta_size
+            num_entries = current[1] + delta_entries
+            if (total_size > self._max_bytes 
+                    or num_entries > self._max_entries):
+                self._cull_to_size(keep=keep)
+            else:
+                self._write_size(total_size, num_entries)
+
+    def _list_cache_entries(self):
+        entries = []
+        for fname in self._list_cache_files():
+            try:
+                stat = os.stat(fname)
+            except OSError as e:
+                if e.errno != errno.ENOENT:
+                    raise
+                continue
+            entries.append((fname, stat.st_mtime, stat.st_size))
+        return entries
+
+    def _cull_to_size(self, keep=None):
+        '''
+        List the cache entries, and remove the least recently used entries 
+        until the cache is below MAX_BYTES and MAX_ENTRIES; record the total 
+        in the sidecar file. The directory lock must be held.
+        @param keep the file name of an entry that should not be removed
+        '''
+        entries = self._list_cache_entries()
+        total_size = sum(size for (fname, mtime, size) in entries)
+        num_entries = len(entries)
+        evicted = 0
+        if (total_size > self._max_bytes
+                or num_entries > self._max_entries):
+            for fname, mtime, size in sorted(entries, key=lambda x: x[1]):
+                if (total_size <= self._max_bytes
+                        and num_entries <= self._max_entries):
+                    break
+                if fname == keep:
+                    continue
+                self._delete(fname)
+                total_size -= size
+                num_entries -= 1
+                evicted += 1
+            logger.info('evicted %d entries from %r, size: %d',
+                evicted, self._dir, total_size)
+        self._write_size(total_size, num_entries)
+        return evicted
+
+
+class _DirectoryLock(object):
+    ''' Exclusive (flock) lock on the lock file, for the with statement '''
+    
+    def __init__(self, lock_path):
+        self.lock_path = lock_path
+        self.lock_file = None
+    
+    def __enter__(self):
+        self.lock_file = io.open(self.lock_path, 'ab')
+        fcntl.flock(self.lock_file.fileno(), fcntl.LOCK_EX)
+        return self
+    
+    def __exit__(self, *args):
+        try:
+            fcntl.flock(self.lock_file.fileno(), fcntl.LOCK_UN)
+        finally:
+            self.lock_file.close()